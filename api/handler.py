@@ -18,6 +18,7 @@
 
 import calendar
 from datetime import datetime, timedelta
+import email.utils
 import hashlib
 import logging
 import time
@@ -29,36 +30,63 @@ try:
 except ImportError:
     import simplejson
 
+from google.appengine.ext import db
+
 from playlists.models import (chirp_playlist_key, PlaylistTrack,
-                              PlayCountSnapshot)
-from djdb import pylast
-from common import dbconfig
+                              PlaylistChange, PlayChart, put_tracks)
+from common import autoretry, identity, profiler
+from djdb import cover_art
+from djdb.models import Album
 
 
 log = logging.getLogger()
 
 
+HTTP_DATE_FORMAT = "%a, %d %b %Y %H:%M:%S GMT"
+
+
+def encode_response(data, last_modified=None):
+    """Encodes view data into a response that can be cached and served.
+
+    The JSON body is encoded once here and served as is along with an
+    ETag (a hash of the body) and a Last-Modified timestamp.
+    """
+    # Default encoding is UTF-8
+    body = simplejson.dumps(data)
+    return {'data': data,
+            'body': body,
+            'etag': hashlib.sha1(body).hexdigest(),
+            'last_modified': int(last_modified or time.time())}
+
+
 class ApiHandler(webapp.RequestHandler):
     use_cache = False
     memcache_ttl = 60  # seconds
+    # Seconds past memcache_ttl that stale data may still be served
+    # while a single request recomputes it.
+    stale_grace = 30
+    # Seconds one request may hold the right to recompute the cache.
+    lease_ttl = 10
+    # How long requests wait for the lease holder when nothing is cached.
+    lease_polls = 10
+    lease_poll_interval = 0.1  # seconds
 
     def get(self):
         self.response.headers['Content-Type'] = 'application/json'
         if not self.use_cache:
-            data = self.get_json()
+            resp = encode_response(self.get_json())
         else:
-            if self.cache_key is None:
-                raise NotImplementedError("cache_key was not set")
-            data = memcache.get(self.cache_key)
-            if not data:
-                data = self.get_json()
-                memcache.set(self.cache_key, data, time=self.memcache_ttl)
-        self.check_data(data)
-        # Default encoding is UTF-8
-        js = simplejson.dumps(data)
-        if self.request.str_GET.get('jsonp'):
+            resp = self.get_cached_response()
+        self.check_data(resp['data'])
+
+        body = resp['body']
+        etag = resp['etag']
+        jsonp = self.request.str_GET.get('jsonp')
+        if jsonp:
             self.response.headers['Content-Type'] = 'application/x-javascript'
-            js = '%s(%s);' % (self.request.str_GET['jsonp'], js)
+            # The body differs per callback so the ETag does too.
+            etag = '%s-%s' % (etag, hashlib.sha1(jsonp).hexdigest()[:8])
+            body = '%s(%s);' % (jsonp, body)
 
         # Clients shouldn't poll more than 15 seconds but we want to make
         # sure they don't miss new tracks so the cache here is low.
@@ -70,8 +98,27 @@ class ApiHandler(webapp.RequestHandler):
         self.response.headers['Expires'] = expires
         self.response.headers['Cache-Control'] = \
                                 'public, max-age=%s' % cache_for_secs
+        self.response.headers['ETag'] = '"%s"' % etag
+        self.response.headers['Last-Modified'] = time.strftime(
+                HTTP_DATE_FORMAT, time.gmtime(resp['last_modified']))
 
-        self.response.out.write(js)
+        if self.is_not_modified(etag, resp['last_modified']):
+            self.response.set_status(304)
+            return
+        self.response.out.write(body)
+
+    def is_not_modified(self, etag, last_modified):
+        """True if the client's conditional GET headers match the response."""
+        if_none_match = self.request.headers.get('If-None-Match')
+        if if_none_match:
+            tags = [t.strip() for t in if_none_match.split(',')]
+            return '*' in tags or '"%s"' % etag in tags
+        if_modified_since = self.request.headers.get('If-Modified-Since')
+        if if_modified_since:
+            parsed = email.utils.parsedate_tz(if_modified_since)
+            if parsed:
+                return email.utils.mktime_tz(parsed) >= last_modified
+        return False
 
     def check_data(self, data):
         """Optional hook to do something with the view's data.
@@ -82,9 +129,95 @@ class ApiHandler(webapp.RequestHandler):
 
 
 class CachedApiHandler(ApiHandler):
+    """An API handler that caches its encoded response in memcache.
+
+    The response is fresh for memcache_ttl seconds and then kept for
+    another stale_grace seconds.  When it goes stale (or is missing) only
+    the request that wins a memcache lease runs get_json(); the others
+    keep serving the stale response.  This stops a wave of polling
+    clients from all recomputing at once.
+    """
     use_cache = True
     cache_key = None
 
+    @classmethod
+    def _fresh_key(cls):
+        return '%s.fresh' % cls.cache_key
+
+    @classmethod
+    def _lease_key(cls):
+        return '%s.lease' % cls.cache_key
+
+    @classmethod
+    def _encode(cls, data, previous=None):
+        resp = encode_response(data)
+        if previous and previous['etag'] == resp['etag']:
+            # Nothing changed since the last time this was encoded.
+            resp['last_modified'] = previous['last_modified']
+        return resp
+
+    @classmethod
+    def set_cache(cls, data, previous=None):
+        """Encodes and caches data, returning the cached response."""
+        resp = cls._encode(data, previous=previous)
+        memcache.set(cls.cache_key, resp,
+                     time=cls.memcache_ttl + cls.stale_grace)
+        memcache.set(cls._fresh_key(), 1, time=cls.memcache_ttl)
+        return resp
+
+    @classmethod
+    def update_cache(cls, update, fresh=True):
+        """Applies update(data) to the cached data.
+
+        This is for writing changes through to the cache instead of
+        invalidating it.  If update() returns None the cache is deleted.
+        Nothing happens when there is no cached data.  Unless fresh is
+        true the updated data is only served until the next request
+        recomputes it behind the lease.
+        """
+        client = memcache.Client()
+        for attempt in range(3):
+            resp = client.gets(cls.cache_key)
+            if resp is None:
+                return
+            data = update(resp['data'])
+            if data is None:
+                break
+            if client.cas(cls.cache_key, cls._encode(data, previous=resp),
+                          time=cls.memcache_ttl + cls.stale_grace):
+                if fresh:
+                    memcache.set(cls._fresh_key(), 1,
+                                 time=cls.memcache_ttl)
+                else:
+                    memcache.delete(cls._fresh_key())
+                return
+        # Lost the race to other writers; the next request will recompute.
+        memcache.delete_multi([cls.cache_key, cls._fresh_key()])
+
+    def get_cached_response(self):
+        if self.cache_key is None:
+            raise NotImplementedError("cache_key was not set")
+        cached = memcache.get_multi([self.cache_key, self._fresh_key()])
+        resp = cached.get(self.cache_key)
+        if resp and self._fresh_key() in cached:
+            return resp
+        if memcache.add(self._lease_key(), 1, time=self.lease_ttl):
+            try:
+                resp = self.set_cache(self.get_json(), previous=resp)
+            finally:
+                memcache.delete(self._lease_key())
+            return resp
+        if resp:
+            # Another request is recomputing.
+            return resp
+        for i in range(self.lease_polls):
+            time.sleep(self.lease_poll_interval)
+            resp = memcache.get(self.cache_key)
+            if resp:
+                return resp
+        log.warning('Gave up waiting on %s lease' % self.cache_key)
+        return encode_response(self.get_json())
+
 
 def iter_tracks(data):
     yield data['now_playing']
@@ -92,21 +225,32 @@ def iter_tracks(data):
         yield track
 
 
+def tracks_as_playlist(tracks):
+    """Returns current playlist data for the 6 latest of these tracks.
+
+    Returns None if there are no tracks.
+    """
+    tracks = sorted(tracks,
+                    key=lambda t: (t['played_at_gmt_ts'], t['played_at_gmt']),
+                    reverse=True)
+    if not tracks:
+        return None
+    return {'now_playing': tracks[0],
+            'recently_played': tracks[1:6]}
+
+
 class CurrentPlaylist(CachedApiHandler):
     """Current track playing on CHIRP and recently played tracks."""
     cache_key = 'api.current_track'
 
     def check_data(self, data):
-        for track in iter_tracks(data):
-            if not track['lastfm_urls']['_processed']:
-                try:
-                    taskqueue.add(url='/api/_check_lastfm_links',
-                                  queue_name='lastfm',
-                                  params={'id': track['id']})
-                except:
-                    log.exception('IGNORED while adding task')
-
-    def track_as_data(self, track):
+        ids = [track['id'] for track in iter_tracks(data)
+               if not track['lastfm_urls']['_processed']]
+        if ids:
+            enqueue_lastfm_links(ids)
+
+    @staticmethod
+    def track_as_data(track):
         # Create Unix timestamps.
         played_g = track.established.utctimetuple()
         played_local = time.mktime(track.established_display.timetuple())
@@ -122,7 +266,7 @@ class CurrentPlaylist(CachedApiHandler):
             'release': track.album_title,
             'label': track.label_display,
             'notes': track.notes or '',
-            'dj': track.selector.effective_dj_name,
+            'dj': track.dj_name,
             'played_at_gmt': track.established.isoformat(),
             'played_at_gmt_ts': calendar.timegm(played_g),
             'played_at_local': track.established_display.isoformat(),
@@ -148,6 +292,42 @@ class CurrentPlaylist(CachedApiHandler):
             'recently_played': [self.track_as_data(t) for t in recent_tracks]
         }
 
+    @classmethod
+    def write_through(cls, *tracks):
+        """Merges tracks that were just saved into the cached playlist.
+
+        The query in get_json() might not see a new track yet (HRD lag)
+        so saved tracks are placed into the cached data directly.
+        """
+        playlist_key = chirp_playlist_key()
+        saved = dict((str(t.key()), cls.track_as_data(t)) for t in tracks
+                     if PlaylistTrack.playlist.get_value_for_datastore(t)
+                        == playlist_key)
+        if not saved:
+            return
+
+        def update(data):
+            merged = [t for t in iter_tracks(data) if t['id'] not in saved]
+            merged.extend(saved.values())
+            return tracks_as_playlist(merged)
+
+        cls.update_cache(update)
+
+    @classmethod
+    def evict(cls, track_key):
+        """Removes a deleted track from the cached playlist.
+
+        The playlist is one track short until the next request recomputes
+        it, so it is not marked fresh.
+        """
+        track_key = str(track_key)
+
+        def update(data):
+            return tracks_as_playlist([t for t in iter_tracks(data)
+                                       if t['id'] != track_key])
+
+        cls.update_cache(update, fresh=False)
+
     def post(self):
         # For some reason _ah/warmup is posting to current_playlist
         # instead of GET.  This might be a bug or it might be some 'ghost
@@ -156,6 +336,72 @@ class CurrentPlaylist(CachedApiHandler):
         return self.get()
 
 
+class PlaylistChanges(ApiHandler):
+    """Playlist tracks added, changed or deleted since a version.
+
+    Pass since=<version> from the previous response to get only newer
+    changes.  Pass wait=<seconds> to hold the request open until there
+    is a change (or the wait runs out).  Changes are only kept for
+    PlaylistChange.RETENTION so a client that has been away longer
+    should reload the whole playlist.
+    """
+    max_wait = 25  # seconds
+    poll_interval = 1  # seconds
+    max_changes = 50
+
+    def get_json(self):
+        try:
+            since = int(self.request.get('since') or 0)
+            wait = min(float(self.request.get('wait') or 0), self.max_wait)
+        except ValueError:
+            self.abort(400)
+        playlist_key = chirp_playlist_key()
+
+        # Waiting only touches memcache so idle clients are cheap.
+        deadline = time.time() + wait
+        while PlaylistChange.latest_version(playlist_key) <= since:
+            if time.time() >= deadline:
+                return {'version': since, 'changes': [], 'more': False}
+            time.sleep(self.poll_interval)
+
+        changes = PlaylistChange.since(playlist_key, since,
+                                       limit=self.max_changes + 1)
+        more = len(changes) > self.max_changes
+        changes = changes[:self.max_changes]
+        return {
+            'version': changes and changes[-1].version or since,
+            'changes': self.changes_as_data(changes),
+            'more': more
+        }
+
+    def changes_as_data(self, changes):
+        """Collapses changes into one entry per track, oldest first."""
+        actions = {}
+        order = []
+        for change in changes:
+            key = str(change.track_key)
+            if key not in actions:
+                order.append(key)
+                actions[key] = change.action
+            elif (actions[key] == PlaylistChange.ADD and
+                  change.action == PlaylistChange.CHANGE):
+                # Still a new track as far as the client knows.
+                continue
+            else:
+                actions[key] = change.action
+        keys = [k for k in order if actions[k] != PlaylistChange.DELETE]
+        tracks = dict(zip(keys, db.get(keys)))
+        data = []
+        for key in order:
+            track = tracks.get(key)
+            if track is None:
+                data.append({'id': key, 'action': PlaylistChange.DELETE})
+            else:
+                data.append({'id': key, 'action': actions[key],
+                             'track': CurrentPlaylist.track_as_data(track)})
+        return data
+
+
 class Index(ApiHandler):
     """Lists available resources."""
 
@@ -166,96 +412,134 @@ class Index(ApiHandler):
         }
 
 
+# Seconds a track stays in the pending set after its Last.fm lookup
+# was queued.  This matches the task_age_limit of the lastfm queue.
+LASTFM_PENDING_TTL = 60 * 5
+
+
+def enqueue_lastfm_links(ids):
+    """Queues one Last.fm lookup task for the tracks not already pending.
+
+    Each track is claimed with memcache.add() so concurrent API requests
+    only queue it once.  The task name is derived from the claimed ids
+    and the current claim period as a second line of defense if memcache
+    is flushed; task names stay tombstoned long after the task ran so
+    the same ids must be able to queue again in a later period.
+    """
+    claimed = [id for id in ids
+               if memcache.add('api.lastfm_pending.%s' % id, 1,
+                               time=LASTFM_PENDING_TTL)]
+    if not claimed:
+        return
+    name = 'lastfm-%s-%d' % (
+        hashlib.sha1(','.join(sorted(claimed))).hexdigest(),
+        int(time.time() // LASTFM_PENDING_TTL))
+    try:
+        taskqueue.add(url='/api/_check_lastfm_links',
+                      queue_name='lastfm',
+                      name=name,
+                      params={'id': claimed})
+    except taskqueue.TaskAlreadyExistsError:
+        return
+    except taskqueue.TombstonedTaskError:
+        # Already ran this period; let a later request queue it again.
+        memcache.delete_multi(claimed, key_prefix='api.lastfm_pending.')
+        return
+    except:
+        log.exception('IGNORED while adding task')
+        # Let the next request try again.
+        memcache.delete_multi(claimed, key_prefix='api.lastfm_pending.')
+        return
+    minute = time.strftime('%Y%m%d%H%M', time.gmtime())
+    count = memcache.incr('api.lastfm_enqueued.%s' % minute,
+                          delta=len(claimed), initial_value=0)
+    log.info('Queued Last.fm lookup for %s tracks (%s this minute)'
+             % (len(claimed), count))
+
+
 class CheckLastFMLinks(webapp.RequestHandler):
+    """Task to fetch Last.fm cover images for one or more tracks."""
 
     def post(self):
         links_fetched = 0
-        if not self.request.POST.get('id'):
+        ids = self.request.POST.getall('id')
+        if not ids:
             # This is a temporary workaround to free up the task queue. It
             # seems that old tasks are stuck in an error-retry loop
             log.error('id not found in POST')
             self.response.out.write(simplejson.dumps({'success': False}))
             return
-        track = PlaylistTrack.get(self.request.POST['id'])
-        if track is None:
+        tracks = [t for t in PlaylistTrack.get(ids) if t is not None]
+        if len(tracks) < len(ids):
             # Track was deleted by DJ, other scenarios?
-            log.warning('track does not exist: %s' % self.request.POST['id'])
+            log.warning('%s of %s tracks do not exist: %s'
+                        % (len(ids) - len(tracks), len(ids), ids))
+        if not tracks:
             self.response.out.write(simplejson.dumps({'success': False}))
             return
-        try:
-            fm = pylast.get_lastfm_network(
-                                api_key=dbconfig['lastfm.api_key'])
-            fm_album = fm.get_album(track.artist_name, track.album_title)
-            track.lastfm_url_sm_image = \
-                            fm_album.get_cover_image(pylast.COVER_SMALL)
-            track.lastfm_url_med_image = \
-                            fm_album.get_cover_image(pylast.COVER_MEDIUM)
-            track.lastfm_url_large_image = \
-                            fm_album.get_cover_image(pylast.COVER_LARGE)
-        except pylast.WSError:
-            # Probably album not found
-            log.exception('IGNORED while fetching LastFM data')
-        track.lastfm_urls_processed = True  # Even on error
-        track.save()
-        memcache.delete(CurrentPlaylist.cache_key)
+        identity.prefetch(tracks, 'album')
+        for track in tracks:
+            # Tracks from the same album share the cached cover art.
+            art = cover_art.refresh(track.artist_name, track.album_title,
+                                    album=track.album)
+            if art['found']:
+                links_fetched += 1
+            track.lastfm_url_sm_image = art['sm']
+            track.lastfm_url_med_image = art['med']
+            track.lastfm_url_large_image = art['lg']
+            track.lastfm_urls_processed = True  # Even when not found
+        # Writes through to the CurrentPlaylist cache.
+        put_tracks(tracks)
+        memcache.delete_multi(ids, key_prefix='api.lastfm_pending.')
         self.response.out.write(simplejson.dumps({
             'success': True,
             'links_fetched': links_fetched
         }))
 
 
+class RefreshCoverArt(webapp.RequestHandler):
+    """Task to fetch cover art from Last.fm for djdb.cover_art.lookup()."""
+
+    def post(self):
+        album = None
+        if self.request.POST.get('album_key'):
+            album = Album.get(self.request.POST['album_key'])
+        cover_art.refresh(self.request.POST.get('artist'),
+                          self.request.POST.get('album'),
+                          album=album)
+        self.response.out.write(simplejson.dumps({'success': True}))
+
+
 class Stats(CachedApiHandler):
     """CHIRP Radio statistics for weekly plays, etc."""
     cache_key = 'api.stats'
-    memcache_ttl = 60 * 60 * 4  # 4 hours
+    # Charts are precomputed; see PlayChart.
+    memcache_ttl = 60 * 15
 
-    def get_json(self):
-        end = datetime.now()
-        start = end - timedelta(days=7)
-        qs = (PlayCountSnapshot.all()
-              .filter('established >=', start)
-              .filter('established <=', end))
-
-        # Collect the play counts.
-        weekly = {}
-        for count in qs.run():
-            id = count.track_id
-            weekly.setdefault(id, {'play_count': []})
-            weekly[id].update({'artist': count.artist_name,
-                               'release': count.album_title,
-                               'label': count.label,
-                               'id': id})
-            weekly[id]['play_count'].append(count.play_count)
-
-        for key, stat in weekly.iteritems():
-            pc = stat['play_count']
-            weekly[key].update({
-                # Average the play counts per release.
-                'play_count': int(round(sum(pc) / len(pc), 1)),
-                # Make this ID shorter so it's easier for clients.
-                'id': hashlib.sha1(stat['id']).hexdigest()
-            })
-
-        # Sort the releases in descending order of play count.
-        rel = sorted(weekly.values(),
-                     key=lambda c: (c['play_count'], c['release']),
-                     reverse=True)
-        # Limit to top 40.
-        rel = rel[0:40]
+    @staticmethod
+    def chart_as_data(chart):
+        return {
+            'start': chart.start.strftime('%Y-%m-%d'),
+            'end': chart.end.strftime('%Y-%m-%d'),
+            'releases': chart.releases
+        }
 
+    def get_json(self):
         return {
-            'this_week': {
-                'start': start.strftime('%Y-%m-%d'),
-                'end': end.strftime('%Y-%m-%d'),
-                'releases': rel
-            }
+            'today': self.chart_as_data(PlayChart.get_chart('day')),
+            'this_week': self.chart_as_data(PlayChart.get_chart('week')),
+            'this_month': self.chart_as_data(PlayChart.get_chart('month'))
         }
 
 
 services = [('/api/', Index),
             ('/api/current_playlist', CurrentPlaylist),
+            ('/api/playlist_changes', PlaylistChanges),
             ('/api/stats', Stats),
-            ('/api/_check_lastfm_links', CheckLastFMLinks)]
+            ('/api/_check_lastfm_links', CheckLastFMLinks),
+            ('/api/_refresh_cover_art', RefreshCoverArt)]
 debug = False
 
 application = webapp.WSGIApplication(services, debug=debug)
+for middleware in (identity, autoretry, profiler):
+    application = middleware.wsgi_middleware(application)
@@ -18,13 +18,16 @@
 
 from __future__ import with_statement
 from datetime import datetime, timedelta
+import time
 import urllib
 import unittest
 
 from django.utils import simplejson
 import fudge
+import fudge.inspector
 from google.appengine.api import memcache
-from google.appengine.api.taskqueue import TransientError
+from google.appengine.api.taskqueue import (TombstonedTaskError,
+                                           TransientError)
 from nose.tools import eq_
 from webtest import TestApp
 
@@ -34,10 +37,12 @@ from api.handler import application
 import auth.roles
 from auth.models import User
 from playlists.models import (Playlist, PlaylistTrack, ChirpBroadcast,
-                              PlayCountSnapshot)
+                              PlaylistChange, PlayCountSnapshot, PlayChart)
 from playlists.tests.test_views import create_stevie_wonder_album_data
-from common import dbconfig
+import playlists.models
+from common import dbconfig, expiry
 from djdb import pylast
+from djdb.models import Album
 
 
 def clear_data():
@@ -49,6 +54,10 @@ def clear_data():
         u.delete()
     for ob in PlayCountSnapshot.all():
         ob.delete()
+    for ob in PlaylistChange.all():
+        ob.delete()
+    for ob in PlayChart.all():
+        ob.delete()
 
 class APITest(unittest.TestCase):
 
@@ -100,6 +109,7 @@ class TestServiceIndex(PlaylistTest):
         eq_(sorted([s[0] for s in self.request('/api/')['services']]),
             ['/api/',
              '/api/current_playlist',
+             '/api/playlist_changes',
              '/api/stats'])
 
 
@@ -173,6 +183,53 @@ class TestTrackPlayingNow(PlaylistTest):
         assert 'Expires' in rs.headers, ('Unexpected: %s' % rs.headers)
         assert 'Cache-Control' in rs.headers, ('Unexpected: %s' % rs.headers)
 
+    def test_conditional_get_with_etag(self):
+        rs = self.client.get('/api/current_playlist')
+        etag = rs.headers['ETag']
+        rs = self.client.get('/api/current_playlist',
+                             headers={'If-None-Match': etag}, status=304)
+        eq_(rs.body, '')
+        eq_(rs.headers['ETag'], etag)
+
+    def test_etag_changes_with_playlist(self):
+        rs = self.client.get('/api/current_playlist')
+        etag = rs.headers['ETag']
+        self.play_stevie_song('Maybe Your Baby')
+        rs = self.client.get('/api/current_playlist',
+                             headers={'If-None-Match': etag})
+        eq_(rs.status, '200 OK')
+        assert rs.headers['ETag'] != etag
+        data = simplejson.loads(rs.body)
+        eq_(data['now_playing']['track'], 'Maybe Your Baby')
+
+    def test_conditional_get_with_last_modified(self):
+        rs = self.client.get('/api/current_playlist')
+        modified = rs.headers['Last-Modified']
+        rs = self.client.get('/api/current_playlist',
+                             headers={'If-Modified-Since': modified},
+                             status=304)
+        eq_(rs.body, '')
+
+    def test_recompute_keeps_last_modified(self):
+        rs = self.client.get('/api/current_playlist')
+        modified = rs.headers['Last-Modified']
+        memcache.delete('api.current_track.fresh')
+        rs = self.client.get('/api/current_playlist')
+        eq_(rs.headers['Last-Modified'], modified)
+
+    def test_jsonp_etag(self):
+        rs = self.client.get('/api/current_playlist')
+        etag = rs.headers['ETag']
+        url = '/api/current_playlist?%s' % urllib.urlencode(
+                                                {'jsonp': 'parseRequest'})
+        rs = self.client.get(url, headers={'If-None-Match': etag})
+        eq_(rs.status, '200 OK')
+        assert rs.body.startswith('parseRequest({'), (
+                                            'Unexpected: %r' % rs.body)
+        rs = self.client.get(url, headers={'If-None-Match':
+                                           rs.headers['ETag']},
+                             status=304)
+
     def test_allow_post(self):
         # support for _ah/warmup ?
         r = self.client.post('/api/current_playlist', {})
@@ -181,9 +238,13 @@ class TestTrackPlayingNow(PlaylistTest):
         current = data['now_playing']
         eq_(current['artist'], 'Stevie Wonder')
 
-    @fudge.patch('api.handler.taskqueue')
-    def test_build_lastfm_links(self, fake_tq):
-        fake_tq.expects('add').with_args(url='/api/_check_lastfm_links')
+    @fudge.patch('api.handler.taskqueue.add')
+    def test_build_lastfm_links(self, fake_add):
+        fake_add.expects_call().with_args(
+                                url='/api/_check_lastfm_links',
+                                queue_name='lastfm',
+                                name=fudge.inspector.arg.any_value(),
+                                params={'id': [str(self.track.key())]})
         data = self.request('/api/current_playlist')
         current = data['now_playing']
         eq_(current['lastfm_urls'], {
@@ -200,16 +261,46 @@ class TestTrackPlayingNow(PlaylistTest):
         fake_log.expects('exception')
         data = self.request('/api/current_playlist')
 
-    @fudge.patch('api.handler.taskqueue')
-    def test_build_partial_lastfm_links(self, fake_tq):
-        (fake_tq.expects('add')
-                .with_args(url='/api/_check_lastfm_links')
-                .times_called(2))
+    @fudge.patch('api.handler.taskqueue.add')
+    def test_build_partial_lastfm_links(self, fake_add):
+        # Queued once even though the track stays unprocessed.
+        fake_add.expects_call().times_called(1)
         data = self.request('/api/current_playlist')
         data['now_playing']['lastfm_urls']['sm_image'] = 'http://.../'
-        memcache.set('api.current_track', data)
+        api.handler.CurrentPlaylist.set_cache(data)
         data = self.request('/api/current_playlist')
 
+    @fudge.patch('api.handler.taskqueue.add')
+    def test_failed_enqueue_is_retried(self, fake_add):
+        (fake_add.expects_call().raises(TransientError)
+                 .next_call().returns(None))
+        self.request('/api/current_playlist')
+        self.request('/api/current_playlist')
+
+    @fudge.patch('api.handler.taskqueue.add')
+    def test_tombstoned_enqueue_is_retried(self, fake_add):
+        (fake_add.expects_call().raises(TombstonedTaskError)
+                 .next_call().returns(None))
+        self.request('/api/current_playlist')
+        self.request('/api/current_playlist')
+
+    def test_task_name_changes_each_period(self):
+        names = []
+
+        def add(**kw):
+            names.append(kw['name'])
+
+        with fudge.patched_context(api.handler.taskqueue, 'add', add):
+            for now in (1000000.0,
+                        1000000.0 + api.handler.LASTFM_PENDING_TTL):
+                memcache.delete_multi(['a', 'b'],
+                                      key_prefix='api.lastfm_pending.')
+                with fudge.patched_context(api.handler.time, 'time',
+                                           lambda: now):
+                    api.handler.enqueue_lastfm_links(['a', 'b'])
+        eq_(len(names), 2)
+        assert names[0] != names[1], names
+
     def test_non_ascii(self):
         unicode_text = 'フォクすけといっしょ'.decode('utf8')
         self.playlist_track.artist.name = unicode_text
@@ -310,6 +401,242 @@ class TestRecentlyPlayedTracks(PlaylistTest):
              "Tuesday Heartbreak"])
 
 
+class TestCurrentPlaylistCache(PlaylistTest):
+
+    def setUp(self):
+        super(TestCurrentPlaylistCache, self).setUp()
+        self.play_stevie_song('Tuesday Heartbreak')
+        self.recomputes = 0
+        # Called while a recompute holds the lease.
+        self.during_recompute = None
+        get_json = api.handler.CurrentPlaylist.get_json
+
+        def counting_get_json(handler):
+            self.recomputes += 1
+            if self.during_recompute:
+                self.during_recompute()
+            return get_json(handler)
+
+        self.patch = fudge.patch_object(api.handler.CurrentPlaylist,
+                                        'get_json', counting_get_json)
+
+    def tearDown(self):
+        self.patch.restore()
+        super(TestCurrentPlaylistCache, self).tearDown()
+
+    def poll(self, times=100):
+        for i in range(times):
+            data = self.request('/api/current_playlist')
+        return data
+
+    def test_sequential_polls_recompute_once_per_track_change(self):
+        self.poll()
+        eq_(self.recomputes, 1)
+
+        self.play_stevie_song('Big Brother')
+        data = self.poll()
+        # The new track was written through to the cache.
+        eq_(self.recomputes, 1)
+        eq_(data['now_playing']['track'], 'Big Brother')
+        eq_(data['recently_played'][0]['track'], 'Tuesday Heartbreak')
+
+    def test_stale_data_served_during_recompute(self):
+        self.poll(1)
+        memcache.delete('api.current_track.fresh')
+        # Simulate a recompute in progress.
+        assert memcache.add('api.current_track.lease', 1)
+        data = self.poll()
+        eq_(self.recomputes, 1)
+        eq_(data['now_playing']['track'], 'Tuesday Heartbreak')
+
+        memcache.delete('api.current_track.lease')
+        self.poll()
+        eq_(self.recomputes, 2)
+
+    def test_pollers_during_recompute_share_it(self):
+        self.poll(1)
+        memcache.delete('api.current_track.fresh')
+        served = []
+
+        def other_pollers():
+            # Requests that arrive while this one holds the lease.
+            self.during_recompute = None
+            for i in range(100):
+                data = self.request('/api/current_playlist')
+                served.append(data['now_playing']['track'])
+
+        self.during_recompute = other_pollers
+        self.poll(1)
+        eq_(self.recomputes, 2)
+        eq_(set(served), set(['Tuesday Heartbreak']))
+        eq_(len(served), 100)
+        self.poll()
+        eq_(self.recomputes, 2)
+
+    def test_cold_cache_waits_for_lease_holder(self):
+        assert memcache.add('api.current_track.lease', 1)
+        cached = api.handler.CurrentPlaylist().get_json()
+        self.recomputes = 0
+
+        def sleep(secs):
+            # The lease holder finishes while we wait.
+            api.handler.CurrentPlaylist.set_cache(cached)
+
+        with fudge.patched_context(api.handler.time, 'sleep', sleep):
+            data = self.request('/api/current_playlist')
+        eq_(self.recomputes, 0)
+        eq_(data['now_playing']['track'], 'Tuesday Heartbreak')
+
+    def test_delete_evicts_track(self):
+        self.poll(1)
+        track = self.play_stevie_song('Big Brother')
+        track.delete()
+        data = self.poll()
+        # The shortened playlist is recomputed once, not served as fresh.
+        eq_(self.recomputes, 2)
+        eq_(data['now_playing']['track'], 'Tuesday Heartbreak')
+
+
+class TestPlaylistChanges(PlaylistTest):
+
+    def changes(self, **params):
+        return self.request('/api/playlist_changes?%s'
+                            % urllib.urlencode(params))
+
+    def test_added_tracks(self):
+        self.play_stevie_song('Tuesday Heartbreak')
+        self.play_stevie_song('Big Brother')
+        data = self.changes(since=0)
+        eq_([(c['action'], c['track']['track']) for c in data['changes']],
+            [('add', 'Tuesday Heartbreak'), ('add', 'Big Brother')])
+        eq_(data['more'], False)
+        assert data['version'] > 0
+
+    def test_nothing_since_version(self):
+        self.play_stevie_song('Tuesday Heartbreak')
+        version = self.changes(since=0)['version']
+        data = self.changes(since=version)
+        eq_(data['changes'], [])
+        eq_(data['version'], version)
+
+    def test_only_newer_changes(self):
+        self.play_stevie_song('Tuesday Heartbreak')
+        version = self.changes(since=0)['version']
+        track = self.play_stevie_song('Big Brother')
+        data = self.changes(since=version)
+        eq_([c['id'] for c in data['changes']], [str(track.key())])
+
+    def test_changed_and_deleted_tracks(self):
+        first = self.play_stevie_song('Tuesday Heartbreak')
+        second = self.play_stevie_song('Big Brother')
+        version = self.changes(since=0)['version']
+        first.notes = 'changed'
+        first.save()
+        second.delete()
+        data = self.changes(since=version)
+        eq_([(c['id'], c['action']) for c in data['changes']],
+            [(str(first.key()), 'change'), (str(second.key()), 'delete')])
+        eq_(data['changes'][0]['track']['notes'], 'changed')
+
+    def test_add_then_change_is_an_add(self):
+        track = self.play_stevie_song('Tuesday Heartbreak')
+        track.notes = 'changed'
+        track.save()
+        data = self.changes(since=0)
+        eq_([c['action'] for c in data['changes']], ['add'])
+
+    def test_paging(self):
+        api.handler.PlaylistChanges.max_changes = 2
+        try:
+            for song in ('Tuesday Heartbreak', 'Big Brother', 'Superstition'):
+                self.play_stevie_song(song)
+            data = self.changes(since=0)
+            eq_(len(data['changes']), 2)
+            eq_(data['more'], True)
+            data = self.changes(since=data['version'])
+            eq_([c['track']['track'] for c in data['changes']],
+                ['Superstition'])
+            eq_(data['more'], False)
+        finally:
+            api.handler.PlaylistChanges.max_changes = 50
+
+    def test_long_poll_returns_new_change(self):
+        self.play_stevie_song('Tuesday Heartbreak')
+        version = self.changes(since=0)['version']
+
+        def sleep(secs):
+            # A DJ enters a track while the client waits.
+            self.play_stevie_song('Big Brother')
+
+        with fudge.patched_context(api.handler.time, 'sleep', sleep):
+            data = self.changes(since=version, wait=10)
+        eq_([c['track']['track'] for c in data['changes']], ['Big Brother'])
+
+    def test_long_poll_is_bounded(self):
+        self.play_stevie_song('Tuesday Heartbreak')
+        version = self.changes(since=0)['version']
+        fake_sleep = fudge.Fake('sleep', callable=True)
+        with fudge.patched_context(api.handler.time, 'sleep', fake_sleep):
+            data = self.changes(since=version, wait=0.01)
+        eq_(data['changes'], [])
+
+    def test_bad_since(self):
+        self.client.get('/api/playlist_changes?since=nope', status=400)
+
+    def play_with_lagging_clock(self, song_name):
+        lagging = time.time() - 60
+        with fudge.patched_context(playlists.models.time, 'time',
+                                   lambda: lagging):
+            return self.play_stevie_song(song_name)
+
+    def test_lagging_clock_is_not_skipped(self):
+        self.play_stevie_song('Tuesday Heartbreak')
+        version = self.changes(since=0)['version']
+        # Another instance with a slow clock saves the next track.
+        track = self.play_with_lagging_clock('Big Brother')
+        data = self.changes(since=version)
+        eq_([c['id'] for c in data['changes']], [str(track.key())])
+        assert data['version'] > version
+
+    def test_versions_survive_memcache_flush(self):
+        self.play_stevie_song('Tuesday Heartbreak')
+        version = self.changes(since=0)['version']
+        assert memcache.flush_all()
+        track = self.play_with_lagging_clock('Big Brother')
+        data = self.changes(since=version)
+        eq_([c['id'] for c in data['changes']], [str(track.key())])
+
+    def test_counter_evicted_while_bumping(self):
+        incr = memcache.incr
+
+        def evicting_incr(key, delta=1, **kw):
+            if not key.startswith('playlists.changes.counter.'):
+                return incr(key, delta=delta, **kw)
+            if delta == 1:
+                return 1  # Far behind the clock.
+            return None  # Evicted before it could be bumped.
+
+        self.play_stevie_song('Tuesday Heartbreak')
+        version = self.changes(since=0)['version']
+        with fudge.patched_context(playlists.models.memcache, 'incr',
+                                   evicting_incr):
+            track = self.play_stevie_song('Big Brother')
+        data = self.changes(since=version)
+        eq_([c['id'] for c in data['changes']], [str(track.key())])
+
+    def test_expire_old_changes(self):
+        self.play_stevie_song('Tuesday Heartbreak')
+        later = (datetime.now() + PlaylistChange.RETENTION +
+                 timedelta(minutes=1))
+        expiry.run_batch('playlist_changes', now=later)
+        eq_(PlaylistChange.all().count(), 0)
+
+    def test_keep_recent_changes(self):
+        self.play_stevie_song('Tuesday Heartbreak')
+        expiry.run_batch('playlist_changes')
+        eq_(PlaylistChange.all().count(), 1)
+
+
 class TestCheckLastFMLinks(PlaylistTest):
 
     def setUp(self):
@@ -317,7 +644,7 @@ class TestCheckLastFMLinks(PlaylistTest):
         self.play_stevie_song('Tuesday Heartbreak')
         self.play_stevie_song('Big Brother')
 
-    @fudge.patch('api.handler.pylast.get_lastfm_network')
+    @fudge.patch('djdb.pylast.get_lastfm_network')
     def test_build_links(self, fm_getter):
         data = self.request('/api/current_playlist')
         (fm_getter.expects_call()
@@ -328,7 +655,6 @@ class TestCheckLastFMLinks(PlaylistTest):
                              'Talking Book')
                   .returns_fake()
                   .expects('get_cover_image')
-                  # First album images:
                   .with_args(pylast.COVER_SMALL)
                   .returns('http://last.fm/sm1.jpg')
                   .next_call()
@@ -338,15 +664,8 @@ class TestCheckLastFMLinks(PlaylistTest):
                   .with_args(pylast.COVER_LARGE)
                   .returns('http://last.fm/large1.jpg')
                   .next_call()
-                  # Second album images:
-                  .with_args(pylast.COVER_SMALL)
-                  .returns('http://last.fm/sm2.jpg')
-                  .next_call()
-                  .with_args(pylast.COVER_MEDIUM)
-                  .returns('http://last.fm/med2.jpg')
-                  .next_call()
-                  .with_args(pylast.COVER_LARGE)
-                  .returns('http://last.fm/large2.jpg'))
+                  .with_args(pylast.COVER_EXTRA_LARGE)
+                  .returns('http://last.fm/xl1.jpg'))
 
         # Simulate check_data() because taskqueue is disabled or something?
         for track in iter_tracks(data):
@@ -354,21 +673,18 @@ class TestCheckLastFMLinks(PlaylistTest):
                              {'id': track['id']})
 
         data = self.request('/api/current_playlist')
-        current = data['now_playing']
-        eq_(current['lastfm_urls'], {
-            'sm_image': 'http://last.fm/sm1.jpg',
-            'med_image': 'http://last.fm/med1.jpg',
-            'large_image': 'http://last.fm/large1.jpg',
-            '_processed': True
-        })
-        eq_(data['recently_played'][0]['lastfm_urls'], {
-            'sm_image': 'http://last.fm/sm2.jpg',
-            'med_image': 'http://last.fm/med2.jpg',
-            'large_image': 'http://last.fm/large2.jpg',
-            '_processed': True
-        })
-
-    @fudge.patch('api.handler.pylast.get_lastfm_network',
+        # Both tracks are on the same album so Last.fm was only asked once.
+        for track in (data['now_playing'], data['recently_played'][0]):
+            eq_(track['lastfm_urls'], {
+                'sm_image': 'http://last.fm/sm1.jpg',
+                'med_image': 'http://last.fm/med1.jpg',
+                'large_image': 'http://last.fm/large1.jpg',
+                '_processed': True
+            })
+        album = Album.get(self.talking_book.key())
+        eq_(album.lastfm_xl_image_url, 'http://last.fm/xl1.jpg')
+
+    @fudge.patch('djdb.pylast.get_lastfm_network',
                  'api.handler.taskqueue')
     def test_recover_from_errors(self, fm_getter, fake_tq):
         (fm_getter.expects_call()
@@ -376,7 +692,7 @@ class TestCheckLastFMLinks(PlaylistTest):
                   .returns_fake()
                   .expects('get_album')
                   .raises(pylast.WSError('', '', 'Album not found')))
-        fake_tq.expects('add').times_called(3)  # only once for all songs
+        fake_tq.expects('add').times_called(1)  # only once for all songs
 
         data = self.request('/api/current_playlist')
         self.client.post('/api/_check_lastfm_links',
@@ -391,6 +707,39 @@ class TestCheckLastFMLinks(PlaylistTest):
             '_processed': True
         })
 
+    @fudge.patch('djdb.pylast.get_lastfm_network')
+    def test_batch_of_tracks(self, fm_getter):
+        first = self.play_stevie_song('Superstition')
+        (fm_getter.expects_call()
+                  .times_called(1)
+                  .returns_fake()
+                  .expects('get_album')
+                  .times_called(1)
+                  .returns_fake()
+                  .provides('get_cover_image')
+                  .returns('http://last.fm/cover.jpg'))
+        r = self.client.post('/api/_check_lastfm_links',
+                             {'id': [str(first.key()),
+                                     str(self.playlist_track.key())]})
+        eq_(simplejson.loads(r.body), {'success': True,
+                                       'links_fetched': 2})
+        for track in PlaylistTrack.get([first.key(),
+                                        self.playlist_track.key()]):
+            eq_(track.lastfm_urls_processed, True)
+            eq_(track.lastfm_url_large_image, 'http://last.fm/cover.jpg')
+
+    @fudge.patch('api.handler.taskqueue.add')
+    def test_each_track_queued_once(self, fake_add):
+        fake_add.expects_call().times_called(1)
+        for i in range(10):
+            self.request('/api/current_playlist')
+
+    @fudge.patch('api.handler.taskqueue.add')
+    def test_duplicate_task_name_is_ignored(self, fake_add):
+        fake_add.expects_call().raises(
+                            api.handler.taskqueue.TaskAlreadyExistsError)
+        self.request('/api/current_playlist')
+
     def test_non_existant_playlist_track(self):
         key = str(self.playlist_track.key())
         self.playlist_track.delete()
@@ -449,3 +798,18 @@ class TestPlayStats(APITest):
         eq_(weekly[1]['label'], 'label1')
         eq_(weekly[1]['play_count'], 5)
         eq_(len(weekly), 2, weekly)
+
+    def test_other_windows(self):
+        PlayCountSnapshot(
+            track_id='3',
+            play_count=50,
+            artist_name='Last Month',
+            album_title='Older',
+            label='...',
+            established=datetime.now() - timedelta(days=8)
+        ).put()
+        res = self.request('/api/stats')
+        eq_([r['artist'] for r in res['this_month']['releases']],
+            ['Last Month', 'Taken By Trees', 'Tame Impala'])
+        eq_([r['artist'] for r in res['today']['releases']],
+            ['Taken By Trees', 'Tame Impala'])
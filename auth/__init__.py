@@ -18,8 +18,10 @@
 """CHIRP authentication system."""
 
 import base64
+from collections import OrderedDict
 import logging
 import os
+import threading
 import time
 
 from common import in_prod
@@ -63,11 +65,54 @@ class UserNotAllowedError(Exception):
     """Raised when the user is recognized but forbidden from entering."""
 
 
+# Verified security tokens are remembered for this long, so that each
+# request doesn't have to check the signature and decrypt the token.
+_TOKEN_CACHE_TIMEOUT_S = 60
+
+# The most tokens remembered by each instance.
+_TOKEN_CACHE_SIZE = 500
+
+
 class _Credentials(object):
     email = None
     security_token_is_stale = False
 
 
+class _TokenCache(object):
+    """LRU cache of verified tokens for this instance."""
+
+    def __init__(self, size):
+        self.size = size
+        self._lock = threading.Lock()
+        self._tokens = OrderedDict()
+
+    def get(self, token):
+        """Returns (email, timestamp, old_key) for a verified token."""
+        with self._lock:
+            entry = self._tokens.pop(token, None)
+            if entry is None:
+                return None
+            cached_at, value = entry
+            if time.time() - cached_at > _TOKEN_CACHE_TIMEOUT_S:
+                return None
+            self._tokens[token] = entry
+            return value
+
+    def set(self, token, value):
+        with self._lock:
+            self._tokens.pop(token, None)
+            self._tokens[token] = (time.time(), value)
+            while len(self._tokens) > self.size:
+                self._tokens.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._tokens.clear()
+
+
+_token_cache = _TokenCache(_TOKEN_CACHE_SIZE)
+
+
 def _create_security_token(user):
     """Create a CHIRP security token.
 
@@ -110,23 +155,24 @@ def _parse_security_token(token):
     if ':' not in token:
         logging.warn('Malformed token: no signature separator')
         return None
+    cached = _token_cache.get(token)
+    if cached is not None:
+        return _make_credentials(*cached)
     sig, body = token.split(':', 1)
+    old_key = False
     if _DISABLE_CRYPTO:
         plaintext = body
     else:
-        key_storage = KeyStorage.get()
-        hmac_key = key_storage.hmac_key
-        if type(hmac_key) == unicode:
-            # Crypto requires byte strings
-            hmac_key = hmac_key.encode('utf8')
-        computed_sig = HMAC.HMAC(key=hmac_key,
-                                 msg=body).hexdigest()
-        if sig != computed_sig:
+        aes_key, old_key = _check_signature(KeyStorage.get(), sig, body)
+        if aes_key is None:
+            # The keys might have been rotated by another instance.
+            aes_key, old_key = _check_signature(KeyStorage.get(refresh=True),
+                                                sig, body)
+        if aes_key is None:
             logging.warn('Malformed token: invalid signature')
             return None
         try:
-            plaintext = AES.new(key_storage.aes_key,
-                                AES.MODE_CBC).decrypt(body)
+            plaintext = AES.new(aes_key, AES.MODE_CBC).decrypt(body)
         except ValueError:
             logging.warn('Malformed token: wrong size')
             return None
@@ -146,6 +192,25 @@ def _parse_security_token(token):
     except ValueError:
         logging.warn('Malformed token: bad timestamp')
         return None
+    cred = _make_credentials(email, timestamp, old_key)
+    if cred is not None:
+        _token_cache.set(token, (email, timestamp, old_key))
+    return cred
+
+
+def _check_signature(key_storage, sig, body):
+    """Returns (aes_key, old_key) for the keys that signed body.
+
+    old_key is True if they are the keys from before the last rotation.
+    aes_key is None if the signature is not valid.
+    """
+    for i, (hmac_key, aes_key) in enumerate(key_storage.key_pairs()):
+        if sig == HMAC.HMAC(key=hmac_key, msg=body).hexdigest():
+            return aes_key, i > 0
+    return None, False
+
+
+def _make_credentials(email, timestamp, old_key=False):
     # Reject tokens that are too old or which have time-traveled.  We
     # allow for 1s of clock skew.
     age_s = time.time() - timestamp
@@ -154,7 +219,9 @@ def _parse_security_token(token):
         return None
     cred = _Credentials()
     cred.email = email
-    cred.security_token_is_stale = (age_s > 0.5 * _TOKEN_TIMEOUT_S)
+    # Tokens made with the old keys are replaced with new ones.
+    cred.security_token_is_stale = (age_s > 0.5 * _TOKEN_TIMEOUT_S
+                                    or old_key)
     return cred
 
 
@@ -198,7 +265,7 @@ def get_current_user(request):
     if cred is None:
         return None
     # Try to find a user for this email address.
-    user = User.get_by_email(cred.email)
+    user = User.get_cached_by_email(cred.email)
     if user is None:
         return None
     # Reject inactive users.
@@ -1,4 +1,5 @@
 import base64
+from cStringIO import StringIO
 from datetime import datetime
 import logging
 import re
@@ -9,7 +10,7 @@ from django.utils import simplejson as json
 
 from google.appengine.api import taskqueue, urlfetch
 
-from auth.models import UserSync
+from auth.models import SyncedVolunteer, UserSync
 from common import dbconfig
 from common.utilities import cronjob
 
@@ -20,6 +21,60 @@ ts = re.compile('''(?P<year>\d{4})(?P<mon>\d{2})(?P<day>\d{2})
                 re.VERBOSE)
 
 
+# Volunteers sent to each sync task.
+BATCH_SIZE = 50
+
+
+def _parse_volunteers(content):
+    """Yields ('last_updated', text) and then (section, volunteer) pairs.
+
+    The XML is parsed as a stream and each volunteer element is cleared
+    once it has been read, so the whole tree is never built.
+    """
+    section = None
+    for event, elem in ET.iterparse(StringIO(content),
+                                    events=('start', 'end')):
+        if event == 'start':
+            if elem.tag in ('current_volunteers', 'suspended_volunteers'):
+                section = elem.tag
+            continue
+        if elem.tag == 'last_updated':
+            yield 'last_updated', elem.text
+        elif elem.tag == 'volunteer' and section:
+            yield section, elem
+            elem.clear()
+        elif elem.tag == section:
+            section = None
+
+
+def _volunteer_data(vol):
+    return {'name_first': vol.find('name/first').text,
+            'name_last': vol.find('name/last').text,
+            'nick': vol.find('name/nick').text,
+            'member_id': int(vol.find('member_id').text),
+            # The email must be lower case otherwise reset-password
+            # and other features won't work.
+            'email': vol.find('email').text.lower()}
+
+
+def _changed(volunteers):
+    """Returns the (member_id, data) pairs not synced as they are now."""
+    synced = SyncedVolunteer.get_for([m for m, data in volunteers])
+    changed = []
+    for member_id, data in volunteers:
+        entity = synced.get(member_id)
+        if (entity is None or
+            entity.digest != SyncedVolunteer.digest_of(data)):
+            changed.append((member_id, data))
+    return changed
+
+
+def _queue_batches(url, name, items):
+    for i in range(0, len(items), BATCH_SIZE):
+        taskqueue.add(url=reverse(url),
+                      params={name: json.dumps(items[i:i + BATCH_SIZE])})
+
+
 @cronjob
 def sync_users(request):
     authstr = 'Basic %s' % base64.b64encode('%s:%s' %
@@ -30,12 +85,6 @@ def sync_users(request):
     if resp.status_code != 200:
         log.error(resp.content)
         raise ValueError('live site XML returned %s' % resp.status_code)
-    root = ET.fromstring(resp.content)
-
-    ts_parts = ts.match(root.find('last_updated').text)
-    ts_parts = [int(x) for x in ts_parts.groups()]
-    last_update = datetime(*ts_parts)
-    log.info('chirpradio data last updated: %s' % last_update)
 
     try:
         sync = UserSync.all()[0]
@@ -44,30 +93,39 @@ def sync_users(request):
         sync = UserSync()
         # Set to a random date in the past to force a new sync.
         last_sync = datetime(2012, 1, 1)
-    if last_sync >= last_update:
-        log.info('No need for sync')
-        return
-
-    stats = {'synced': 0, 'deactivated': 0}
-
-    for vol in root.findall('current_volunteers/volunteer'):
-        user = {'name_first': vol.find('name/first').text,
-                'name_last': vol.find('name/last').text,
-                'nick': vol.find('name/nick').text,
-                'member_id': int(vol.find('member_id').text),
-                # The email must be lower case otherwise reset-password
-                # and other features won't work.
-                'email': vol.find('email').text.lower()}
-        taskqueue.add(url=reverse('auth.tasks.sync_user'),
-                      params={'user': json.dumps(user)})
-        stats['synced'] += 1
-
-    for vol in root.findall('suspended_volunteers/volunteer'):
-        taskqueue.add(url=reverse('auth.tasks.deactivate_user'),
-                      params={'external_id': vol.find('member_id').text})
-        stats['deactivated'] += 1
+
+    current = []
+    suspended = []
+    last_update = None
+    for section, value in _parse_volunteers(resp.content):
+        if section == 'last_updated':
+            ts_parts = ts.match(value)
+            ts_parts = [int(x) for x in ts_parts.groups()]
+            last_update = datetime(*ts_parts)
+            log.info('chirpradio data last updated: %s' % last_update)
+            if last_sync >= last_update:
+                log.info('No need for sync')
+                return
+        elif section == 'current_volunteers':
+            user = _volunteer_data(value)
+            current.append((user['member_id'], user))
+        else:
+            member_id = int(value.find('member_id').text)
+            suspended.append((member_id, {'suspended': member_id}))
+    if last_update is None:
+        raise ValueError('live site XML has no last_updated')
+
+    changed = _changed(current)
+    _queue_batches('auth.tasks.sync_users', 'users',
+                   [data for member_id, data in changed])
+    deactivated = _changed(suspended)
+    _queue_batches('auth.tasks.deactivate_users', 'external_ids',
+                   [member_id for member_id, data in deactivated])
 
     sync.last_sync = last_update
+    sync.changed = len(changed) + len(deactivated)
+    sync.unchanged = len(current) + len(suspended) - sync.changed
     sync.put()
-    log.info('Sync finished. Sychronized: %(synced)s; '
-             'deactivated: %(deactivated)s' % stats)
+    log.info('Sync finished. Changed: %s (deactivated: %s); '
+             'unchanged: %s' % (sync.changed, len(deactivated),
+                                sync.unchanged))
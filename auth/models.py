@@ -21,11 +21,18 @@ import hashlib
 import logging
 import time
 
+from django.utils import simplejson as json
+from google.appengine.api import memcache
 from google.appengine.ext import db
 
 from auth import roles
 from common.autoretry import AutoRetry
 
+# Users looked up by email are cached in memcache under this prefix.
+_USER_CACHE_PREFIX = 'auth.User.email.'
+_USER_CACHE_TIMEOUT_S = 60 * 60
+
+
 class User(db.Model):
     """CHIRP radio's canonical user class.
 
@@ -43,9 +50,6 @@ class User(db.Model):
 
     dj_name = db.StringProperty(required=False)
 
-    # This is an index of searchable terms for the user. Used by autocomplete.
-    index = db.StringListProperty()
-
     # This is the SHA1 hash of the user's password.
     password = db.StringProperty()
     # We omit Django's is_staff property.
@@ -103,12 +107,67 @@ class User(db.Model):
     def get_by_email(cls, email):
         query = db.Query(cls)
         query.filter('email =', email)
-        if AutoRetry(query).count() == 0:
-            return None
-        elif AutoRetry(query).count() == 1:
-            return AutoRetry(query).get()
-        else:
+        users = AutoRetry(query).fetch(2)
+        if len(users) > 1:
             raise LookupError('User email collision for %s' % email)
+        return users and users[0] or None
+
+    @classmethod
+    def get_cached_by_email(cls, email):
+        """Like get_by_email() but the user is kept in memcache.
+
+        The cached copy is dropped whenever the user is saved or deleted
+        so only use this to read users.
+        """
+        cache_key = _USER_CACHE_PREFIX + email
+        data = memcache.get(cache_key)
+        if data is not None:
+            return db.model_from_protobuf(data)
+        user = cls.get_by_email(email)
+        if user is not None:
+            memcache.set(cache_key, db.model_to_protobuf(user).Encode(),
+                         time=_USER_CACHE_TIMEOUT_S)
+        return user
+
+    @classmethod
+    def from_entity(cls, entity):
+        user = super(User, cls).from_entity(entity)
+        # Remember the stored email, which is cached even if it changes.
+        user._stored_email = user.email
+        return user
+
+    def _cache_keys(self):
+        emails = set([self.email, getattr(self, '_stored_email', None)])
+        return [_USER_CACHE_PREFIX + e for e in emails if e]
+
+    def _uncache(self):
+        memcache.delete_multi(self._cache_keys())
+
+    @classmethod
+    def put_multi(cls, users):
+        """Saves many users in one batch, dropping their cached copies."""
+        keys = db.put(users)
+        cache_keys = []
+        for user in users:
+            cache_keys.extend(user._cache_keys())
+            user._stored_email = user.email
+        memcache.delete_multi(cache_keys)
+        _update_index(saved=users)
+        return keys
+
+    def put(self, **kwargs):
+        key = super(User, self).put(**kwargs)
+        self._uncache()
+        self._stored_email = self.email
+        _update_index(saved=[self])
+        return key
+
+    save = put
+
+    def delete(self, **kwargs):
+        super(User, self).delete(**kwargs)
+        self._uncache()
+        _update_index(deleted=[self])
 
     @property
     def effective_dj_name(self):
@@ -117,6 +176,13 @@ class User(db.Model):
         else:
             return u"%s %s" % (self.first_name, self.last_name)
 
+
+def _update_index(**kwargs):
+    # Imported here since auth.user_index needs this module.
+    from auth import user_index
+    user_index.update(**kwargs)
+
+
 # Patch the User class to provide properties for checking roles.
 # These are useful in templates.
 for role in roles.ALL_ROLES:
@@ -131,6 +197,43 @@ for role in roles.ALL_ROLES:
 class UserSync(db.Model):
     """A log to track when users were synced with the live site."""
     last_sync = db.DateTimeProperty()
+    # Volunteers sent to be synced or left alone by the last sync.
+    changed = db.IntegerProperty(default=0)
+    unchanged = db.IntegerProperty(default=0)
+
+
+class SyncedVolunteer(db.Model):
+    """What was last synced for one volunteer from the live site.
+
+    The key name comes from key_name_for(member_id).  A volunteer whose
+    data still has the same digest is skipped by the next sync; delete
+    these entities to force a full sync.
+    """
+    digest = db.StringProperty(indexed=False)
+    user = db.ReferenceProperty(User, indexed=False)
+
+    @staticmethod
+    def key_name_for(member_id):
+        # Key names may not start with a digit.
+        return 'member:%s' % member_id
+
+    @staticmethod
+    def digest_of(data):
+        return hashlib.sha1(json.dumps(data, sort_keys=True)).hexdigest()
+
+    @classmethod
+    def get_for(cls, member_ids):
+        """Returns a dict of member_id to SyncedVolunteer, if there is one.
+        """
+        synced = {}
+        for i in range(0, len(member_ids), 500):
+            chunk = member_ids[i:i + 500]
+            entities = cls.get_by_key_name([cls.key_name_for(m)
+                                            for m in chunk])
+            for member_id, entity in zip(chunk, entities):
+                if entity is not None:
+                    synced[member_id] = entity
+        return synced
 
 
 #############################################################################
@@ -146,6 +249,8 @@ _KEY_STORAGE_DATASTORE_KEY = 'KeyStorage'
 
 _KEY_STORAGE_TIMEOUT_S = 5 * 60  # Re-load after 5 minutes.
 
+_KEY_STORAGE_MIN_AGE_S = 30  # Re-load at most this often when asked.
+
 
 class KeyStorage(db.Model):
     """Models a single entity that contains crypto keys."""
@@ -155,14 +260,27 @@ class KeyStorage(db.Model):
     # Used to encrypt security tokens.
     aes_key = db.StringProperty(required=True)
 
+    # The keys replaced by the last rotate().  Tokens made with them are
+    # still accepted, and are then replaced.
+    previous_hmac_key = db.StringProperty()
+    previous_aes_key = db.StringProperty()
+
     @classmethod
-    def get(cls):
-        """Returns the one true KeyStorage object."""
+    def get(cls, refresh=False):
+        """Returns the one true KeyStorage object.
+
+        Pass refresh=True to reload it now, for when the keys may have
+        been rotated by another instance.  This is limited to once per
+        _KEY_STORAGE_MIN_AGE_S.
+        """
         # We cache a copy of our KeyStorage singleton to avoid having
         # to do a datastore lookup at the beginning of every single
         # operation.
         ks, timestamp = getattr(cls, '_cached', (None, None))
-        if ks is None or time.time() - timestamp > _KEY_STORAGE_TIMEOUT_S:
+        if ks is not None and refresh:
+            refresh = time.time() - timestamp > _KEY_STORAGE_MIN_AGE_S
+        if (ks is None or refresh
+            or time.time() - timestamp > _KEY_STORAGE_TIMEOUT_S):
             ks = AutoRetry(cls).get_by_key_name(_KEY_STORAGE_DATASTORE_KEY)
             if ks is None:
                 ks = cls(key_name=_KEY_STORAGE_DATASTORE_KEY,
@@ -173,5 +291,28 @@ class KeyStorage(db.Model):
             cls._cached = (ks, time.time())
         return ks
 
+    @classmethod
+    def rotate(cls, hmac_key, aes_key):
+        """Replaces the keys, keeping the current ones as the previous."""
+        ks = cls.get(refresh=True)
+        ks.previous_hmac_key = ks.hmac_key
+        ks.previous_aes_key = ks.aes_key
+        ks.hmac_key = hmac_key
+        ks.aes_key = aes_key
+        AutoRetry(ks).save()
+        cls._cached = (ks, time.time())
+        return ks
+
+    def key_pairs(self):
+        """Returns (hmac_key, aes_key) pairs, the current ones first.
+
+        The HMAC keys are byte strings, as PyCrypto requires.
+        """
+        pairs = [(self.hmac_key, self.aes_key)]
+        if self.previous_hmac_key and self.previous_aes_key:
+            pairs.append((self.previous_hmac_key, self.previous_aes_key))
+        return [(type(h) == unicode and h.encode('utf8') or h, a)
+                for h, a in pairs]
+
 
 
@@ -2,58 +2,158 @@ import logging
 
 from django import http
 from django.utils import simplejson as json
+from google.appengine.ext import db
 
 from auth import roles
-from auth.models import User
-from auth.views import _reindex
+from auth.models import SyncedVolunteer, User
 
 log = logging.getLogger()
 
 
+def _find_users(users, synced):
+    """Returns a dict of member_id to the User each volunteer was synced to.
+
+    Volunteers synced before are found by key in one batch, the rest by
+    external_id a few at a time.
+    """
+    found = {}
+    keys = dict((member_id, SyncedVolunteer.user.get_value_for_datastore(s))
+                for member_id, s in synced.items())
+    keys = dict((m, k) for m, k in keys.items() if k is not None)
+    if keys:
+        member_ids = keys.keys()
+        for member_id, dj_user in zip(member_ids,
+                                      db.get([keys[m] for m in member_ids])):
+            if dj_user is not None:
+                found[member_id] = dj_user
+    unknown = [u['member_id'] for u in users if u['member_id'] not in found]
+    # IN queries are limited to 30 values.
+    for i in range(0, len(unknown), 30):
+        qs = User.all().filter('external_id IN', unknown[i:i + 30])
+        for dj_user in qs:
+            found.setdefault(dj_user.external_id, dj_user)
+    return found
+
+
+def _find_user_by_email(user):
+    # No previously sync'd user exists.
+    # Let's check by email to see if an old
+    # user exists with the same email.
+    qs = User.all().filter('email =', user['email'])
+    users = qs.fetch(2)
+    if len(users) == 2:
+        raise LookupError('More than one user for %s; '
+                          'aborting sync' % user['email'])
+    if len(users):
+        log.info('Linking user %s to ID %s' %
+                 (user['email'], user['member_id']))
+        return users[0]
+    return None
+
+
+def _record_synced(pairs):
+    """Saves the digest of what was synced to each user."""
+    db.put([SyncedVolunteer(key_name=SyncedVolunteer.key_name_for(member_id),
+                            digest=SyncedVolunteer.digest_of(data),
+                            user=dj_user)
+            for member_id, data, dj_user in pairs])
+
+
+def _sync_users(users):
+    """Creates or updates the User of each volunteer.
+
+    Returns the errors for volunteers that could not be synced.  Those
+    are not recorded as synced so they are tried again next time.
+    """
+    member_ids = [u['member_id'] for u in users]
+    found = _find_users(users, SyncedVolunteer.get_for(member_ids))
+    errors = []
+    synced = []
+    for user in users:
+        dj_user = found.get(user['member_id'])
+        if dj_user is None:
+            try:
+                dj_user = _find_user_by_email(user)
+            except LookupError, exc:
+                log.error(str(exc))
+                errors.append(exc)
+                continue
+
+        fields = {
+            'first_name': user['name_first'],
+            'last_name': user['name_last'],
+            'email': user['email'],
+            'dj_name': user['nick'],
+            'external_id': user['member_id'],
+            'is_active': True,
+        }
+        if not dj_user:
+            fields['roles'] = [roles.DJ]
+            dj_user = User(**fields)
+        else:
+            for k, v in fields.items():
+                setattr(dj_user, k, v)
+            if roles.DJ not in dj_user.roles:
+                dj_user.roles.append(roles.DJ)
+        synced.append((user['member_id'], user, dj_user))
+
+    User.put_multi([dj_user for member_id, data, dj_user in synced])
+    _record_synced(synced)
+    return errors
+
+
+def _deactivate_users(member_ids):
+    member_ids = [int(m) for m in member_ids]
+    found = _find_users([{'member_id': m} for m in member_ids],
+                        SyncedVolunteer.get_for(member_ids))
+    deactivated = []
+    for member_id in member_ids:
+        if member_id not in found:
+            log.info('no user exists with external_id %s' % member_id)
+            # This is okay. We'll deactivate them next time.
+            continue
+        dj_user = found[member_id]
+        dj_user.is_active = False
+        deactivated.append((member_id, {'suspended': member_id}, dj_user))
+        log.info('Deactivated user %s %s' % (dj_user, dj_user.email))
+
+    User.put_multi([dj_user for member_id, data, dj_user in deactivated])
+    _record_synced(deactivated)
+    return len(deactivated)
+
+
+def sync_users(request):
+    """Syncs a batch of volunteers queued by auth.cron.sync_users."""
+    users = request.POST.get('users')
+    if not users:
+        return http.HttpResponseBadRequest()
+    # Errors are logged; raising would retry the whole batch.
+    _sync_users(json.loads(users))
+    return http.HttpResponse('OK')
+
+
+def deactivate_users(request):
+    """Deactivates a batch of volunteers queued by auth.cron.sync_users."""
+    member_ids = request.POST.get('external_ids')
+    if not member_ids:
+        log.info('external_ids not found in POST')
+        return http.HttpResponseBadRequest()
+    if not _deactivate_users(json.loads(member_ids)):
+        # Return a 200 here otherwise the task will be retried.
+        return http.HttpResponse('No one deactivated')
+    return http.HttpResponse('OK')
+
+
+# The single volunteer tasks below were queued by older versions of
+# auth.cron.sync_users.
+
 def sync_user(request):
     user = request.POST.get('user')
     if not user:
         return http.HttpResponseBadRequest()
-    user = json.loads(user)
-
-    qs = User.all().filter('external_id =', user['member_id'])
-    users = qs.fetch(1)
-    dj_user = None
-    if len(users):
-        dj_user = users[0]
-    else:
-        # No previously sync'd user exists.
-        # Let's check by email to see if an old
-        # user exists with the same email.
-        qs = User.all().filter('email =', user['email'])
-        if qs.count(2) == 2:
-            raise LookupError('More than one user for %s; '
-                              'aborting sync' % user['email'])
-        users = qs.fetch(1)
-        if len(users):
-            log.info('Linking user %s to ID %s' %
-                     (user['email'], user['member_id']))
-            dj_user = users[0]
-
-    fields = {
-        'first_name': user['name_first'],
-        'last_name': user['name_last'],
-        'email': user['email'],
-        'dj_name': user['nick'],
-        'external_id': user['member_id'],
-        'is_active': True,
-    }
-    if not dj_user:
-        fields['roles'] = [roles.DJ]
-        dj_user = User(**fields)
-    else:
-        for k, v in fields.items():
-            setattr(dj_user, k, v)
-        if roles.DJ not in dj_user.roles:
-            dj_user.roles.append(roles.DJ)
-    _reindex(dj_user)
-    dj_user.put()
-
+    errors = _sync_users([json.loads(user)])
+    if errors:
+        raise errors[0]
     return http.HttpResponse('OK')
 
 
@@ -62,17 +162,7 @@ def deactivate_user(request):
     if not id:
         log.info('external_id not found in POST')
         return http.HttpResponseBadRequest()
-    qs = User.all().filter('external_id =', int(id))
-    users = qs.fetch(1)
-    if not len(users):
-        log.info('no user exists with external_id %s' % id)
-        # This is okay. We'll deactivate them next time.
+    if not _deactivate_users([id]):
         # Return a 200 here otherwise the task will be retried.
         return http.HttpResponse('No one deactivated')
-
-    dj_user = users[0]
-    dj_user.is_active = False
-    dj_user.put()
-    log.info('Deactivated user %s %s' % (dj_user, dj_user.email))
-
     return http.HttpResponse('OK')
@@ -9,7 +9,7 @@ import fudge
 from fudge.inspector import arg
 from nose.tools import eq_
 
-from auth.models import UserSync
+from auth.models import SyncedVolunteer, UserSync
 from common import dbconfig
 
 
@@ -55,6 +55,8 @@ class TestSyncUsers(TestCase):
     def tearDown(self):
         for ob in UserSync.all():
             ob.delete()
+        for ob in SyncedVolunteer.all():
+            ob.delete()
 
     @fudge.patch('auth.cron.urlfetch.fetch')
     @fudge.patch('auth.cron.taskqueue')
@@ -64,7 +66,9 @@ class TestSyncUsers(TestCase):
                                        content=XML))
 
         def user_data(data):
-            user = json.loads(data['user'])
+            users = json.loads(data['users'])
+            eq_(len(users), 1)
+            user = users[0]
             eq_(user['name_first'], 'Ivan')
             eq_(user['name_last'], u'Krsti\u0107')
             eq_(user['member_id'], 1)
@@ -74,15 +78,18 @@ class TestSyncUsers(TestCase):
 
         (tq.expects('add')
            .with_args(
-               url=reverse('auth.tasks.sync_user'),
+               url=reverse('auth.tasks.sync_users'),
                params=arg.passes_test(user_data),
            ))
 
         res = self.client.post(self.url,
                                HTTP_X_APPENGINE_CRON='true')
         eq_(res.status_code, 200)
-        eq_(UserSync.all()[0].last_sync.timetuple()[0:3],
+        sync = UserSync.all()[0]
+        eq_(sync.last_sync.timetuple()[0:3],
             date(2012, 12, 2).timetuple()[0:3])
+        eq_(sync.changed, 1)
+        eq_(sync.unchanged, 0)
 
     @fudge.patch('auth.cron.urlfetch.fetch')
     @fudge.patch('auth.cron.taskqueue')
@@ -120,8 +127,103 @@ class TestSyncUsers(TestCase):
                                        content=suspended))
         (tq.expects('add')
            .with_args(
-               url=reverse('auth.tasks.deactivate_user'),
-               params={'external_id': '1'},
+               url=reverse('auth.tasks.deactivate_users'),
+               params={'external_ids': '[1]'},
            ))
 
         self.client.post(self.url, HTTP_X_APPENGINE_CRON='true')
+
+
+def volunteer(member_id):
+    return {'name_first': 'First%s' % member_id,
+            'name_last': 'Last%s' % member_id,
+            'nick': None,
+            'member_id': member_id,
+            'email': 'dj%s@chirpradio.org' % member_id}
+
+
+def volunteers_xml(current, suspended=()):
+    def vol_xml(vol):
+        return dedent("""\
+            <volunteer>
+              <name>
+                <first>%(name_first)s</first>
+                <last>%(name_last)s</last>
+                <nick></nick>
+              </name>
+              <member_id>%(member_id)s</member_id>
+              <email>%(email)s</email>
+            </volunteer>
+            """) % vol
+    return ('<volunteers><last_updated>20121202005516</last_updated>'
+            '<current_volunteers>%s</current_volunteers>'
+            '<suspended_volunteers>%s</suspended_volunteers>'
+            '</volunteers>' % (''.join(vol_xml(v) for v in current),
+                               ''.join(vol_xml(v) for v in suspended)))
+
+
+class TestIncrementalSync(TestCase):
+
+    def setUp(self):
+        dbconfig['chirpradio.member_api.url'] = 'http://waaatjusttesting.com/api'
+        dbconfig['chirpradio.member_api.user'] = 'example_user'
+        dbconfig['chirpradio.member_api.password'] = 'example_pw'
+        self.url = reverse('auth.cron.sync_users')
+
+    def tearDown(self):
+        for ob in UserSync.all():
+            ob.delete()
+        for ob in SyncedVolunteer.all():
+            ob.delete()
+
+    def mark_synced(self, member_id, data):
+        SyncedVolunteer(key_name=SyncedVolunteer.key_name_for(member_id),
+                        digest=SyncedVolunteer.digest_of(data)).put()
+
+    @fudge.patch('auth.cron.urlfetch.fetch')
+    @fudge.patch('auth.cron.taskqueue')
+    def test_only_changed_are_queued(self, fetch, tq):
+        current = [volunteer(i) for i in range(1, 4)]
+        (fetch.expects_call().returns_fake()
+                             .has_attr(status_code=200,
+                                       content=volunteers_xml(current,
+                                                              [volunteer(9)])))
+        self.mark_synced(1, current[0])
+        changed = dict(current[1], email='old@chirpradio.org')
+        self.mark_synced(2, changed)
+        self.mark_synced(9, {'suspended': 9})
+
+        def changed_users(data):
+            eq_([u['member_id'] for u in json.loads(data['users'])], [2, 3])
+            return True
+
+        (tq.expects('add')
+           .with_args(url=reverse('auth.tasks.sync_users'),
+                      params=arg.passes_test(changed_users)))
+
+        self.client.post(self.url, HTTP_X_APPENGINE_CRON='true')
+        sync = UserSync.all()[0]
+        eq_(sync.changed, 2)
+        eq_(sync.unchanged, 2)
+
+    @fudge.patch('auth.cron.urlfetch.fetch')
+    @fudge.patch('auth.cron.taskqueue')
+    def test_batches(self, fetch, tq):
+        current = [volunteer(i) for i in range(1, 61)]
+        (fetch.expects_call().returns_fake()
+                             .has_attr(status_code=200,
+                                       content=volunteers_xml(current)))
+        synced = set()
+
+        def batch(data):
+            users = json.loads(data['users'])
+            synced.update(u['member_id'] for u in users)
+            return len(users) in (50, 10)
+
+        (tq.expects('add')
+           .with_args(url=reverse('auth.tasks.sync_users'),
+                      params=arg.passes_test(batch))
+           .times_called(2))
+
+        self.client.post(self.url, HTTP_X_APPENGINE_CRON='true')
+        eq_(synced, set(range(1, 61)))
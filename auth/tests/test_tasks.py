@@ -1,11 +1,12 @@
 from django.core.urlresolvers import reverse
 from django.test import TestCase
 from django.utils import simplejson as json
+from google.appengine.api import memcache
 
 from nose.tools import eq_, raises
 
-from auth import roles
-from auth.models import User
+from auth import roles, user_index
+from auth.models import SyncedVolunteer, User
 
 
 class TestSyncUser(TestCase):
@@ -16,6 +17,7 @@ class TestSyncUser(TestCase):
             'email': 'person@chirpradio.org'}
 
     def setUp(self):
+        assert memcache.flush_all()
         self.url = reverse('auth.tasks.sync_user')
 
     def tearDown(self):
@@ -38,7 +40,7 @@ class TestSyncUser(TestCase):
         eq_(us.is_superuser, False)
         eq_(us.is_active, True)
         eq_(us.roles, [roles.DJ])
-        assert us.index, 'User was not indexed'
+        eq_([u[0] for u in user_index.search('Ivan')], [str(us.key())])
 
     def test_sync_existing_with_id(self):
         us = User(email=self.user['email'],
@@ -54,7 +56,7 @@ class TestSyncUser(TestCase):
         eq_(us.is_superuser, False)
         eq_(us.is_active, True)
         eq_(us.roles, [roles.DJ])
-        assert us.index, 'User was not indexed'
+        eq_([u[0] for u in user_index.search('Ivan')], [str(us.key())])
 
     def test_sync_existing_without_id(self):
         us = User(email=self.user['email'])
@@ -137,3 +139,63 @@ class TestDeactivateUser(TestCase):
     def test_deactivate_non_existant(self):
         resp = self.client.post(self.url, {'external_id': 23})
         eq_(resp.status_code, 200)
+
+
+class TestSyncUsers(TestCase):
+    users = [{'name_first': 'Ivan',
+              'name_last': 'Krstic',
+              'nick': None,
+              'member_id': 1,
+              'email': 'person@chirpradio.org'},
+             {'name_first': 'Other',
+              'name_last': 'Person',
+              'nick': 'DJ Other',
+              'member_id': 2,
+              'email': 'other@chirpradio.org'}]
+
+    def setUp(self):
+        self.url = reverse('auth.tasks.sync_users')
+
+    def tearDown(self):
+        for ob in User.all():
+            ob.delete()
+        for ob in SyncedVolunteer.all():
+            ob.delete()
+
+    def sync(self, users):
+        resp = self.client.post(self.url, {'users': json.dumps(users)})
+        eq_(resp.status_code, 200)
+
+    def test_sync(self):
+        existing = User(email='other@chirpradio.org')
+        existing.put()
+        self.sync(self.users)
+        eq_(User.all().count(), 2)
+        synced = SyncedVolunteer.get_for([1, 2])
+        eq_(synced[1].digest, SyncedVolunteer.digest_of(self.users[0]))
+        eq_(synced[2].user.key(), existing.key())
+        eq_(User.get(existing.key()).external_id, 2)
+
+    def test_resync_by_key(self):
+        self.sync(self.users)
+        changed = dict(self.users[0], email='new@chirpradio.org')
+        self.sync([changed])
+        eq_(User.all().count(), 2)
+        eq_(User.all().filter('external_id =', 1)[0].email,
+            'new@chirpradio.org')
+
+    def test_collision_skips_volunteer(self):
+        User(email=self.users[0]['email']).put()
+        User(email=self.users[0]['email']).put()
+        self.sync(self.users)
+        eq_(sorted(SyncedVolunteer.get_for([1, 2]).keys()), [2])
+
+    def test_deactivate(self):
+        self.sync(self.users)
+        resp = self.client.post(reverse('auth.tasks.deactivate_users'),
+                                {'external_ids': json.dumps([1, 3])})
+        eq_(resp.status_code, 200)
+        eq_(User.all().filter('external_id =', 1)[0].is_active, False)
+        eq_(User.all().filter('external_id =', 2)[0].is_active, True)
+        eq_(SyncedVolunteer.get_for([1])[1].digest,
+            SyncedVolunteer.digest_of({'suspended': 1}))
@@ -0,0 +1,71 @@
+###
+### Copyright 2009 The Chicago Independent Radio Project
+### All Rights Reserved.
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###     http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+###
+import unittest
+
+from google.appengine.api import memcache
+
+from auth import user_index
+from auth.models import User
+
+
+class TestUserIndex(unittest.TestCase):
+
+    def setUp(self):
+        assert memcache.flush_all()
+        self.users = [User(email='a@chirpradio.org', first_name='Anna',
+                           last_name='Kowalski', dj_name='DJ Kat'),
+                      User(email='b@chirpradio.org', first_name='Anne',
+                           last_name='Smith'),
+                      User(email='c@chirpradio.org', first_name='Carl',
+                           last_name='Kowalski', is_active=False)]
+        User.put_multi(self.users)
+
+    def tearDown(self):
+        for user in User.all():
+            user.delete()
+        assert memcache.flush_all()
+
+    def names(self, query):
+        return [name for key, name, dj_name in user_index.search(query)]
+
+    def test_prefix(self):
+        self.assertEqual(self.names('ann'), ['Anna Kowalski', 'Anne Smith'])
+        self.assertEqual(self.names('kat'), ['Anna Kowalski'])
+        self.assertEqual(self.names('carl'), [])
+        self.assertEqual(self.names(''), [])
+
+    def test_intersection(self):
+        self.assertEqual(self.names('ann kow'), ['Anna Kowalski'])
+        self.assertEqual(self.names('anne kow'), [])
+
+    def test_incremental_update(self):
+        self.assertEqual(self.names('smith'), ['Anne Smith'])
+        version = user_index.get_index()['version']
+        anne = self.users[1]
+        anne.last_name = 'Jones'
+        anne.put()
+        self.assertEqual(self.names('smith'), [])
+        self.assertEqual(self.names('jones'), ['Anne Jones'])
+        assert user_index.get_index()['version'] > version
+        anne.delete()
+        self.assertEqual(self.names('anne'), [])
+
+    def test_rebuild(self):
+        self.assertEqual(self.names('anna'), ['Anna Kowalski'])
+        # Lost from memcache; the next search rebuilds it.
+        assert memcache.flush_all()
+        self.assertEqual(self.names('anna'), ['Anna Kowalski'])
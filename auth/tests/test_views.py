@@ -16,22 +16,26 @@
 ### limitations under the License.
 ###
 
+from __future__ import with_statement
 import base64
 import os
 import time
 import unittest
 
 from django import http
+from django.conf import settings
 from django.test.client import Client
+from google.appengine.api import memcache
 from google.appengine.api import users as google_users
 from django.test import TestCase as DjangoTestCase
+import fudge
 
+from common import profiler
 from common.testutil import FormTestCaseHelper
 import auth
 from auth import forms as auth_forms
 from auth import roles
 from auth.models import User, KeyStorage
-from auth.views import _reindex
 
 
 # These are needed by the App Engine local user service stub.
@@ -267,6 +271,68 @@ class AuthTestCase(DjangoTestCase):
         self.assertEqual(403, response.status_code)
         self.assertEqual('User %s already exists' % g_email, response.content)
 
+    def test_get_current_user_rpcs(self):
+        user = User(email='rpc_test@test.com')
+        user.save()
+        request = http.HttpRequest()
+        request.COOKIES[auth._CHIRP_SECURITY_TOKEN_COOKIE] = (
+            auth._create_security_token(user))
+        auth._token_cache.clear()
+        profiler.install()
+
+        def get_rpcs():
+            with fudge.patched_context(settings, 'PROFILER_SAMPLE_RATE', 1):
+                profiler.start('/')
+                profile = profiler.current_profile()
+                try:
+                    self.assertEqual(auth.get_current_user(request).email,
+                                     'rpc_test@test.com')
+                finally:
+                    profiler.finish()
+            return sorted(call for call, site in profile.sites
+                          for i in range(profile.sites[(call, site)][0]))
+
+        # This used to take two counts and a get of the user every time.
+        self.assertEqual(get_rpcs(), ['datastore_v3.RunQuery(User)',
+                                      'memcache.Get', 'memcache.Set'])
+        self.assertEqual(get_rpcs(), ['memcache.Get'])
+        # Saving the user drops the cached copy.
+        user.first_name = 'Changed'
+        user.save()
+        self.assertEqual(auth.get_current_user(request).first_name,
+                         'Changed')
+
+    def test_user_cache_follows_email_changes(self):
+        user = User(email='before@test.com')
+        user.save()
+        user = User.get_cached_by_email('before@test.com')
+        user.email = 'after@test.com'
+        user.save()
+        self.assertEqual(User.get_cached_by_email('before@test.com'), None)
+        self.assertEqual(User.get_cached_by_email('after@test.com').email,
+                         'after@test.com')
+        user.delete()
+        self.assertEqual(User.get_cached_by_email('after@test.com'), None)
+
+    def test_key_rotation(self):
+        KeyStorage._cached = (None, None)
+        user = User(email='rotation_test@test.com')
+        old_token = auth._create_security_token(user)
+        old_keys = KeyStorage.get().key_pairs()[0]
+        try:
+            KeyStorage.rotate('rotatedkey', 'rotatedkey9012345678901234567890')
+            auth._token_cache.clear()
+            # Old tokens still work but are replaced.
+            cred = auth._parse_security_token(old_token)
+            self.assertEqual(cred.email, 'rotation_test@test.com')
+            self.assertTrue(cred.security_token_is_stale)
+            cred = auth._parse_security_token(
+                                    auth._create_security_token(user))
+            self.assertFalse(cred.security_token_is_stale)
+        finally:
+            KeyStorage.rotate(*old_keys)
+            auth._token_cache.clear()
+
     def test_url_generation(self):
         # This is just a smoke test.
         auth.create_login_url("not actually a path")
@@ -548,6 +614,7 @@ class UserViewsTestCase(FormTestCaseHelper, DjangoTestCase):
 class AutocompleteViewsTestCase(DjangoTestCase):
 
     def setUp(self):
+        assert memcache.flush_all()
 #        assert self.client.login(email="test@test.com")
         self.activeUser = User(
             email='foo@bar.com',
@@ -556,7 +623,6 @@ class AutocompleteViewsTestCase(DjangoTestCase):
             is_active=True,
             password='123456'
         )
-        _reindex(self.activeUser)
         self.activeUser.save()
         self.inactiveUser = User(
             email='blah@blah.com',
@@ -565,7 +631,6 @@ class AutocompleteViewsTestCase(DjangoTestCase):
             is_active=False,
             password='123456'
         )
-        _reindex(self.inactiveUser)
         self.inactiveUser.save()
 
     def test_active_user(self):
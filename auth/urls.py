@@ -51,6 +51,10 @@ urlpatterns = patterns(
     url(r'^cron/sync_users$', 'auth.cron.sync_users',
         name='auth.cron.sync_users'),
 
+    url(r'^task/sync_users$', 'auth.tasks.sync_users',
+        name='auth.tasks.sync_users'),
+    url(r'^task/deactivate_users$', 'auth.tasks.deactivate_users',
+        name='auth.tasks.deactivate_users'),
     url(r'^task/sync_user$', 'auth.tasks.sync_user',
         name='auth.tasks.sync_user'),
     url(r'^task/deactivate_user$', 'auth.tasks.deactivate_user',
@@ -0,0 +1,153 @@
+###
+### Copyright 2009 The Chicago Independent Radio Project
+### All Rights Reserved.
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###     http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+###
+
+"""A prefix index of active users for the autocomplete widget.
+
+The index is a sorted list of (term, user key) pairs, one for each word
+of a user's name and DJ name, plus the text to show for each user.  A
+prefix is looked up by bisecting the list.  The index is kept in
+memcache and each instance keeps its own copy until the version in
+memcache moves on.
+
+Saving users updates the index in place; see auth.models.User.put.  If
+the index falls out of memcache it is rebuilt from the datastore by the
+next search.
+"""
+
+import bisect
+import logging
+
+from google.appengine.api import memcache
+
+from djdb import search as djdb_search
+
+log = logging.getLogger()
+
+INDEX_KEY = 'auth.user_index'
+VERSION_KEY = 'auth.user_index.version'
+
+# This instance's copy of the index.
+_local_index = None
+
+
+def _terms(user):
+    terms = set(djdb_search.scrub(unicode(user)).split())
+    if user.dj_name is not None:
+        terms.update(djdb_search.scrub(user.dj_name).split())
+    return terms
+
+
+def _add(index, users):
+    for user in users:
+        if not user.is_active:
+            continue
+        key = str(user.key())
+        index['users'][key] = (unicode(user), user.dj_name)
+        index['terms'].extend((term, key) for term in _terms(user))
+
+
+def _next_version():
+    return memcache.incr(VERSION_KEY, initial_value=0)
+
+
+def rebuild(users=None):
+    """Builds the index from all active users and stores it in memcache.
+
+    Pass the users when they are already loaded.
+    """
+    # Imported here since auth.models updates the index.
+    from auth.models import User
+    if users is None:
+        users = User.all().filter('is_active =', True)
+    index = {'version': _next_version(), 'users': {}, 'terms': []}
+    _add(index, users)
+    index['terms'].sort()
+    memcache.set(INDEX_KEY, index)
+    return index
+
+
+def update(saved=(), deleted=()):
+    """Updates the index after the given users were saved or deleted."""
+    version = _next_version()
+    client = memcache.Client()
+    for attempt in range(3):
+        index = client.gets(INDEX_KEY)
+        if index is None:
+            # The next search rebuilds it.
+            return
+        keys = set(str(user.key()) for user in list(saved) + list(deleted))
+        for key in keys:
+            index['users'].pop(key, None)
+        index['terms'] = [t for t in index['terms'] if t[1] not in keys]
+        _add(index, saved)
+        index['terms'].sort()
+        index['version'] = max(version, index['version'])
+        if client.cas(INDEX_KEY, index):
+            return
+    log.warning('Could not update the user index; dropping it')
+    memcache.delete(INDEX_KEY)
+
+
+def clear():
+    global _local_index
+    _local_index = None
+    memcache.delete(INDEX_KEY)
+
+
+def get_index():
+    """Returns the current index, from this instance if it is up to date.
+    """
+    global _local_index
+    version = memcache.get(VERSION_KEY)
+    if (_local_index is not None and version is not None and
+        _local_index['version'] == version):
+        return _local_index
+    index = memcache.get(INDEX_KEY)
+    if index is None:
+        index = rebuild()
+    _local_index = index
+    return index
+
+
+def _prefix_matches(terms, prefix):
+    keys = set()
+    i = bisect.bisect_left(terms, (prefix,))
+    while i < len(terms) and terms[i][0].startswith(prefix):
+        keys.add(terms[i][1])
+        i += 1
+    return keys
+
+
+def search(query):
+    """Returns (key, name, dj_name) for the active users matching query.
+
+    Every word in the query must be the start of a word in the user's
+    name or DJ name.
+    """
+    terms = djdb_search.scrub(query).split()
+    if not terms:
+        return []
+    index = get_index()
+    keys = None
+    for term in terms:
+        matches = _prefix_matches(index['terms'], term)
+        keys = matches if keys is None else keys & matches
+        if not keys:
+            return []
+    users = index['users']
+    return sorted(((key,) + users[key] for key in keys),
+                  key=lambda u: u[1].lower())
@@ -19,7 +19,7 @@ import os
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
-from auth import models, views
+from auth import models
 
 #    email:4,first_name:2,last_name:3,password,is_active:7,is_superuser:8
 #    last_login:9,date_joined:10,roles
@@ -42,7 +42,6 @@ class UserLoader(bulkloader.Loader):
         if q.fetch(1):
             return None
         else:
-            views._reindex(entity)
             print "adding: " + entity.email
             return entity
 
@@ -32,9 +32,9 @@ import auth
 from auth import roles
 from auth.decorators import require_role, require_signed_in_user
 from auth import forms as auth_forms
+from auth import user_index
 from auth.models import User
 from common import email
-from djdb import search
 from common.autoretry import AutoRetry
 
 # Require this role in order to access any management tasks.
@@ -249,17 +249,6 @@ def main_page(request):
             })
     return http.HttpResponse(tmpl.render(ctx))
 
-def _reindex(user):
-    index = []
-    for term in search.scrub(unicode(user)).split():
-        for i in range(len(term) + 1) :
-            index.append(term[0:i])
-    if user.dj_name is not None:
-        for term in search.scrub(user.dj_name).split():
-            for i in range(len(term) + 1):
-                index.append(term[0:i])
-    user.index = index
-
 @require_role(USER_MANAGEMENT_ROLE)
 def edit_user(request):
     tmpl = loader.get_template('auth/user_form.html')
@@ -273,7 +262,6 @@ def edit_user(request):
         user_form = auth_forms.UserForm(request.POST)
         if user_form.is_valid():
             user_to_edit = user_form.to_user()
-            _reindex(user_to_edit)
             AutoRetry(user_to_edit).save()
             # When finished, redirect user back to the user list.
             return http.HttpResponseRedirect('/auth/')
@@ -298,10 +286,6 @@ def add_user(request):
             ctx_vars['form'] = form
         if form.is_valid():
             user = form.to_user()
-            
-            # Set name index for autocomplete searching.
-            _reindex(user)
-            
             user.save()
             
             # Send out the welcome email:
@@ -319,9 +303,12 @@ def add_user(request):
     return http.HttpResponse(tmpl.render(ctx))
 
 def index_users(request):
-    for user in User.all() :
-        _reindex(user)
-        user.save()
+    # Re-saving drops the prefix lists older versions stored on users.
+    user_index.clear()
+    users = list(User.all())
+    for i in range(0, len(users), 100):
+        User.put_multi(users[i:i + 100])
+    user_index.rebuild([u for u in users if u.is_active])
 
     tmpl = loader.get_template('auth/main_page.html')
     all_users = list(User.all().order('last_name').order('first_name'))
@@ -337,21 +324,11 @@ def index_users(request):
     return http.HttpResponse(tmpl.render(ctx))
 
 def user_search_for_autocomplete(request):
-    match_users = []
     response = http.HttpResponse(mimetype="text/plain")
-    terms = [term for term in search.scrub(request.GET.get('q', '')).split()]
-    for term in terms:
-        query = User.all()
-        query.filter("is_active =", True).filter("index =", term)
-        users = AutoRetry(query).fetch(999)
-        if (len(users) > 0):
-            for user in users:
-                match_users.append(user)
-            break
-    for user in match_users :
-        response.write("%s|%s\n" % (user, user.key()))
-        if user.dj_name is not None:
-            response.write("%s|%s\n" % (user.dj_name, user.key()))
+    for key, name, dj_name in user_index.search(request.GET.get('q', '')):
+        response.write("%s|%s\n" % (name, key))
+        if dj_name is not None:
+            response.write("%s|%s\n" % (dj_name, key))
     return response
 
 def token(request):
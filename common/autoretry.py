@@ -15,16 +15,221 @@
 ### limitations under the License.
 ###
 
-import time
-import sys
-import inspect
+"""Retries datastore calls that fail with a transient error.
+
+Retries back off with jitter and stop early rather than run past the
+request's deadline, which DeadlineMiddleware (or the api application
+wrapper) sets for each request.  Retries are counted in memcache by
+exception type and by the line of our code that made the call; see
+get_metrics().  Sampled requests also count them in common.profiler.
+"""
+
 import logging
-from functools import wraps
-from google.appengine.runtime import apiproxy_errors
-from google.appengine.datastore import datastore_pb
+import random
+import sys
+import threading
+import time
+
+from google.appengine.api import memcache
 from google.appengine.api.datastore_errors import Timeout
 from google.appengine.api.datastore_errors import TransactionFailedError
-                
+
+from common import profiler
+
+log = logging.getLogger()
+
+RETRIABLE_ERRORS = (TransactionFailedError, Timeout)
+
+# Retries of one call before its error is raised.
+MAX_RETRIES = 6
+# Seconds before the first retry.  Each later retry waits BACKOFF times
+# longer, give or take the jitter.
+RETRY_INTERVAL = 0.1
+BACKOFF = 1.75
+
+# Seconds App Engine lets a request run; tasks and cron jobs get longer.
+REQUEST_DEADLINE = 60
+TASK_DEADLINE = 600
+# Retrying stops this many seconds before the deadline so that there is
+# time left to handle the error.
+DEADLINE_MARGIN = 5
+
+METRICS_PREFIX = 'common.autoretry.'
+SITES_KEY = METRICS_PREFIX + 'sites'
+# Call sites kept in the retry counts, by number of retries.
+MAX_SITES = 50
+
+# Tests replace the time module to skip sleeps, not to stop the clock.
+_clock = time.time
+_local = threading.local()
+
+
+def start_request(deadline=REQUEST_DEADLINE):
+    """Starts the retry budget of the current request."""
+    _local.deadline = _clock() + deadline
+
+
+def finish_request():
+    _local.deadline = None
+
+
+def time_remaining():
+    """Returns seconds until the current request's deadline, or None."""
+    deadline = getattr(_local, 'deadline', None)
+    if deadline is None:
+        return None
+    return deadline - _clock()
+
+
+def _deadline(headers):
+    if (headers.get('HTTP_X_APPENGINE_QUEUENAME') or
+        headers.get('HTTP_X_APPENGINE_CRON')):
+        return TASK_DEADLINE
+    return REQUEST_DEADLINE
+
+
+class DeadlineMiddleware(object):
+    """Gives each request a retry budget that ends before its deadline."""
+
+    def process_request(self, request):
+        start_request(_deadline(request.META))
+
+    def process_response(self, request, response):
+        finish_request()
+        return response
+
+    def process_exception(self, request, exception):
+        finish_request()
+
+
+def wsgi_middleware(app):
+    """Wraps a WSGI application to give each request a retry budget."""
+    def wrapped_app(environ, start_response):
+        start_request(_deadline(environ))
+        try:
+            return app(environ, start_response)
+        finally:
+            finish_request()
+    return wrapped_app
+
+
+def _incr_metrics(offsets):
+    """Increments memcache counters; metrics never fail a call."""
+    try:
+        memcache.offset_multi(offsets, key_prefix=METRICS_PREFIX,
+                              initial_value=0)
+    except:
+        log.exception('IGNORED while recording metrics:')
+
+
+def _incr_site(site):
+    client = memcache.Client()
+    for attempt in range(3):
+        sites = client.gets(SITES_KEY)
+        if sites is None:
+            if client.add(SITES_KEY, {site: 1}):
+                return
+            continue
+        sites[site] = sites.get(site, 0) + 1
+        if len(sites) > MAX_SITES:
+            top = sorted(sites.items(), key=lambda s: s[1], reverse=True)
+            sites = dict(top[:MAX_SITES])
+        if client.cas(SITES_KEY, sites):
+            return
+
+
+def _record_retry(site, exc_type, outcome='retries'):
+    _incr_metrics({outcome: 1, 'exc.' + exc_type: 1})
+    try:
+        _incr_site('%s %s' % (exc_type, site))
+    except:
+        log.exception('IGNORED while recording metrics:')
+    profiler.record_retry(site, exc_type)
+
+
+def get_metrics():
+    """Returns retry counts by outcome, exception type and call site.
+
+    These are memcache counters so they reset whenever memcache is flushed.
+    """
+    names = ['retries', 'gave_up', 'out_of_budget']
+    exc_names = ['exc.' + e.__name__ for e in RETRIABLE_ERRORS]
+    stats = memcache.get_multi(names + exc_names + ['sites'],
+                               key_prefix=METRICS_PREFIX)
+    metrics = dict((name, stats.get(name, 0)) for name in names)
+    metrics['by_exception'] = dict((name[len('exc.'):], stats.get(name, 0))
+                                   for name in exc_names)
+    metrics['by_site'] = sorted((stats.get('sites') or {}).items(),
+                                key=lambda s: s[1], reverse=True)
+    return metrics
+
+
+def _backoff(method, retries):
+    """Sleeps before the next retry of method or re-raises its error.
+
+    This must be called from the except block that caught the error.
+    Returns the number of retries so far.
+    """
+    etype, val, tb = sys.exc_info()
+    exc_type = etype.__name__
+    site = profiler.call_site()
+    call_name = getattr(method, '__name__', 'unnamed')
+    retries += 1
+    if retries > MAX_RETRIES:
+        _record_retry(site, exc_type, 'gave_up')
+        raise etype, val, tb
+    # The jitter spreads out retries of requests that failed together.
+    sleep = (RETRY_INTERVAL * BACKOFF ** (retries - 1) *
+             random.uniform(0.5, 1.5))
+    remaining = time_remaining()
+    if remaining is not None and sleep > remaining - DEADLINE_MARGIN:
+        _record_retry(site, exc_type, 'out_of_budget')
+        log.warning('Datastore %s: not retrying %s at %s with %.1f '
+                    'seconds left in the request'
+                    % (exc_type, call_name, site, remaining))
+        raise etype, val, tb
+    _record_retry(site, exc_type)
+    log.warning('Datastore %s: retry #%d of %s at %s in %.2f seconds'
+                % (exc_type, retries, call_name, site, sleep))
+    time.sleep(sleep)
+    return retries
+
+
+def _run_in_retry_loop(method, args, kw):
+    retries = 0
+    while 1:
+        try:
+            return method(*args, **kw)
+        except RETRIABLE_ERRORS:
+            retries = _backoff(method, retries)
+
+
+class RetryingRPC(object):
+    """The RPC of an async call, which is made again if it fails.
+
+    The error of an async call is raised by get_result() so that is
+    where it is retried.  Other attributes are those of the current RPC.
+    """
+
+    def __init__(self, method, args, kw):
+        self.__method = method
+        self.__args = args
+        self.__kw = kw
+        self.__retries = 0
+        self.__rpc = _run_in_retry_loop(method, args, kw)
+
+    def get_result(self):
+        while 1:
+            try:
+                return self.__rpc.get_result()
+            except RETRIABLE_ERRORS:
+                self.__retries = _backoff(self.__method, self.__retries)
+                self.__rpc = _run_in_retry_loop(self.__method, self.__args,
+                                                self.__kw)
+
+    def __getattr__(self, attr):
+        return getattr(self.__rpc, attr)
+
 
 class AutoRetry(object):
     """Wrapper around any object that proxies methods and retries on failure.
@@ -39,6 +244,9 @@ class AutoRetry(object):
         
         query = User.all().filter('email =', email)
         all_users = AutoRetry(query).fetch(1000)
+
+    Methods whose names end in _async, such as db.get_async(), return a
+    RetryingRPC.
     
     See http://code.google.com/p/chirpradio/issues/detail?id=78 
     or search the GAE group discussion list for "datastore timeout" for more information.
@@ -52,16 +260,20 @@ class AutoRetry(object):
             raise ValueError("Cannot re-wrap in %r (with %r)" % (
                                 self.__class__.__name__, obj))
         self.__obj = obj
+        self.__dispatchers = {}
     
     def __make_dispatcher(self, attr):
+        dispatcher = self.__dispatchers.get(attr)
+        if dispatcher is not None:
+            return dispatcher
         method = getattr(self.__obj, attr)
-        if not hasattr(method, '__name__'):
-            # well, hmm, it seems that wraps() will raise an 
-            # exception if a method does not have __name__
-            method.__name__ = 'unnamed'
-        @wraps(method)
-        def dispatcher(*args, **kw):
-            return self.__run_in_retry_loop(method, args, kw)
+        if attr.endswith('_async'):
+            def dispatcher(*args, **kw):
+                return RetryingRPC(method, args, kw)
+        else:
+            def dispatcher(*args, **kw):
+                return _run_in_retry_loop(method, args, kw)
+        self.__dispatchers[attr] = dispatcher
         return dispatcher
     
     __getitem__ = property(fget=lambda self: self.__make_dispatcher('__getitem__'))
@@ -69,28 +281,3 @@ class AutoRetry(object):
 
     def __getattr__(self, attr):
         return self.__make_dispatcher(attr)
-    
-    def __run_in_retry_loop(self, method, args, kw, attempts=5.0, interval=0.1, exponent=2.0):
-        count = 0.0
-        while 1:
-            try:
-                return method(*args, **kw)
-            except (TransactionFailedError, Timeout), exc:
-                etype, val, tb = sys.exc_info()
-                exc_type = etype.__name__
-
-                sleep = (exponent ** count) * interval
-                count += 0.8
-                if count > attempts: 
-                    raise exc, None, tb
-
-                msg = "Datastore %s: retry #%d in %s seconds.\n%s"
-                if hasattr(method, '__name__'):
-                    call_name = method.__name__
-                else:
-                    call_name = 'unknown'
-                call = '%s(%s)' % (call_name, ', '.join([repr(a) for a in args]))
-                logging.warning(msg % (exc_type, count, sleep, call))
-
-                time.sleep(sleep)
-
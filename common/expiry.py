@@ -0,0 +1,141 @@
+###
+### Copyright 2009 The Chicago Independent Radio Project
+### All Rights Reserved.
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###     http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+###
+
+
+"""Batched deletion of expired datastore entities.
+
+Register a function that returns a keys-only query for the expired
+entities of some kind.  It is passed the time the run started so every
+chained task filters on the same cutoff::
+
+    from common import expiry
+
+    @expiry.expirer('play_count')
+    def expired_play_counts(now):
+        return (PlayCount.all(keys_only=True)
+                .filter('modified <', now - timedelta(days=7)))
+
+Then run_batch('play_count') deletes as many of them as it can in
+TIME_LIMIT seconds and chains a task to continue from the query cursor
+until none are left.  The modules that register expirers are listed in
+settings.EXPIRY_MODULES.
+"""
+
+from datetime import datetime
+import logging
+import time
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from google.appengine.api import memcache, taskqueue
+from google.appengine.ext import db
+
+log = logging.getLogger()
+
+# Keys fetched per query.
+BATCH_SIZE = 500
+# Keys deleted per RPC.  The deletes for a batch run in parallel.
+DELETE_BATCH_SIZE = 100
+# Seconds each task spends deleting before chaining the next one.
+TIME_LIMIT = 60
+# How the start of a run is passed to chained tasks.
+NOW_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+expiry_registry = {}
+
+
+def expirer(name):
+    """Decorator to register a function of the run's start time that
+    returns a keys-only query of expired entities."""
+    def fn_decorator(fn):
+        expiry_registry[name] = fn
+        return fn
+    return fn_decorator
+
+
+def init_expirers():
+    for path in settings.EXPIRY_MODULES:
+        __import__(path)  # registers the expirers
+
+
+def get_query(name, now):
+    init_expirers()
+    if name not in expiry_registry:
+        raise LookupError("No expirer has been registered for %r" % name)
+    return expiry_registry[name](now)
+
+
+def _stats_key(name):
+    return 'common.expiry.%s' % name
+
+
+def get_stats(name):
+    """Returns stats for the last completed run of an expirer or None."""
+    return memcache.get(_stats_key(name))
+
+
+def run_batch(name, cursor=None, deleted=0, started=None, now=None):
+    """Deletes expired entities for TIME_LIMIT seconds.
+
+    A task is queued to continue where this left off if there are more
+    to delete.  now is the start of the run, which the expirer's cutoff
+    is based on.  Returns a dict of progress so far.
+    """
+    if started is None:
+        started = time.time()
+    if now is None:
+        now = datetime.now()
+    query = get_query(name, now)
+    deadline = time.time() + TIME_LIMIT
+    rpcs = []
+    while True:
+        if cursor:
+            query.with_cursor(cursor)
+        # Fetch the next batch while the last one is being deleted.
+        keys = query.fetch(BATCH_SIZE)
+        cursor = query.cursor()
+        for rpc in rpcs:
+            rpc.get_result()
+        rpcs = [db.delete_async(keys[i:i + DELETE_BATCH_SIZE])
+                for i in range(0, len(keys), DELETE_BATCH_SIZE)]
+        deleted += len(keys)
+        finished = len(keys) < BATCH_SIZE
+        if finished or time.time() >= deadline:
+            break
+    for rpc in rpcs:
+        rpc.get_result()
+
+    elapsed = max(time.time() - started, 0.001)
+    stats = {'name': name,
+             'deleted': deleted,
+             'finished': finished,
+             'seconds': round(elapsed, 3),
+             'per_second': round(deleted / elapsed, 1)}
+    if finished:
+        log.info('Expired %(deleted)s %(name)s entities in %(seconds)ss '
+                 '(%(per_second)s/sec)' % stats)
+        memcache.set(_stats_key(name), stats)
+    else:
+        log.info('Expired %(deleted)s %(name)s entities so far '
+                 '(%(per_second)s/sec)' % stats)
+        taskqueue.add(url=reverse('common.expire'),
+                      params={'name': name,
+                              'cursor': cursor,
+                              'deleted': deleted,
+                              'started': repr(started),
+                              'now': now.strftime(NOW_FORMAT)})
+    return stats
@@ -0,0 +1,146 @@
+###
+### Copyright 2009 The Chicago Independent Radio Project
+### All Rights Reserved.
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###     http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+###
+
+
+"""Request-scoped identity map for referenced entities.
+
+While a request is being served, every entity fetched through get() or
+through a ReferenceProperty declared with this module's class is kept
+by key, so an Album that a page dereferences from fifty tracks is only
+fetched once.  Resolve a whole list of references with one batch get
+before looping over it::
+
+    from common import identity
+
+    identity.prefetch(tracks, 'album', 'selector')
+
+IdentityMapMiddleware (or the api application wrapper) starts the map
+for each request and clears it at the end.  Outside of a request, get()
+goes straight to the datastore and nothing is kept.
+"""
+
+import threading
+
+from google.appengine.ext import db
+
+from common.autoretry import AutoRetry
+
+_local = threading.local()
+
+
+def enable():
+    """Starts keeping fetched entities for the current request."""
+    _local.entities = {}
+
+
+def clear():
+    """Forgets all kept entities and stops keeping new ones."""
+    _local.entities = None
+
+
+def is_active():
+    return getattr(_local, 'entities', None) is not None
+
+
+def get(keys):
+    """Returns entities for keys, fetching only those not already kept.
+
+    Like db.get() this returns None for each key that doesn't exist.
+    """
+    entities = getattr(_local, 'entities', None)
+    if entities is None:
+        return AutoRetry(db).get(keys)
+    missing = list(set(k for k in keys if k not in entities))
+    if missing:
+        entities.update(zip(missing, AutoRetry(db).get(missing)))
+    return [entities[k] for k in keys]
+
+
+def add(entity):
+    """Keeps an entity that was fetched some other way."""
+    entities = getattr(_local, 'entities', None)
+    if entities is not None and entity is not None:
+        entities[entity.key()] = entity
+
+
+def prefetch(entities, *names):
+    """Resolves the named references of all entities with one batch get.
+
+    Entities may be of different kinds as long as each has the named
+    properties.  References to deleted entities are left unresolved so
+    accessing them still raises db.ReferencePropertyResolveError.
+    """
+    refs = []
+    for entity in entities:
+        for name in names:
+            prop = getattr(type(entity), name)
+            key = prop.get_value_for_datastore(entity)
+            if key is not None:
+                refs.append((entity, prop, key))
+    if not refs:
+        return
+    keys = list(set(key for entity, prop, key in refs))
+    resolved = dict(zip(keys, get(keys)))
+    for entity, prop, key in refs:
+        if resolved[key] is not None:
+            setattr(entity, _resolved_attr_name(prop), resolved[key])
+
+
+def _resolved_attr_name(prop):
+    return '_RESOLVED' + prop._attr_name()
+
+
+class ReferenceProperty(db.ReferenceProperty):
+    """ReferenceProperty that resolves through the identity map."""
+
+    def __get__(self, model_instance, model_class):
+        if model_instance is not None and is_active():
+            attr_name = _resolved_attr_name(self)
+            if getattr(model_instance, attr_name, None) is None:
+                key = self.get_value_for_datastore(model_instance)
+                if key is not None:
+                    entity = get([key])[0]
+                    if entity is not None:
+                        setattr(model_instance, attr_name, entity)
+        # This raises ReferencePropertyResolveError for a deleted entity.
+        return super(ReferenceProperty, self).__get__(model_instance,
+                                                      model_class)
+
+
+class IdentityMapMiddleware(object):
+    """Keeps an identity map for the duration of each request."""
+
+    def process_request(self, request):
+        enable()
+
+    def process_response(self, request, response):
+        clear()
+        return response
+
+    def process_exception(self, request, exception):
+        clear()
+
+
+def wsgi_middleware(app):
+    """Wraps a WSGI application to keep an identity map per request."""
+    def wrapped_app(environ, start_response):
+        enable()
+        try:
+            return app(environ, start_response)
+        finally:
+            clear()
+    return wrapped_app
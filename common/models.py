@@ -18,6 +18,7 @@
 """Common data models shared across all apps."""
 
 import logging
+import time
 
 from google.appengine.api import memcache
 from google.appengine.ext import db
@@ -27,16 +28,110 @@ from common.autoretry import AutoRetry
 log = logging.getLogger()
 
 
+# Seconds between checks of the config version in memcache.
+VERSION_CHECK_INTERVAL = 5
+# Changes made in the Datastore admin show up after this long.
+SNAPSHOT_TTL = 60 * 10
+
+_clock = time.time
+
+# This instance's copy of the config:
+# {'version': n, 'loaded': <when it was read from the datastore>,
+#  'values': {...}}
+_snapshot = None
+_checked = 0
+
+
 def make_key(key):
     return 'dbconfig.%s' % key
 
 
+VERSION_KEY = make_key('__version__')
+SNAPSHOT_KEY = make_key('__snapshot__')
+
+
+def _bump_version():
+    # Versions start from the clock so that a version lost from
+    # memcache is never reused.
+    return memcache.incr(VERSION_KEY, initial_value=int(_clock() * 1000))
+
+
+def _current_version():
+    try:
+        version = memcache.get(VERSION_KEY)
+        if version is None:
+            version = _bump_version()
+        return version
+    except Exception, exc:
+        log.error('Getting %s: %s' % (VERSION_KEY, exc))
+        return None
+
+
+def _load_snapshot(version):
+    """Returns the snapshot for version, from memcache or the datastore."""
+    if version is not None:
+        try:
+            snapshot = memcache.get(SNAPSHOT_KEY)
+        except Exception, exc:
+            log.error('Getting %s: %s' % (SNAPSHOT_KEY, exc))
+            snapshot = None
+        if (snapshot is not None and snapshot['version'] == version and
+            not _is_old(snapshot)):
+            return snapshot
+    values = dict((c.varname, c.value)
+                  for c in AutoRetry(Config.all()).fetch(1000))
+    snapshot = {'version': version, 'loaded': _clock(), 'values': values}
+    if version is not None:
+        try:
+            memcache.set(SNAPSHOT_KEY, snapshot, time=SNAPSHOT_TTL)
+        except Exception, exc:
+            log.error('Setting %s: %s' % (SNAPSHOT_KEY, exc))
+    return snapshot
+
+
+def _is_old(snapshot):
+    # Old enough that the datastore may have been edited directly.
+    return _clock() - snapshot['loaded'] >= SNAPSHOT_TTL
+
+
+def _update_snapshot(varname, value):
+    """Bumps the version and saves a value into the cached snapshot."""
+    global _snapshot
+    try:
+        version = _bump_version()
+        client = memcache.Client()
+        for attempt in range(3):
+            snapshot = client.gets(SNAPSHOT_KEY)
+            if snapshot is None:
+                # The value was just put so loading from the datastore
+                # could miss it; load what is there and then cas.
+                _load_snapshot(version)
+                continue
+            snapshot['values'][varname] = value
+            snapshot['version'] = max(version, snapshot['version'])
+            if client.cas(SNAPSHOT_KEY, snapshot, time=SNAPSHOT_TTL):
+                _snapshot = snapshot
+                return
+        memcache.delete(SNAPSHOT_KEY)
+    except Exception, exc:
+        log.error('Updating %s: %s' % (SNAPSHOT_KEY, exc))
+    # Reload at the next read.
+    _snapshot = None
+
+
 class DBConfig(object):
     """A datastore config dictionary.
 
     Some configuration params cannot be hard coded into settings.py
     and must be stored in the App Engine datastore.  This object allows you
     to set and retrieve those settings.
+
+    Each instance keeps a snapshot of all values, loaded with one query
+    and shared through memcache.  Setting a value bumps a version number
+    in memcache and the other instances reload their snapshot when they
+    see it change, which they check at most every VERSION_CHECK_INTERVAL
+    seconds.  Edits made in the Datastore admin don't bump the version so
+    snapshots are also reloaded from the datastore after SNAPSHOT_TTL.
     """
 
     def get(self, varname, default=None):
@@ -45,41 +140,44 @@ class DBConfig(object):
         except KeyError:
             return default
 
-    def _memcache(self, key, val):
-        key = make_key(key)
-        try:
-            memcache.set(key, val)
-        except Exception, exc:
-            log.error('Setting %s: %s' % (key, exc))
+    def _values(self):
+        global _snapshot, _checked
+        now = _clock()
+        snapshot = _snapshot
+        if (snapshot is not None and
+            now - _checked < VERSION_CHECK_INTERVAL):
+            return snapshot['values']
+        version = _current_version()
+        if (snapshot is None or version is None or
+            snapshot['version'] != version or _is_old(snapshot)):
+            snapshot = _snapshot = _load_snapshot(version)
+        _checked = now
+        return snapshot['values']
+
+    def refresh(self):
+        """Checks the version now instead of at the next interval."""
+        global _checked
+        _checked = 0
+        self._values()
 
     def __getitem__(self, varname):
         try:
-            cached = memcache.get(make_key(varname))
-        except Exception, exc:
-            log.error('Getting %s: %s' % (make_key(varname), exc))
-            cached = False
-        if cached:
-            return cached
-
-        q = Config.all().filter("varname =", varname)
-        if AutoRetry(q).count(1) == 0:
+            return self._values()[varname]
+        except KeyError:
             raise KeyError("No config value with varname %r" % varname)
-        else:
-            value = AutoRetry(q).fetch(1)[0].value
-            self._memcache(varname, value)
-            return value
 
     def __setitem__(self, varname, value):
         q = Config.all().filter("varname =", varname)
-        if q.count(1) == 1:
-            cfg = AutoRetry(q).fetch(1)[0]
+        configs = AutoRetry(q).fetch(1)
+        if configs:
+            cfg = configs[0]
         else:
             cfg = Config()
 
         cfg.varname = varname
         cfg.value = value
         AutoRetry(cfg).put()
-        self._memcache(varname, value)
+        _update_snapshot(varname, value)
 
 
 class Config(db.Model):
@@ -88,5 +186,5 @@ class Config(db.Model):
 
 
 def load_dbconfig_into_memcache():
-    for c in Config.all():
-        memcache.set(make_key(c.varname), c.value)
+    """Loads this instance's config snapshot, into memcache if need be."""
+    DBConfig().refresh()
@@ -50,8 +50,12 @@
     :copyright: 2009 by tipfy.org.
     :license: BSD, see LICENSE.txt for more details.
 """
+import hashlib
+import hmac
+import logging
 import re
-from base64 import b64encode, b64decode
+from base64 import (b64encode, b64decode, urlsafe_b64encode,
+                    urlsafe_b64decode)
 from urllib import urlencode
 from cgi import parse_qsl
 from datetime import datetime
@@ -59,7 +63,12 @@ from datetime import datetime
 from google.appengine.ext import db
 import google.appengine.ext.db.polymodel
 from google.appengine.ext.search import SearchableQuery, SearchableMultiQuery
-from google.appengine.api import datastore_errors
+from google.appengine.api import datastore_errors, memcache
+from google.appengine.datastore.datastore_query import Cursor
+
+from common import identity
+
+log = logging.getLogger()
 
 # Regex borrowed from google.appengine.api.datastore.
 OPERATORS = ['<', '<=', '>', '>=', '=', '==']
@@ -68,14 +77,11 @@ FILTER_REGEX = re.compile(
     '^\s*([^\s]+)(\s+(%s)\s*)?$' % '|'.join(OPERATORS),
     re.IGNORECASE | re.UNICODE)
 
-class PagerQuery(object):
-    """Wraps db.Query to build bookmarkable queries, and to resume queries from
-    bookmarks.
-    """
-    _query_class = db.Query
+class _QueryBuilder(object):
+    """Collects the filters, orderings and ancestor of a query."""
 
     def __init__(self, model_class, keys_only=False):
-        """Constructs a bookmarkable query over instances of the given Model.
+        """Constructs a query over instances of the given Model.
 
         Args:
           model_class: Model class to build query for.
@@ -167,6 +173,24 @@ class PagerQuery(object):
         self._ancestor = ancestor
         return self
 
+    def _add_default_orderings(self):
+        # If the query has an inequality filter but no sort order:
+        # appends an ASC sort order on the inequality property.
+        if self._inequality_prop and not self._orderings:
+            self.order(self._inequality_prop)
+
+        # If the query doesn't have a sort order on __key__:
+        # append an ASC sort order on __key__.
+        if '__key__' not in self._orderings:
+            self.order('__key__')
+
+
+class PagerQuery(_QueryBuilder):
+    """Wraps db.Query to build bookmarkable queries, and to resume queries from
+    bookmarks.
+    """
+    _query_class = db.Query
+
     def fetch(self, limit, bookmark=None):
         """Fetches the query results, returning bookmarks for next and previous
         pages if available. If bookmark is provided, the query is resumed from
@@ -181,15 +205,7 @@ class PagerQuery(object):
           for the next and previous pages and 'res' is a list of db.Model
           instances for the current page.
         """
-        # If the query has an inequality filter but no sort order:
-        # appends an ASC sort order on the inequality property.
-        if self._inequality_prop and not self._orderings:
-            self.order(self._inequality_prop)
-
-        # If the query doesn't have a sort order on __key__:
-        # append an ASC sort order on __key__.
-        if '__key__' not in self._orderings:
-            self.order('__key__')
+        self._add_default_orderings()
 
         reverse = False
         if bookmark:
@@ -463,6 +479,158 @@ class SearchablePagerQuery(PagerQuery):
         return query
 
 
+class CursorPagerQuery(_QueryBuilder):
+    """Bookmarkable query that resumes from native datastore cursors.
+
+    Each page is one keys-only query from a cursor, plus a batch get of the
+    page's entities, so a deep page costs the same as the first one.
+    Bookmarks are signed with secret so that a bookmark is only accepted
+    by the query that made it.  The keys of each page are cached in
+    memcache for page_cache_ttl seconds; the entities are always fetched
+    fresh.
+
+    Filters, orderings and fetch() work as in PagerQuery, but bookmarks
+    can only come from fetch()::
+
+        query = CursorPagerQuery(Album, secret).filter('title >=', 'F') \
+                                               .order('title')
+        prev, albums, next = query.fetch(10, bookmark)
+        total = query.approximate_count()
+    """
+    page_cache_ttl = 60
+    count_cache_ttl = 60 * 10
+    # approximate_count() stops counting here.
+    count_limit = 1000
+
+    def __init__(self, model_class, secret, keys_only=False):
+        super(CursorPagerQuery, self).__init__(model_class,
+                                               keys_only=keys_only)
+        if type(secret) == unicode:
+            secret = secret.encode('utf8')
+        self._secret = secret
+
+    def fetch(self, limit, bookmark=None):
+        """Fetches a page of results; see PagerQuery.fetch()."""
+        self._add_default_orderings()
+        cache_key = self._cache_key('page', limit, bookmark)
+        page = memcache.get(cache_key)
+        if page is None:
+            page = self._fetch_page(limit, bookmark)
+            memcache.set(cache_key, page, time=self.page_cache_ttl)
+        prev, keys, next = page
+        if self._keys_only:
+            return (prev, keys, next)
+        # Entities deleted since the page was cached are skipped.
+        res = [e for e in identity.get(keys) if e is not None]
+        return (prev, res, next)
+
+    def approximate_count(self):
+        """Returns the number of results, up to count_limit.
+
+        The count is cached for count_cache_ttl seconds so it can be
+        a little out of date.
+        """
+        cache_key = self._cache_key('count')
+        count = memcache.get(cache_key)
+        if count is None:
+            query = self._get_keys_query(ordered=False)
+            count = query.count(self.count_limit)
+            memcache.set(cache_key, count, time=self.count_cache_ttl)
+        return count
+
+    def _fetch_page(self, limit, bookmark):
+        """Returns the previous bookmark, keys and next bookmark of a page.
+        """
+        backward, cursor = self._decode_bookmark(bookmark)
+        if backward:
+            # Walk back from the start of the page after this one.
+            query = self._get_keys_query(reverse=True).with_cursor(cursor)
+            keys = query.fetch(limit)
+            keys.reverse()
+            start = query.cursor()
+            prev = None
+            if query.with_cursor(start).fetch(1):
+                prev = self._encode_bookmark(True, start)
+            next = self._encode_bookmark(False, _reverse_cursor(cursor))
+        else:
+            query = self._get_keys_query().with_cursor(cursor)
+            keys = query.fetch(limit)
+            end = query.cursor()
+            prev = None
+            if cursor:
+                prev = self._encode_bookmark(True, _reverse_cursor(cursor))
+            next = None
+            if query.with_cursor(end).fetch(1):
+                next = self._encode_bookmark(False, end)
+        return (prev, keys, next)
+
+    def _get_keys_query(self, reverse=False, ordered=True):
+        query = self._model_class.all(keys_only=True)
+        if self._ancestor:
+            query.ancestor(self._ancestor)
+        for operator, value in self._inequality_filters.iteritems():
+            query.filter('%s %s' % (self._inequality_prop, operator), value)
+        for prop, value in self._filters.iteritems():
+            query.filter(prop + ' =', value)
+        if ordered:
+            directions = {'': '-', '-': ''}
+            for prop in self._orderings:
+                direction = self._order_directions[prop]
+                if reverse:
+                    direction = directions[direction]
+                query.order(direction + prop)
+        return query
+
+    def _signature(self):
+        """Returns a string that identifies this query."""
+        def value(v):
+            if isinstance(v, db.Model):
+                return v.key()
+            return v
+        return repr((self._model_class.__name__,
+                     value(self._ancestor),
+                     sorted((p, value(v)) for p, v in self._filters.items()),
+                     self._inequality_prop,
+                     sorted(self._inequality_filters.items()),
+                     [self._order_directions[p] + p
+                      for p in self._orderings]))
+
+    def _cache_key(self, *args):
+        digest = hashlib.sha1(self._signature() + repr(args)).hexdigest()
+        return 'common.pager.%s.%s' % (args[0], digest)
+
+    def _sign(self, msg):
+        return hmac.new(self._secret, self._signature() + msg,
+                        hashlib.sha1).hexdigest()
+
+    def _encode_bookmark(self, backward, cursor):
+        msg = '%s:%s' % (backward and 'b' or 'f', cursor)
+        return urlsafe_b64encode('%s:%s' % (msg, self._sign(msg)))
+
+    def _decode_bookmark(self, bookmark):
+        """Returns (backward, cursor) for a bookmark made by this query.
+
+        A missing or bad bookmark starts from the first page.
+        """
+        if not bookmark:
+            return (False, None)
+        try:
+            msg, sig = urlsafe_b64decode(str(bookmark)).rsplit(':', 1)
+            direction, cursor = msg.split(':', 1)
+        except (TypeError, ValueError):
+            log.warning('Malformed bookmark %r' % bookmark)
+            return (False, None)
+        if sig != self._sign(msg):
+            log.warning('Bookmark %r was not made by this query' % bookmark)
+            return (False, None)
+        return (direction == 'b', cursor)
+
+
+def _reverse_cursor(cursor):
+    """Returns the cursor for the same position in the reversed query."""
+    return Cursor.from_websafe_string(cursor).reversed().to_websafe_string()
+
+
 def match_filter(prop_operator):
     """Returns the property and operator given a value passed to filter()."""
     matches = FILTER_REGEX.match(prop_operator)
@@ -0,0 +1,304 @@
+###
+### Copyright 2009 The Chicago Independent Radio Project
+### All Rights Reserved.
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###     http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+###
+
+
+"""Sampled profiling of the API calls made by each request.
+
+For a sample of requests (settings.PROFILER_SAMPLE_RATE) every
+datastore, memcache, taskqueue and urlfetch call is counted and timed,
+grouped by the line of our code that made it.  A call made from the
+same line more than NPLUSONE_THRESHOLD times in one request is logged
+as a likely N+1 pattern.  At the end of the request a summary is merged
+into the per-URL stats that the /common/admin/profiler page shows.
+
+Requests that are not sampled only pay for a thread-local lookup per
+call.
+"""
+
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+from django.conf import settings
+from google.appengine.api import apiproxy_stub_map, memcache
+
+log = logging.getLogger()
+
+PROFILED_SERVICES = ('datastore_v3', 'memcache', 'taskqueue', 'urlfetch')
+
+# Calls from one site in one request before it is flagged as N+1.
+NPLUSONE_THRESHOLD = 10
+# Call sites kept in each URL's summary, by total time.
+MAX_SITES = 10
+# URLs kept in the summaries, by total time.
+MAX_URLS = 200
+
+SUMMARIES_KEY = 'common.profiler.summaries'
+SUMMARIES_TTL = 60 * 60 * 24 * 7
+
+# Frames from these paths are skipped when looking for the call site.
+_LIBRARY_PATHS = [os.path.join('google', 'appengine'),
+                  os.path.join('django', ''),
+                  os.path.join('common', 'autoretry.py'),
+                  os.path.join('common', 'identity.py'),
+                  os.path.join('common', 'profiler.py'),
+                  'ae_djangoforms.py',
+                  'appengine_django']
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_local = threading.local()
+# Tests may swap in a new apiproxy, which then needs the hooks too.
+_hooked_apiproxy = None
+
+
+class Profile(object):
+    """API calls made while serving one request."""
+
+    def __init__(self, url):
+        self.url = url
+        self.started = time.time()
+        self.pending = {}
+        # (call, site) -> [calls, milliseconds]
+        self.sites = {}
+        # 'exception site' -> retries; see common.autoretry.
+        self.retries = {}
+
+    def start_call(self, rpc_id, call, site):
+        self.pending[rpc_id] = (call, site, time.time())
+
+    def end_call(self, rpc_id):
+        if rpc_id not in self.pending:
+            return
+        call, site, started = self.pending.pop(rpc_id)
+        stats = self.sites.setdefault((call, site), [0, 0])
+        stats[0] += 1
+        stats[1] += int((time.time() - started) * 1000)
+
+    def nplusone(self):
+        return sorted((n, call, site) for (call, site), (n, ms)
+                      in self.sites.items() if n > NPLUSONE_THRESHOLD)
+
+    def summary(self):
+        return {
+            'elapsed_ms': int((time.time() - self.started) * 1000),
+            'rpcs': sum(n for n, ms in self.sites.values()),
+            'rpc_ms': sum(ms for n, ms in self.sites.values()),
+            'nplusone': len(self.nplusone()),
+            'retries': sum(self.retries.values()),
+            'sites': dict(('%s %s' % key, val)
+                          for key, val in self.sites.items()),
+        }
+
+
+def _call_name(service, call, request):
+    name = '%s.%s' % (service, call)
+    if service == 'datastore_v3' and call == 'RunQuery':
+        try:
+            name = '%s(%s)' % (name, request.kind())
+        except:
+            pass
+    return name
+
+
+def call_site():
+    """Returns the file and line of our code that led to this call."""
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if not any(p in filename for p in _LIBRARY_PATHS):
+            return '%s:%s' % (os.path.relpath(filename, _ROOT),
+                              frame.f_lineno)
+        frame = frame.f_back
+    return 'unknown'
+
+
+def _pre_call(service, call, request, response, rpc):
+    profile = getattr(_local, 'profile', None)
+    if profile is None:
+        return
+    profile.start_call(id(response), _call_name(service, call, request),
+                       call_site())
+
+
+def _post_call(service, call, request, response, rpc, error):
+    profile = getattr(_local, 'profile', None)
+    if profile is None:
+        return
+    profile.end_call(id(response))
+
+
+def record_retry(site, exc_type):
+    """Counts a retry in the current request's profile, if it is sampled."""
+    profile = getattr(_local, 'profile', None)
+    if profile is None:
+        return
+    key = '%s %s' % (exc_type, site)
+    profile.retries[key] = profile.retries.get(key, 0) + 1
+
+
+def install():
+    """Adds the API call hooks; safe to call more than once."""
+    global _hooked_apiproxy
+    apiproxy = apiproxy_stub_map.apiproxy
+    if apiproxy is _hooked_apiproxy:
+        return
+    for service in PROFILED_SERVICES:
+        apiproxy.GetPreCallHooks().Append('profiler_pre_' + service,
+                                          _pre_call, service)
+        apiproxy.GetPostCallHooks().Append('profiler_post_' + service,
+                                           _post_call, service)
+    _hooked_apiproxy = apiproxy
+
+
+def url_pattern(path):
+    """Groups URLs that differ only by IDs or entity keys."""
+    path = re.sub(r'/\d+(?=/|$)', '/:id', path)
+    return re.sub(r'/[\w-]{20,}(?=/|$)', '/:key', path)
+
+
+def start(path):
+    """Starts profiling the current request if it is sampled."""
+    if random.random() < settings.PROFILER_SAMPLE_RATE:
+        _local.profile = Profile(url_pattern(path))
+    else:
+        _local.profile = None
+
+
+def current_profile():
+    """Returns the Profile of the current request, if it is sampled."""
+    return getattr(_local, 'profile', None)
+
+
+def finish():
+    """Stops profiling the current request and records its summary."""
+    profile = getattr(_local, 'profile', None)
+    if profile is None:
+        return
+    # The calls made while recording are not profiled.
+    _local.profile = None
+    for n, call, site in profile.nplusone():
+        log.warning('Possible N+1 query on %s: %s calls of %s from %s'
+                    % (profile.url, n, call, site))
+    for key, n in profile.retries.items():
+        log.info('%s retries of %s on %s' % (n, key, profile.url))
+    try:
+        _record(profile.url, profile.summary())
+    except:
+        log.exception('IGNORED while recording profile:')
+
+
+def _merge(summaries, url, summary):
+    totals = summaries.setdefault(url, {'requests': 0, 'total_ms': 0,
+                                        'max_ms': 0, 'rpcs': 0,
+                                        'rpc_ms': 0, 'nplusone': 0,
+                                        'retries': 0, 'sites': {}})
+    totals['requests'] += 1
+    totals['total_ms'] += summary['elapsed_ms']
+    totals['max_ms'] = max(totals['max_ms'], summary['elapsed_ms'])
+    for name in ('rpcs', 'rpc_ms', 'nplusone', 'retries'):
+        totals[name] += summary[name]
+    sites = totals['sites']
+    for site, (n, ms) in summary['sites'].items():
+        stats = sites.setdefault(site, [0, 0])
+        stats[0] += n
+        stats[1] += ms
+    if len(sites) > MAX_SITES:
+        top = sorted(sites.items(), key=lambda s: s[1][1], reverse=True)
+        totals['sites'] = dict(top[:MAX_SITES])
+    if len(summaries) > MAX_URLS:
+        slowest = sorted(summaries.items(), key=lambda s: s[1]['total_ms'],
+                         reverse=True)
+        summaries = dict(slowest[:MAX_URLS])
+    return summaries
+
+
+def _record(url, summary):
+    client = memcache.Client()
+    for attempt in range(3):
+        summaries = client.gets(SUMMARIES_KEY)
+        if summaries is None:
+            if client.add(SUMMARIES_KEY, _merge({}, url, summary),
+                          time=SUMMARIES_TTL):
+                return
+            continue
+        if client.cas(SUMMARIES_KEY, _merge(summaries, url, summary),
+                      time=SUMMARIES_TTL):
+            return
+    # Lost the race to other requests; this sample is dropped.
+
+
+def get_report():
+    """Returns URL stats, slowest average first, with their top call sites.
+    """
+    report = []
+    for url, totals in (memcache.get(SUMMARIES_KEY) or {}).items():
+        n = totals['requests']
+        sites = sorted(totals['sites'].items(), key=lambda s: s[1][1],
+                       reverse=True)
+        report.append({
+            'url': url,
+            'requests': n,
+            'avg_ms': totals['total_ms'] / n,
+            'max_ms': totals['max_ms'],
+            'avg_rpcs': float(totals['rpcs']) / n,
+            'avg_rpc_ms': totals['rpc_ms'] / n,
+            'nplusone': totals['nplusone'],
+            'retries': totals.get('retries', 0),
+            'sites': [{'site': site, 'avg_calls': float(calls) / n,
+                       'avg_ms': ms / n}
+                      for site, (calls, ms) in sites],
+        })
+    report.sort(key=lambda r: r['avg_ms'], reverse=True)
+    return report
+
+
+def reset():
+    memcache.delete(SUMMARIES_KEY)
+
+
+class ProfilerMiddleware(object):
+    """Profiles a sample of requests; see the module docstring."""
+
+    def __init__(self):
+        install()
+
+    def process_request(self, request):
+        start(request.path)
+
+    def process_response(self, request, response):
+        finish()
+        return response
+
+    def process_exception(self, request, exception):
+        finish()
+
+
+def wsgi_middleware(app):
+    """Wraps a WSGI application to profile a sample of its requests."""
+    install()
+
+    def wrapped_app(environ, start_response):
+        start(environ.get('PATH_INFO', ''))
+        try:
+            return app(environ, start_response)
+        finally:
+            finish()
+    return wrapped_app
@@ -19,6 +19,7 @@ from __future__ import with_statement
 import unittest
 
 import fudge
+from google.appengine.api import memcache
 from google.appengine.ext import db
 from google.appengine.datastore import datastore_pb
 from google.appengine.runtime import apiproxy_errors
@@ -83,10 +84,11 @@ class TestAutoRetryQueryInterface(unittest.TestCase):
 class TestAutoRetryExceptionHandling(unittest.TestCase):
     
     def setUp(self):
-        pass
+        assert memcache.flush_all()
     
     def tearDown(self):
         fudge.clear_expectations()
+        assert memcache.flush_all()
     
     def test_timeout(self):
                 
@@ -147,3 +149,60 @@ class TestAutoRetryExceptionHandling(unittest.TestCase):
             b = AutoRetry(a)
         self.assertRaises(ValueError, wrap_twice)
         
+    
+    def test_dispatchers_are_cached(self):
+        q = db.Query(User)
+        wrapped = AutoRetry(q)
+        assert wrapped.fetch is wrapped.fetch
+    
+    def test_give_up(self):
+        timeout = Timeout()
+        FakeUser = fudge.Fake('User').provides('fetch').raises(timeout)
+        fake_time = fudge.Fake('time').provides('sleep')
+        
+        with fudge.patched_context(autoretry, 'time', fake_time):
+            self.assertRaises(Timeout, AutoRetry(FakeUser).fetch, 1000)
+        
+        self.assertEquals(autoretry.get_metrics()['gave_up'], 1)
+    
+    def test_out_of_budget(self):
+        timeout = Timeout()
+        FakeUser = (fudge.Fake('User')
+                        .expects('fetch')
+                        .raises(timeout)
+                        .next_call()
+                        .returns(['<user>']))
+        # Not enough time is left in the request to retry.
+        fake_time = fudge.Fake('time')
+        
+        autoretry.start_request(deadline=autoretry.DEADLINE_MARGIN)
+        try:
+            with fudge.patched_context(autoretry, 'time', fake_time):
+                self.assertRaises(Timeout, AutoRetry(FakeUser).fetch, 1000)
+        finally:
+            autoretry.finish_request()
+        
+        metrics = autoretry.get_metrics()
+        self.assertEquals(metrics['out_of_budget'], 1)
+        self.assertEquals(metrics['by_exception']['Timeout'], 1)
+        site, count = metrics['by_site'][0]
+        assert site.startswith('Timeout '), site
+        assert 'test_autoretry.py' in site, site
+    
+    def test_async(self):
+        timeout = Timeout()
+        failed_rpc = fudge.Fake('rpc').provides('get_result').raises(timeout)
+        rpc = fudge.Fake('rpc').provides('get_result').returns(['<user>'])
+        fake_db = (fudge.Fake('db')
+                        .expects('get_async')
+                        .with_args('<key>')
+                        .returns(failed_rpc)
+                        .next_call()
+                        .returns(rpc))
+        fake_time = fudge.Fake('time').expects('sleep')
+        
+        with fudge.patched_context(autoretry, 'time', fake_time):
+            result = AutoRetry(fake_db).get_async('<key>')
+            self.assertEquals(result.get_result(), ['<user>'])
+        
+        fudge.verify()
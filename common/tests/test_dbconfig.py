@@ -15,11 +15,13 @@
 ### limitations under the License.
 ###
 
+import time
 import unittest
 
 from google.appengine.api import memcache
 
 from common import dbconfig
+from common import models
 from common.models import Config, load_dbconfig_into_memcache
 
 __all__ = ['TestDBConfig']
@@ -30,6 +32,7 @@ class TestDBConfig(unittest.TestCase):
         assert memcache.flush_all()
         for c in Config.all():
             c.delete()
+        dbconfig.refresh()
     
     def test_non_existant_var(self):
         self.assertRaises(KeyError, lambda: dbconfig['not-here'])
@@ -66,3 +69,40 @@ class TestDBConfig(unittest.TestCase):
         self.assertEqual(dbconfig['one'], '1')
         self.assertEqual(dbconfig['two'], '2')
         self.assertEqual(dbconfig['three'], 'three')
+
+    def test_other_instance_sees_change(self):
+        dbconfig['color'] = 'red'
+        stale = models._snapshot
+        dbconfig['color'] = 'blue'
+        # Pretend to be an instance that still has the old snapshot.
+        models._snapshot = stale
+        self.assertEqual(dbconfig['color'], 'red')
+        models._checked = 0
+        self.assertEqual(dbconfig['color'], 'blue')
+
+    def test_snapshot_from_memcache(self):
+        dbconfig['one'] = '1'
+        for c in Config.all():
+            c.delete()
+        # A new instance loads the snapshot from memcache.
+        models._snapshot = None
+        self.assertEqual(dbconfig['one'], '1')
+        # Lost from memcache, so it is loaded from the datastore.
+        assert memcache.flush_all()
+        dbconfig.refresh()
+        self.assertRaises(KeyError, lambda: dbconfig['one'])
+
+    def test_datastore_edit_shows_up_after_ttl(self):
+        dbconfig['color'] = 'red'
+        # Edited in the Datastore admin, which doesn't bump the version.
+        cfg = Config.all().filter('varname =', 'color').get()
+        cfg.value = 'blue'
+        cfg.put()
+        models._checked = 0
+        self.assertEqual(dbconfig['color'], 'red')
+        now = models._clock()
+        models._clock = lambda: now + models.SNAPSHOT_TTL
+        try:
+            self.assertEqual(dbconfig['color'], 'blue')
+        finally:
+            models._clock = time.time
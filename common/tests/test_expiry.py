@@ -0,0 +1,113 @@
+###
+### Copyright 2009 The Chicago Independent Radio Project
+### All Rights Reserved.
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###     http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+###
+from __future__ import with_statement
+from datetime import datetime, timedelta
+
+from django.test import TestCase
+from django.utils import simplejson
+import fudge
+from fudge.inspector import arg
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+from common import expiry
+
+
+class Widget(db.Model):
+    created = db.DateTimeProperty()
+
+
+@expiry.expirer('widgets')
+def old_widgets(now):
+    return Widget.all(keys_only=True).filter(
+                    'created <', now - timedelta(days=1))
+
+
+class TestExpiry(TestCase):
+
+    def setUp(self):
+        assert memcache.flush_all()
+        old = datetime.now() - timedelta(days=2)
+        db.put([Widget(created=old) for i in range(5)])
+        Widget(created=datetime.now()).put()
+
+    def tearDown(self):
+        assert memcache.flush_all()
+        db.delete(Widget.all(keys_only=True).fetch(100))
+
+    def test_run_batch(self):
+        stats = expiry.run_batch('widgets')
+        self.assertEqual(stats['deleted'], 5)
+        self.assertEqual(stats['finished'], True)
+        self.assertEqual(Widget.all().count(), 1)
+        self.assertEqual(expiry.get_stats('widgets')['deleted'], 5)
+        assert 'per_second' in expiry.get_stats('widgets')
+
+    @fudge.patch('common.expiry.taskqueue')
+    def test_chain(self, fake_tq):
+        tasks = []
+
+        def add(url=None, params=None):
+            tasks.append(params)
+
+        fake_tq.provides('add').calls(add)
+        with fudge.patched_context(expiry, 'BATCH_SIZE', 2):
+            with fudge.patched_context(expiry, 'TIME_LIMIT', 0):
+                stats = expiry.run_batch('widgets')
+                self.assertEqual(stats['finished'], False)
+                while tasks:
+                    r = self.client.post('/common/task/expire', tasks.pop())
+                    self.assertEqual(r.status_code, 200)
+                    stats = simplejson.loads(r.content)
+        self.assertEqual(stats['finished'], True)
+        self.assertEqual(stats['deleted'], 5)
+        self.assertEqual(Widget.all().count(), 1)
+
+    @fudge.patch('common.expiry.taskqueue')
+    def test_chain_keeps_cutoff(self, fake_tq):
+        tasks = []
+
+        def add(url=None, params=None):
+            tasks.append(params)
+
+        fake_tq.provides('add').calls(add)
+        # Old now but not when the run started.
+        db.put([Widget(created=datetime.now() - timedelta(days=1, hours=6))
+                for i in range(2)])
+        started = datetime.now() - timedelta(hours=12)
+        with fudge.patched_context(expiry, 'BATCH_SIZE', 2):
+            with fudge.patched_context(expiry, 'TIME_LIMIT', 0):
+                stats = expiry.run_batch('widgets', now=started)
+                while tasks:
+                    params = tasks.pop()
+                    self.assertEqual(params['now'],
+                                     started.strftime(expiry.NOW_FORMAT))
+                    r = self.client.post('/common/task/expire', params)
+                    self.assertEqual(r.status_code, 200)
+                    stats = simplejson.loads(r.content)
+        self.assertEqual(stats['finished'], True)
+        self.assertEqual(stats['deleted'], 5)
+        self.assertEqual(Widget.all().count(), 3)
+
+    def test_cron(self):
+        r = self.client.get('/common/task/expire/widgets',
+                            HTTP_X_APPENGINE_CRON='true')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(Widget.all().count(), 1)
+
+    def test_unknown_expirer(self):
+        self.assertRaises(LookupError, expiry.run_batch, 'nope')
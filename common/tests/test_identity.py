@@ -0,0 +1,100 @@
+###
+### Copyright 2009 The Chicago Independent Radio Project
+### All Rights Reserved.
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###     http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+###
+import unittest
+
+from google.appengine.ext import db
+
+from common import identity
+
+
+class Parent(db.Model):
+    name = db.StringProperty()
+
+
+class Child(db.Model):
+    parent_ref = identity.ReferenceProperty(Parent)
+
+
+class TestIdentityMap(unittest.TestCase):
+
+    def setUp(self):
+        self.parent = Parent(name='a')
+        self.parent.put()
+        self.other = Parent(name='b')
+        self.other.put()
+        self.children = [Child(parent_ref=self.parent),
+                         Child(parent_ref=self.other),
+                         Child(parent_ref=self.parent)]
+        db.put(self.children)
+
+    def tearDown(self):
+        identity.clear()
+        for kind in (Parent, Child):
+            db.delete(kind.all(keys_only=True).fetch(100))
+
+    def children_from_datastore(self):
+        return Child.get([c.key() for c in self.children])
+
+    def test_inactive(self):
+        first, second = identity.get([self.parent.key()] * 2)
+        self.assertEqual(first.name, 'a')
+        assert first is not second
+
+    def test_get(self):
+        identity.enable()
+        first, second = identity.get([self.parent.key()] * 2)
+        assert first is second
+        assert identity.get([self.parent.key()])[0] is first
+        identity.clear()
+        assert identity.get([self.parent.key()])[0] is not first
+
+    def test_get_missing(self):
+        key = self.other.key()
+        self.other.delete()
+        identity.enable()
+        self.assertEqual(identity.get([key]), [None])
+
+    def test_reference_resolution(self):
+        identity.enable()
+        first, second, third = self.children_from_datastore()
+        assert first.parent_ref is third.parent_ref
+        self.assertEqual(second.parent_ref.name, 'b')
+
+    def test_prefetch(self):
+        children = self.children_from_datastore()
+        identity.prefetch(children, 'parent_ref')
+        # Already resolved so these do not touch the datastore.
+        db.delete([self.parent, self.other])
+        self.assertEqual([c.parent_ref.name for c in children],
+                         ['a', 'b', 'a'])
+        assert children[0].parent_ref is children[2].parent_ref
+
+    def test_prefetch_bad_reference(self):
+        self.other.delete()
+        children = self.children_from_datastore()
+        identity.prefetch(children, 'parent_ref')
+        self.assertEqual(children[0].parent_ref.name, 'a')
+        self.assertRaises(db.ReferencePropertyResolveError,
+                          lambda: children[1].parent_ref)
+
+    def test_middleware(self):
+        middleware = identity.IdentityMapMiddleware()
+        middleware.process_request(None)
+        assert identity.is_active()
+        response = object()
+        assert middleware.process_response(None, response) is response
+        assert not identity.is_active()
@@ -0,0 +1,118 @@
+###
+### Copyright 2009 The Chicago Independent Radio Project
+### All Rights Reserved.
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###     http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+###
+import unittest
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+from common import pager
+
+SECRET = 'SEKRET'
+
+
+class Item(db.Model):
+    name = db.StringProperty()
+    group = db.StringProperty()
+
+
+class TestCursorPagerQuery(unittest.TestCase):
+
+    def setUp(self):
+        assert memcache.flush_all()
+        db.put([Item(name='item%02d' % i, group='a') for i in range(25)] +
+               [Item(name='other', group='b')])
+
+    def tearDown(self):
+        assert memcache.flush_all()
+        db.delete(Item.all(keys_only=True).fetch(100))
+
+    def query(self):
+        return pager.CursorPagerQuery(Item, SECRET) \
+                    .filter('group =', 'a').order('name')
+
+    def names(self, items):
+        return [i.name for i in items]
+
+    def test_pages(self):
+        prev, items, next = self.query().fetch(10)
+        self.assertEqual(prev, None)
+        self.assertEqual(self.names(items),
+                         ['item%02d' % i for i in range(10)])
+
+        prev, items, next = self.query().fetch(10, next)
+        self.assertEqual(self.names(items),
+                         ['item%02d' % i for i in range(10, 20)])
+        page_two_next = next
+
+        prev, items, next = self.query().fetch(10, next)
+        self.assertEqual(self.names(items),
+                         ['item%02d' % i for i in range(20, 25)])
+        self.assertEqual(next, None)
+
+        # Back to page two, then page one.
+        prev, items, next = self.query().fetch(10, prev)
+        self.assertEqual(self.names(items),
+                         ['item%02d' % i for i in range(10, 20)])
+        self.assertEqual(next, page_two_next)
+
+        prev, items, next = self.query().fetch(10, prev)
+        self.assertEqual(self.names(items),
+                         ['item%02d' % i for i in range(10)])
+        self.assertEqual(prev, None)
+
+    def test_bookmark_is_signed(self):
+        prev, items, next = self.query().fetch(10)
+        other = pager.CursorPagerQuery(Item, SECRET) \
+                     .filter('group =', 'b').order('name')
+        # Not made by this query so it starts from the first page.
+        prev, items, next = other.fetch(10, next)
+        self.assertEqual(self.names(items), ['other'])
+        prev, items, next = self.query().fetch(10, 'garbage')
+        self.assertEqual(self.names(items)[0], 'item00')
+
+    def test_bookmark_needs_same_secret(self):
+        prev, items, next = self.query().fetch(10)
+        other = pager.CursorPagerQuery(Item, 'other secret') \
+                     .filter('group =', 'a').order('name')
+        prev, items, next = other.fetch(10, next)
+        self.assertEqual(self.names(items)[0], 'item00')
+
+    def test_not_a_pager_query(self):
+        assert not isinstance(self.query(), pager.PagerQuery)
+        assert not hasattr(self.query(), 'get_bookmark')
+
+    def test_page_cache(self):
+        prev, items, next = self.query().fetch(10)
+        # Cached keys are used but deleted entities are skipped.
+        items[0].delete()
+        Item(name='item00a', group='a').put()
+        prev, items, next = self.query().fetch(10)
+        self.assertEqual(self.names(items),
+                         ['item%02d' % i for i in range(1, 10)])
+
+    def test_keys_only(self):
+        query = pager.CursorPagerQuery(Item, SECRET, keys_only=True) \
+                     .filter('group =', 'a').order('name')
+        prev, keys, next = query.fetch(5)
+        self.assertEqual([k.kind() for k in keys], ['Item'] * 5)
+
+    def test_approximate_count(self):
+        self.assertEqual(self.query().approximate_count(), 25)
+        query = self.query()
+        query.count_limit = 20
+        assert memcache.flush_all()
+        self.assertEqual(query.approximate_count(), 20)
@@ -0,0 +1,90 @@
+###
+### Copyright 2009 The Chicago Independent Radio Project
+### All Rights Reserved.
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###     http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+###
+from __future__ import with_statement
+
+from django.conf import settings
+from django.test import TestCase
+import fudge
+from google.appengine.api import memcache
+
+from auth import roles
+from common import profiler
+
+
+class TestProfiler(TestCase):
+
+    def setUp(self):
+        assert memcache.flush_all()
+        profiler.install()
+
+    def tearDown(self):
+        assert memcache.flush_all()
+
+    def profile(self, path, calls):
+        with fudge.patched_context(settings, 'PROFILER_SAMPLE_RATE', 1):
+            profiler.start(path)
+            for i in range(calls):
+                memcache.get('profiler-test-%s' % i)
+            profiler.finish()
+
+    def test_url_pattern(self):
+        self.assertEqual(profiler.url_pattern('/djdb/album/123/info'),
+                         '/djdb/album/:id/info')
+        self.assertEqual(
+            profiler.url_pattern('/playlists/delete/agpjaGlycHJhZGlvcgwLEgV'),
+            '/playlists/delete/:key')
+        self.assertEqual(profiler.url_pattern('/djdb/'), '/djdb/')
+
+    def test_summary(self):
+        self.profile('/djdb/album/1', 3)
+        self.profile('/djdb/album/2', 3)
+        report = profiler.get_report()
+        self.assertEqual(len(report), 1)
+        url = report[0]
+        self.assertEqual(url['url'], '/djdb/album/:id')
+        self.assertEqual(url['requests'], 2)
+        self.assertEqual(url['avg_rpcs'], 3)
+        self.assertEqual(url['nplusone'], 0)
+        self.assertEqual(len(url['sites']), 1)
+        site = url['sites'][0]
+        assert site['site'].startswith('memcache.Get '), site
+        assert 'test_profiler.py' in site['site'], site
+        self.assertEqual(site['avg_calls'], 3)
+
+    def test_nplusone(self):
+        self.profile('/djdb/', profiler.NPLUSONE_THRESHOLD + 1)
+        self.assertEqual(profiler.get_report()[0]['nplusone'], 1)
+
+    def test_not_sampled(self):
+        with fudge.patched_context(settings, 'PROFILER_SAMPLE_RATE', 0):
+            profiler.start('/djdb/')
+            memcache.get('profiler-test')
+            profiler.finish()
+        self.assertEqual(profiler.get_report(), [])
+
+    def test_report_page(self):
+        self.profile('/djdb/', 1)
+        self.client.login(email='test@test.com', roles=[roles.DJ])
+        # Keep these requests out of the report.
+        with fudge.patched_context(settings, 'PROFILER_SAMPLE_RATE', 0):
+            r = self.client.get('/common/admin/profiler')
+            self.assertEqual(r.status_code, 200)
+            assert '/djdb/' in r.content
+            r = self.client.post('/common/admin/profiler',
+                                 {'reset': 'Reset'})
+            self.assertEqual(r.status_code, 302)
+        self.assertEqual(profiler.get_report(), [])
@@ -22,4 +22,8 @@ from django.conf.urls.defaults import patterns, url
 urlpatterns = patterns('common.views',
     url(r'^_init_config$', '_init_config'),
     url(r'^_make_json_error$', '_make_json_error'),
+    url(r'^task/expire$', 'expire', name='common.expire'),
+    url(r'^task/expire/(\w+)$', 'start_expiry', name='common.start_expiry'),
+    url(r'^admin/profiler$', 'profiler_report',
+        name='common.profiler_report'),
 )
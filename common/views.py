@@ -15,13 +15,18 @@
 ### limitations under the License.
 ###
 
+from datetime import datetime
 import logging
 
+from django.conf import settings
 from django.http import HttpResponse, HttpResponseRedirect
+from django.shortcuts import render_to_response
+from django.template import RequestContext
 from google.appengine.api import taskqueue
 
+from common import autoretry, expiry, profiler
 from common.models import Config, load_dbconfig_into_memcache
-from common.utilities import as_json
+from common.utilities import as_json, cronjob
 
 log = logging.getLogger()
 
@@ -61,3 +66,35 @@ def appengine_warmup(request):
     taskqueue.add(url='/api/current_playlist', method='GET')
     load_dbconfig_into_memcache()
     return HttpResponse("it's getting hot in here")
+
+
+@cronjob
+def start_expiry(request, name):
+    """Cron view to delete expired entities; see common.expiry."""
+    expiry.run_batch(name)
+
+
+@as_json
+def expire(request):
+    """Task view that continues deleting expired entities."""
+    return expiry.run_batch(request.POST['name'],
+                            cursor=request.POST['cursor'],
+                            deleted=int(request.POST['deleted']),
+                            started=float(request.POST['started']),
+                            now=datetime.strptime(request.POST['now'],
+                                                  expiry.NOW_FORMAT))
+
+
+def profiler_report(request):
+    """Admin page of the slowest URLs, their top API call sites and
+    datastore retries."""
+    if request.method == 'POST' and request.POST.get('reset'):
+        profiler.reset()
+        return HttpResponseRedirect(request.path)
+    return render_to_response('common/profiler_report.html', {
+        'title': 'Slow requests',
+        'report': profiler.get_report(),
+        'retries': autoretry.get_metrics(),
+        'sample_rate': settings.PROFILER_SAMPLE_RATE,
+        'nplusone_threshold': profiler.NPLUSONE_THRESHOLD,
+    }, context_instance=RequestContext(request))
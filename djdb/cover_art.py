@@ -0,0 +1,185 @@
+###
+### Copyright 2009 The Chicago Independent Radio Project
+### All Rights Reserved.
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###     http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+###
+
+"""Album cover art from Last FM, cached for page views and the API.
+
+Cover art is keyed by the normalized (artist, album) names.  Library
+albums keep their URLs in the Album.lastfm_* fields; anything else (like
+freeform playlist entries) is kept in a CoverArt entity.  Memcache sits
+in front of both.
+
+lookup() never talks to Last FM.  When the cover art is missing or old it
+queues a task that calls refresh(), which does.
+"""
+
+from datetime import datetime, timedelta
+import hashlib
+import logging
+import time
+
+from google.appengine.api import memcache, taskqueue
+
+from djdb import lastfm
+from djdb import models
+from djdb import pylast
+
+log = logging.getLogger(__name__)
+
+# How long cover art is used before it is refreshed from Last FM.
+FOUND_TTL = timedelta(days=30)
+# How long to remember that Last FM had no cover art.
+NOT_FOUND_TTL = timedelta(days=1)
+MEMCACHE_TTL = 60 * 60 * 6  # seconds
+# At most one refresh task is queued per album in this many seconds.
+REFRESH_INTERVAL = 60 * 60
+
+SIZES = ('sm', 'med', 'lg', 'xl')
+
+
+def normalize(artist_name, album_title):
+    """Returns the name that identifies an album's cover art."""
+    def norm(name):
+        return u' '.join((name or u'').lower().split())
+    return u'%s\n%s' % (norm(artist_name), norm(album_title))
+
+
+def get_key_name(artist_name, album_title):
+    return hashlib.sha1(
+        normalize(artist_name, album_title).encode('utf8')).hexdigest()
+
+
+def _memcache_key(key_name):
+    return 'djdb.cover_art.%s' % key_name
+
+
+def _as_art(entity, found):
+    art = {'found': found,
+           'retrieved': entity.lastfm_retrieval_time}
+    for size in SIZES:
+        art[size] = getattr(entity, 'lastfm_%s_image_url' % size)
+    return art
+
+
+def _load(key_name, album=None):
+    """Loads cover art from the datastore or returns None."""
+    if album is not None:
+        if album.lastfm_retrieval_time is None:
+            return None
+        return _as_art(album, bool(album.lastfm_med_image_url or
+                                   album.lastfm_xl_image_url))
+    entity = models.CoverArt.get_by_key_name(key_name)
+    if entity is None or entity.lastfm_retrieval_time is None:
+        return None
+    return _as_art(entity, entity.found)
+
+
+def is_stale(art):
+    ttl = art['found'] and FOUND_TTL or NOT_FOUND_TTL
+    return art['retrieved'] + ttl < datetime.now()
+
+
+def lookup(artist_name, album_title, album=None):
+    """Returns cached cover art without contacting Last FM.
+
+    The result is a dict of image URLs by size ('sm', 'med', 'lg', 'xl')
+    plus 'found' (False if Last FM had no cover art) or None if the cover
+    art has not been retrieved yet.  Missing or stale cover art is
+    refreshed in the background.
+
+    Pass album if this is a library album.
+    """
+    key_name = get_key_name(artist_name, album_title)
+    art = memcache.get(_memcache_key(key_name))
+    if art is None:
+        art = _load(key_name, album=album)
+        if art is not None:
+            memcache.set(_memcache_key(key_name), art, time=MEMCACHE_TTL)
+    if art is None or is_stale(art):
+        queue_refresh(artist_name, album_title, album=album)
+    return art
+
+
+def queue_refresh(artist_name, album_title, album=None):
+    key_name = get_key_name(artist_name, album_title)
+    interval = int(time.time()) // REFRESH_INTERVAL
+    params = {'artist': (artist_name or u'').encode('utf8'),
+              'album': (album_title or u'').encode('utf8')}
+    if album is not None:
+        params['album_key'] = str(album.key())
+    try:
+        taskqueue.add(url='/api/_refresh_cover_art',
+                      queue_name='lastfm',
+                      name='cover-art-%s-%d' % (key_name, interval),
+                      params=params)
+    except (taskqueue.TaskAlreadyExistsError,
+            taskqueue.TombstonedTaskError):
+        pass
+    except:
+        log.exception('IGNORED while queueing cover art refresh')
+
+
+def refresh(artist_name, album_title, album=None, force=False):
+    """Returns cover art, fetching it from Last FM if it is missing or stale.
+
+    This blocks on Last FM so it should only be called from tasks.
+    """
+    key_name = get_key_name(artist_name, album_title)
+    art = _load(key_name, album=album)
+    if art is None or force or is_stale(art):
+        art = _fetch(key_name, artist_name, album_title, album=album)
+    memcache.set(_memcache_key(key_name), art, time=MEMCACHE_TTL)
+    return art
+
+
+def _fetch(key_name, artist_name, album_title, album=None):
+    if album is not None:
+        try:
+            album.get_lastfm_image_urls()
+        except pylast.WSError:
+            # Probably album not found
+            log.info('No Last FM cover art for %r / %r'
+                     % (artist_name, album_title))
+            for size in SIZES:
+                setattr(album, 'lastfm_%s_image_url' % size, None)
+            album.lastfm_retrieval_time = datetime.now()
+            album.save()
+        return _load(key_name, album=album)
+
+    entity = models.CoverArt(key_name=key_name,
+                             artist_name=artist_name,
+                             album_title=album_title)
+    try:
+        fm = lastfm.get_network()
+        fm_album = fm.get_album(artist_name, album_title)
+        entity.lastfm_sm_image_url = fm_album.get_cover_image(
+                                                    pylast.COVER_SMALL)
+        entity.lastfm_med_image_url = fm_album.get_cover_image(
+                                                    pylast.COVER_MEDIUM)
+        entity.lastfm_lg_image_url = fm_album.get_cover_image(
+                                                    pylast.COVER_LARGE)
+        entity.lastfm_xl_image_url = fm_album.get_cover_image(
+                                                    pylast.COVER_EXTRA_LARGE)
+        entity.found = bool(entity.lastfm_med_image_url or
+                            entity.lastfm_xl_image_url)
+    except pylast.WSError:
+        # Probably album not found
+        log.info('No Last FM cover art for %r / %r'
+                 % (artist_name, album_title))
+        entity.found = False
+    entity.lastfm_retrieval_time = datetime.now()
+    entity.put()
+    return _as_art(entity, entity.found)
@@ -0,0 +1,231 @@
+###
+### Copyright 2009 The Chicago Independent Radio Project
+### All Rights Reserved.
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###     http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+###
+
+
+"""Last FM web service plumbing for App Engine.
+
+pylast comes with a file based cache and opens a new connection for
+every call.  Importing this module makes every pylast.Network use a
+memcache cache backed by the datastore, a pool of keep-alive connections
+and a rate limiter instead.  Use get_network() to talk to Last FM.
+"""
+
+from __future__ import with_statement
+from datetime import datetime, timedelta
+import httplib
+import logging
+import socket
+import threading
+import time
+
+from google.appengine.api import memcache
+
+from common import dbconfig, expiry
+from djdb import models
+from djdb import pylast
+
+log = logging.getLogger(__name__)
+
+# How long responses are cached, by web service method.
+METHOD_TTLS = {
+    'album.getInfo': timedelta(days=7),
+    'artist.getInfo': timedelta(days=7),
+    'track.getInfo': timedelta(days=7),
+}
+DEFAULT_TTL = timedelta(days=1)
+
+# Last FM asks for no more than 5 calls per second.
+CALLS_PER_SECOND = 5
+
+METRICS_PREFIX = 'djdb.lastfm.'
+
+
+def _incr_metrics(offsets):
+    """Increments memcache counters; metrics never fail a call."""
+    try:
+        memcache.offset_multi(offsets, key_prefix=METRICS_PREFIX,
+                              initial_value=0)
+    except:
+        log.exception('IGNORED while recording metrics:')
+
+
+def get_metrics():
+    """Returns cache and upstream call counts for Last FM.
+
+    These are memcache counters so they reset whenever memcache is flushed.
+    """
+    stats = memcache.get_multi(['cache_hits', 'cache_misses',
+                                'upstream_calls', 'upstream_errors',
+                                'latency_ms', 'throttled'],
+                               key_prefix=METRICS_PREFIX)
+    hits = stats.get('cache_hits', 0)
+    misses = stats.get('cache_misses', 0)
+    calls = stats.get('upstream_calls', 0)
+    return {
+        'cache_hits': hits,
+        'cache_misses': misses,
+        'hit_ratio': (hits + misses) and float(hits) / (hits + misses),
+        'upstream_calls': calls,
+        'upstream_errors': stats.get('upstream_errors', 0),
+        'avg_latency_ms': calls and stats.get('latency_ms', 0) / calls,
+        'throttled': stats.get('throttled', 0),
+    }
+
+
+def get_ttl(method_name):
+    return METHOD_TTLS.get(method_name, DEFAULT_TTL)
+
+
+def _seconds(delta):
+    return delta.days * 86400 + delta.seconds
+
+
+class CacheBackend(object):
+    """pylast cache backend that keeps responses in memcache.
+
+    Responses are also saved as LastfmResponse entities so they survive
+    memcache evictions.  Expired responses are treated as missing.
+    """
+    key_prefix = 'djdb.lastfm.response.'
+
+    def get_xml(self, key):
+        xml = memcache.get(self.key_prefix + key)
+        if xml is None:
+            entity = models.LastfmResponse.get_by_key_name(key)
+            now = datetime.now()
+            if entity is not None and entity.expires > now:
+                xml = entity.xml
+                memcache.set(self.key_prefix + key, xml,
+                             time=_seconds(entity.expires - now))
+        _incr_metrics({xml is None and 'cache_misses' or 'cache_hits': 1})
+        return xml
+
+    def set_xml(self, key, xml_string, method_name=None):
+        ttl = get_ttl(method_name)
+        memcache.set(self.key_prefix + key, xml_string, time=_seconds(ttl))
+        try:
+            models.LastfmResponse(key_name=key,
+                                  method=method_name or '',
+                                  xml=xml_string,
+                                  expires=datetime.now() + ttl).put()
+        except:
+            # The memcache copy is still good.
+            log.exception('IGNORED while saving Last FM response')
+
+    def has_key(self, key):
+        return self.get_xml(key) is not None
+
+
+@expiry.expirer('lastfm_responses')
+def expired_responses(now):
+    return models.LastfmResponse.all(keys_only=True).filter('expires <', now)
+
+
+class KeepAliveTransport(object):
+    """pylast transport that reuses HTTP connections to Last FM.
+
+    Idle connections are pooled per host, up to max_idle of them.  A
+    reused connection the server has since closed is retried once on a
+    new connection.
+    """
+    max_idle = 4
+    timeout = 10  # seconds
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def reset(self):
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle = {}
+
+    def _checkout(self, host):
+        with self._lock:
+            conns = self._idle.get(host)
+            if conns:
+                return conns.pop(), True
+        return httplib.HTTPConnection(host, timeout=self.timeout), False
+
+    def _checkin(self, host, conn):
+        with self._lock:
+            conns = self._idle.setdefault(host, [])
+            if len(conns) < self.max_idle:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def post(self, host, path, body, headers):
+        started = time.time()
+        while True:
+            conn, reused = self._checkout(host)
+            try:
+                conn.request('POST', path, body=body, headers=headers)
+                response = conn.getresponse()
+                text = response.read()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if reused:
+                    continue
+                _incr_metrics({'upstream_calls': 1, 'upstream_errors': 1})
+                raise
+            break
+        if response.will_close:
+            conn.close()
+        else:
+            self._checkin(host, conn)
+        _incr_metrics({'upstream_calls': 1,
+                       'latency_ms': int((time.time() - started) * 1000)})
+        return text
+
+
+class RateLimiter(object):
+    """Spaces out Last FM calls from this instance.
+
+    At most calls_per_second calls are started each second; wait()
+    sleeps until the next call is allowed.
+    """
+
+    def __init__(self, calls_per_second=CALLS_PER_SECOND):
+        self.interval = 1.0 / calls_per_second
+        self._lock = threading.Lock()
+        self._next_call = 0
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            delay = self._next_call - now
+            self._next_call = max(now, self._next_call) + self.interval
+        if delay > 0:
+            _incr_metrics({'throttled': 1})
+            time.sleep(delay)
+
+
+cache_backend = CacheBackend()
+transport = KeepAliveTransport()
+rate_limiter = RateLimiter()
+
+pylast.Network.default_cache_backend = cache_backend
+pylast.Network.default_transport = transport
+pylast.Network.default_rate_limiter = rate_limiter
+
+
+def get_network():
+    """Returns a pylast.Network for Last FM with CHIRP's API key."""
+    return pylast.get_lastfm_network(api_key=dbconfig['lastfm.api_key'])
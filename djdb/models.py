@@ -24,10 +24,10 @@ import re
 from google.appengine.ext import db
 
 from auth.models import User
+from common import identity
 from common import sanitize_html
 from common import time_util
 from common.autoretry import AutoRetry
-from common import dbconfig
 from djdb import pylast
 
 # A list of standard doctypes.
@@ -332,7 +332,7 @@ class Album(db.Model):
 
     is_compilation = db.BooleanProperty(required=False, default=False)
 
-    album_artist = db.ReferenceProperty(Artist, required=False)
+    album_artist = identity.ReferenceProperty(Artist, required=False)
 
     num_tracks = db.IntegerProperty(required=True)
 
@@ -505,7 +505,8 @@ class Album(db.Model):
             return self.year
             
     def get_lastfm_image_urls(self):
-        fm = pylast.get_lastfm_network(api_key=dbconfig['lastfm.api_key'])
+        from djdb import lastfm  # lastfm imports this module.
+        fm = lastfm.get_network()
         fm_album = fm.get_album(self.artist_name, self.title)
         self.lastfm_sm_image_url = fm_album.get_cover_image(
                                                     pylast.COVER_SMALL)
@@ -519,6 +520,34 @@ class Album(db.Model):
         self.save()
 
 
+class CoverArt(db.Model):
+    """Cached Last FM cover art for an album that is not in the library.
+
+    Freeform playlist entries have no Album entity to hold cover art
+    URLs so they are kept here instead.  See djdb.cover_art for the
+    key naming scheme.  If found is False, Last FM had no cover art.
+    """
+    artist_name = db.StringProperty(required=False)
+    album_title = db.StringProperty(required=False)
+    found = db.BooleanProperty(default=False)
+    lastfm_sm_image_url = db.StringProperty(required=False)
+    lastfm_med_image_url = db.StringProperty(required=False)
+    lastfm_lg_image_url = db.StringProperty(required=False)
+    lastfm_xl_image_url = db.StringProperty(required=False)
+    lastfm_retrieval_time = db.DateTimeProperty(required=False)
+
+
+class LastfmResponse(db.Model):
+    """A cached Last FM web service response.
+
+    The key name is the pylast request's cache key.  This backs up the
+    memcache copy; see djdb.lastfm.CacheBackend.
+    """
+    method = db.StringProperty(required=True)
+    xml = db.TextProperty(required=True)
+    expires = db.DateTimeProperty(required=True)
+
+
 _CHANNEL_CHOICES = ("stereo", "joint_stereo", "dual_mono", "mono")
 
 
@@ -548,13 +577,13 @@ class Track(db.Model):
         not be returned in search results, and should be otherwise hidden
         from users when possible.
     """
-    album = db.ReferenceProperty(Album, required=True)
+    album = identity.ReferenceProperty(Album, required=True)
 
     title = db.StringProperty(required=True)
 
     pronunciation = db.StringProperty(required=False)
 
-    track_artist = db.ReferenceProperty(Artist, required=False)
+    track_artist = identity.ReferenceProperty(Artist, required=False)
 
     import_tags = db.StringListProperty()
 
@@ -694,10 +723,10 @@ class Document(db.Model):
     that is attached to a specific djdb object.
     """
     # The object that this document's text is the subject of.
-    subject = db.ReferenceProperty(required=True)
+    subject = identity.ReferenceProperty(required=True)
 
     # The user who wrote the text.
-    author = db.ReferenceProperty(User, required=False)
+    author = identity.ReferenceProperty(User, required=False)
     
     # If the author is not a user, then use this field.
     author_name = db.StringProperty(required=False)
@@ -779,10 +808,10 @@ class TagEdit(db.Model):
     the various TagEdits.
     """
     # The object being tagged.
-    subject = db.ReferenceProperty(required=True)
+    subject = identity.ReferenceProperty(required=True)
 
     # The user who made this edit.
-    author = db.ReferenceProperty(User, required=True)
+    author = identity.ReferenceProperty(User, required=True)
 
     # When this document was created.
     timestamp = db.DateTimeProperty(required=True, auto_now=True)
@@ -247,6 +247,12 @@ class Network(object):
         A music social network website that is Last.fm or one exposing a Last.fm compatible API
     """
     
+    # Used by every new Network; see enable_caching(), set_transport()
+    # and set_rate_limiter() to change them for one Network.
+    default_cache_backend = None
+    default_transport = None
+    default_rate_limiter = None
+    
     def __init__(self, name, homepage, ws_server, api_key, api_secret, session_key, submission_server, username, password_hash,
                     domain_names, urls):
         """
@@ -283,7 +289,9 @@ class Network(object):
         self.domain_names = domain_names
         self.urls = urls
         
-        self.cache_backend = None
+        self.cache_backend = Network.default_cache_backend
+        self.transport = Network.default_transport
+        self.rate_limiter = Network.default_rate_limiter
         self.proxy_enabled = False
         self.proxy = None
         self.last_call_time = 0
@@ -460,15 +468,19 @@ class Network(object):
         
         return self.proxy
         
-    def enable_caching(self, file_path = None):
+    def enable_caching(self, file_path = None, backend = None):
         """Enables caching request-wide for all cachable calls.
-        In choosing the backend used for caching, it will try _SqliteCacheBackend first if
-        the module sqlite3 is present. If not, it will fallback to _ShelfCacheBackend which uses shelve.Shelf objects.
+        Unless a backend is given, _ShelfCacheBackend which uses shelve.Shelf objects is used.
         
         * file_path: A file path for the backend storage file. If 
         None set, a temp file would probably be created, according the backend.
+        * backend: An object with the same methods as _ShelfCacheBackend.
         """
         
+        if backend is not None:
+            self.cache_backend = backend
+            return
+        
         if not file_path:
             file_path = tempfile.mktemp(prefix="pylast_tmp_")
         
@@ -487,6 +499,17 @@ class Network(object):
     def _get_cache_backend(self):
         
         return self.cache_backend
+    
+    def set_transport(self, transport):
+        """Sends web service calls through transport.post(host, path, body, headers)
+        which returns the response body. None opens a new connection for each call."""
+        
+        self.transport = transport
+    
+    def set_rate_limiter(self, rate_limiter):
+        """Calls rate_limiter.wait() before each web service call. None disables it."""
+        
+        self.rate_limiter = rate_limiter
         
     def search_for_album(self, album_name):
         """Searches for an album by its name. Returns a AlbumSearch object.
@@ -660,9 +683,10 @@ class _ShelfCacheBackend(object):
         self.shelf = shelve.open(file_path)
     
     def get_xml(self, key):
-        return self.shelf[key]
+        """Returns the cached response or None."""
+        return self.shelf.get(key)
     
-    def set_xml(self, key, xml_string):
+    def set_xml(self, key, xml_string, method_name = None):
         self.shelf[key] = xml_string
     
     def has_key(self, key):
@@ -705,6 +729,7 @@ class _Request(object):
         
         self.params = params
         self.network = network
+        self.method_name = method_name
         
         (self.api_key, self.api_secret, self.session_key) = network._get_ws_auth()
         
@@ -758,11 +783,13 @@ class _Request(object):
     def _get_cached_response(self):
         """Returns a file object of the cached response."""
         
-        if not self._is_cached():
+        cache_key = self._get_cache_key()
+        response = self.cache.get_xml(cache_key)
+        if response is None:
             response = self._download_response()
-            self.cache.set_xml(self._get_cache_key(), response)
+            self.cache.set_xml(cache_key, response, self.method_name)
         
-        return self.cache.get_xml(self._get_cache_key())
+        return response
     
     def _is_cached(self):
         """Returns True if the request is already in cache."""
@@ -773,7 +800,8 @@ class _Request(object):
         """Returns a response body string from the server."""
         
         # Delay the call if necessary
-        #self.network._delay_call()    # enable it if you want.
+        if self.network.rate_limiter:
+            self.network.rate_limiter.wait()
         
         data = []
         for name in self.params.keys():
@@ -792,12 +820,15 @@ class _Request(object):
             conn = httplib.HTTPConnection(host = self._get_proxy()[0], port = self._get_proxy()[1])
             conn.request(method='POST', url="http://" + HOST_NAME + HOST_SUBDIR, 
                 body=data, headers=headers)
+            response_text = _unicode(conn.getresponse().read())
+        elif self.network.transport:
+            response_text = _unicode(self.network.transport.post(
+                HOST_NAME, HOST_SUBDIR, data, headers))
         else:
             conn = httplib.HTTPConnection(host=HOST_NAME)
             conn.request(method='POST', url=HOST_SUBDIR, body=data, headers=headers)
+            response_text = _unicode(conn.getresponse().read())
         
-        response = conn.getresponse()
-        response_text = _unicode(response.read())
         self._check_response_for_errors(response_text)
         return response_text
         
@@ -25,12 +25,20 @@ import unicodedata
 from google.appengine.ext import db
 
 from djdb import models
+from common import expiry
 from common.autoretry import AutoRetry
 
 # All search data used by this code is marked with this generation.
 _GENERATION = 1
 
 
+@expiry.expirer('search_matches')
+def old_search_matches(now):
+    """Search data from previous generations."""
+    return (models.SearchMatches.all(keys_only=True)
+            .filter('generation <', _GENERATION))
+
+
 ###
 ### Text Normalization
 ###
@@ -0,0 +1,102 @@
+from __future__ import with_statement
+###
+### Copyright 2009 The Chicago Independent Radio Project
+### All Rights Reserved.
+###
+### Licensed under the Apache License, Version 2.0 (the 'License');
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###     http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an 'AS IS' BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+###
+
+from datetime import datetime, timedelta
+import unittest
+
+import fudge
+import fudge.inspector
+from google.appengine.api import memcache
+
+from common import dbconfig
+from djdb import cover_art, models, pylast
+
+
+class CoverArtTestCase(unittest.TestCase):
+
+    def setUp(self):
+        dbconfig['lastfm.api_key'] = 'SEKRET_LASTFM_KEY'
+        fudge.clear_expectations()
+
+    def tearDown(self):
+        fudge.clear_expectations()
+        assert memcache.flush_all()
+        for art in models.CoverArt.all():
+            art.delete()
+
+    def fake_network(self, url='http://last.fm/cover.jpg'):
+        fm_getter = fudge.Fake('get_lastfm_network', expect_call=True)
+        (fm_getter.returns_fake()
+                  .expects('get_album')
+                  .with_args(u'Sun Ra', u'Lanquidity')
+                  .returns_fake()
+                  .provides('get_cover_image')
+                  .returns(url))
+        return fm_getter
+
+    @fudge.patch('djdb.cover_art.taskqueue.add')
+    def test_lookup_queues_refresh(self, fake_add):
+        fake_add.expects_call().with_args(
+                                    url='/api/_refresh_cover_art',
+                                    queue_name='lastfm',
+                                    name=fudge.inspector.arg.any(),
+                                    params={'artist': 'Sun Ra',
+                                            'album': 'Lanquidity'})
+        # Nothing is known yet and Last FM is not contacted.
+        self.assertEqual(cover_art.lookup(u'Sun Ra', u'Lanquidity'), None)
+
+    @fudge.patch('djdb.cover_art.taskqueue.add')
+    def test_lookup_after_refresh(self, fake_add):
+        fake_add.is_callable().times_called(0)
+        with fudge.patched_context('djdb.pylast', 'get_lastfm_network',
+                                   self.fake_network()):
+            cover_art.refresh(u'Sun Ra', u'Lanquidity')
+        assert memcache.flush_all()
+        # Freeform album names are normalized.
+        art = cover_art.lookup(u'sun  ra', u'LANQUIDITY')
+        self.assertEqual(art['found'], True)
+        self.assertEqual(art['xl'], 'http://last.fm/cover.jpg')
+
+    def test_not_found_is_cached(self):
+        fm_getter = fudge.Fake('get_lastfm_network', expect_call=True)
+        (fm_getter.returns_fake()
+                  .expects('get_album')
+                  .times_called(1)
+                  .raises(pylast.WSError('', '', 'Album not found')))
+        with fudge.patched_context('djdb.pylast', 'get_lastfm_network',
+                                   fm_getter):
+            art = cover_art.refresh(u'Sun Ra', u'Lanquidity')
+            self.assertEqual(art['found'], False)
+            # Not asked again until NOT_FOUND_TTL has passed.
+            art = cover_art.refresh(u'Sun Ra', u'Lanquidity')
+            self.assertEqual(art['found'], False)
+        fudge.verify()
+
+    def test_stale_art_is_refreshed(self):
+        with fudge.patched_context('djdb.pylast', 'get_lastfm_network',
+                                   self.fake_network('http://last.fm/1.jpg')):
+            cover_art.refresh(u'Sun Ra', u'Lanquidity')
+        art = models.CoverArt.get_by_key_name(
+                    cover_art.get_key_name(u'Sun Ra', u'Lanquidity'))
+        art.lastfm_retrieval_time = (datetime.now() - cover_art.FOUND_TTL
+                                     - timedelta(minutes=1))
+        art.put()
+        with fudge.patched_context('djdb.pylast', 'get_lastfm_network',
+                                   self.fake_network('http://last.fm/2.jpg')):
+            art = cover_art.refresh(u'Sun Ra', u'Lanquidity')
+        self.assertEqual(art['med'], 'http://last.fm/2.jpg')
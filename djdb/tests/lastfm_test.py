@@ -0,0 +1,188 @@
+###
+### Copyright 2009 The Chicago Independent Radio Project
+### All Rights Reserved.
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###     http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+###
+
+
+from __future__ import with_statement
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from datetime import datetime, timedelta
+from SocketServer import ThreadingMixIn
+import threading
+import unittest
+
+import fudge
+from google.appengine.api import memcache
+
+from common import expiry
+from djdb import lastfm, models, pylast
+
+ALBUM_INFO = """<?xml version="1.0" encoding="utf-8"?>
+<lfm status="ok">
+<album>
+  <name>Lanquidity</name>
+  <artist>Sun Ra</artist>
+  <image size="small">http://last.fm/sm.jpg</image>
+  <image size="medium">http://last.fm/med.jpg</image>
+  <image size="large">http://last.fm/lg.jpg</image>
+  <image size="extralarge">http://last.fm/xl.jpg</image>
+</album>
+</lfm>"""
+
+NOT_FOUND = """<?xml version="1.0" encoding="utf-8"?>
+<lfm status="failed">
+<error code="6">Album not found</error>
+</lfm>"""
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class LastfmStandIn(object):
+    """Local HTTP server standing in for the Last FM web service.
+
+    It answers every call with self.response over keep-alive connections
+    and records the client address of each call.
+    """
+
+    def __init__(self):
+        self.response = ALBUM_INFO
+        self.clients = []
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                stand_in.clients.append(self.client_address)
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/xml')
+                self.send_header('Content-Length', len(stand_in.response))
+                self.end_headers()
+                self.wfile.write(stand_in.response)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    @property
+    def host(self):
+        return '127.0.0.1:%s' % self.server.server_port
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class LastfmTestCase(unittest.TestCase):
+
+    def setUp(self):
+        assert memcache.flush_all()
+        self.stand_in = LastfmStandIn()
+        self.network = pylast.get_lastfm_network(api_key='SEKRET')
+        self.network.ws_server = (self.stand_in.host, '/2.0/')
+        self.network.set_rate_limiter(None)
+
+    def tearDown(self):
+        lastfm.transport.reset()
+        self.stand_in.stop()
+        for response in models.LastfmResponse.all():
+            response.delete()
+
+    def get_cover(self):
+        album = self.network.get_album(u'Sun Ra', u'Lanquidity')
+        return album.get_cover_image(pylast.COVER_MEDIUM)
+
+    def test_defaults(self):
+        self.assertEqual(self.network.cache_backend, lastfm.cache_backend)
+        self.assertEqual(self.network.transport, lastfm.transport)
+
+    def test_cached_response(self):
+        self.assertEqual(self.get_cover(), 'http://last.fm/med.jpg')
+        self.assertEqual(self.get_cover(), 'http://last.fm/med.jpg')
+        self.assertEqual(len(self.stand_in.clients), 1)
+        metrics = lastfm.get_metrics()
+        self.assertEqual(metrics['upstream_calls'], 1)
+        self.assertEqual(metrics['cache_hits'], 1)
+        self.assertEqual(metrics['cache_misses'], 1)
+        self.assertEqual(metrics['hit_ratio'], 0.5)
+
+    def test_datastore_fallback(self):
+        self.get_cover()
+        assert memcache.flush_all()
+        self.assertEqual(self.get_cover(), 'http://last.fm/med.jpg')
+        self.assertEqual(len(self.stand_in.clients), 1)
+        response = models.LastfmResponse.all().get()
+        self.assertEqual(response.method, 'album.getInfo')
+        assert response.expires > datetime.now() + timedelta(days=6)
+
+    def test_expired_response(self):
+        self.get_cover()
+        response = models.LastfmResponse.all().get()
+        response.expires = datetime.now() - timedelta(minutes=1)
+        response.put()
+        assert memcache.flush_all()
+        self.get_cover()
+        self.assertEqual(len(self.stand_in.clients), 2)
+
+    def test_expire_responses(self):
+        now = datetime.now()
+        for name, expires in (('old', now - timedelta(minutes=1)),
+                              ('new', now + timedelta(days=1))):
+            models.LastfmResponse(key_name=name, method='album.getInfo',
+                                  xml=ALBUM_INFO, expires=expires).put()
+        expiry.run_batch('lastfm_responses')
+        self.assertEqual([r.key().name()
+                          for r in models.LastfmResponse.all()], ['new'])
+
+    def test_errors_are_not_cached(self):
+        self.stand_in.response = NOT_FOUND
+        for i in range(2):
+            self.assertRaises(pylast.WSError, self.get_cover)
+        self.assertEqual(len(self.stand_in.clients), 2)
+        self.assertEqual(models.LastfmResponse.all().count(), 0)
+
+    def test_keep_alive(self):
+        self.network.disable_caching()
+        for i in range(3):
+            self.get_cover()
+        self.assertEqual(len(self.stand_in.clients), 3)
+        # All calls went over the same connection.
+        self.assertEqual(len(set(self.stand_in.clients)), 1)
+
+    def test_reconnect(self):
+        self.network.disable_caching()
+        self.get_cover()
+        # Server dropped the idle connection.
+        for conns in lastfm.transport._idle.values():
+            for conn in conns:
+                conn.sock.close()
+        self.assertEqual(self.get_cover(), 'http://last.fm/med.jpg')
+        self.assertEqual(lastfm.get_metrics()['upstream_errors'], 0)
+
+    @fudge.patch('djdb.lastfm.time.sleep')
+    def test_rate_limiter(self, sleep):
+        sleep.expects_call().times_called(1)
+        self.network.set_rate_limiter(lastfm.RateLimiter(calls_per_second=1))
+        self.network.disable_caching()
+        self.get_cover()
+        self.get_cover()
+        self.assertEqual(lastfm.get_metrics()['throttled'], 1)
@@ -29,7 +29,8 @@ from django.template import loader, Context, RequestContext
 
 from auth.decorators import require_role
 from auth import roles
-from common import dbconfig, sanitize_html, pager
+from auth.models import KeyStorage
+from common import identity, sanitize_html, pager
 from common.autoretry import AutoRetry
 from common.time_util import chicago_now
 from common.utilities import as_json
@@ -37,12 +38,13 @@ from djdb import models
 from djdb import search
 from djdb import review
 from djdb import comment
+from djdb import cover_art
 from djdb import forms
 from djdb.models import Album
+from playlists.middleware import from_studio
 from playlists.models import chirp_playlist_key, PlaylistEvent, PlaylistTrack
 from playlists.views import PlaylistEventView
 from datetime import datetime, timedelta
-import djdb.pylast as pylast
 import random
 import re
 import tag_util
@@ -63,6 +65,11 @@ def context(*args, **kw):
     return ctx
 
 
+def _pager_query(model):
+    """A CursorPagerQuery whose bookmarks are signed with the site key."""
+    return pager.CursorPagerQuery(model, KeyStorage.get().hmac_key)
+
+
 def fetch_activity(num=None, start_dt=None, days=None):
     default_num = 10
     activity = []
@@ -73,6 +80,7 @@ def fetch_activity(num=None, start_dt=None, days=None):
     else:
         num_reviews = num
     revs = review.fetch_recent(num_reviews, start_dt=start_dt, days=days)
+    identity.prefetch(revs, 'subject', 'author')
     for rev in revs:
         dt = rev.created_display.strftime('%Y-%m-%d %H:%M')
         if len(rev.text) > 100:
@@ -98,6 +106,7 @@ def fetch_activity(num=None, start_dt=None, days=None):
         else:
             num_comments = num - len(activity)        
         comments = comment.fetch_recent(num_comments, start_dt=start_dt, days=days)
+        identity.prefetch(comments, 'subject', 'author')
         for com in comments:
             dt = com.created_display.strftime('%Y-%m-%d %H:%M')
             if len(com.text) > 100:
@@ -123,6 +132,10 @@ def fetch_activity(num=None, start_dt=None, days=None):
         else:
             num_tags = num - len(activity)
         tag_edits = tag_util.fetch_recent(num_tags, start_dt=start_dt, days=days)
+        identity.prefetch(tag_edits, 'subject', 'author')
+        # Each line shows the album of the tagged track.
+        identity.prefetch([e.subject for e in tag_edits
+                           if e.subject.kind() == 'Track'], 'album')
         for tag_edit in tag_edits:
             dt = tag_edit.timestamp_display.strftime('%Y-%m-%d %H:%M')
             for tag in tag_edit.added:
@@ -187,6 +200,7 @@ def fetch_activity(num=None, start_dt=None, days=None):
     
     return activity_list
     
+@from_studio
 def landing_page(request, ctx_vars=None):
     template = loader.get_template('djdb/landing_page.html')
     if ctx_vars is None : ctx_vars = {}
@@ -403,9 +417,10 @@ def tracks_played_page(request, user_id, ctx_vars=None):
             order = request.POST.get('order')
             bookmark = request.POST.get('bookmark')
     dt = datetime(from_year, from_month, from_day, 0, 0, 0)
-    query = pager.PagerQuery(PlaylistEvent).filter('playlist =', chirp_playlist_key()) \
-                                           .filter('selector =', user.key()) \
-                                           .filter('established >=', dt)
+    query = _pager_query(PlaylistEvent) \
+                        .filter('playlist =', chirp_playlist_key()) \
+                        .filter('selector =', user.key()) \
+                        .filter('established >=', dt)
     query.order("-established")
     prev, events, next = query.fetch(page_size, bookmark)
     ctx_vars["playlist_events"] = get_played_tracks(events)
@@ -1034,7 +1049,7 @@ def browse_page(request, entity_kind, start_char, ctx_vars=None):
         prev = None
         next = None
     else:
-        query = pager.PagerQuery(model)
+        query = _pager_query(model)
         if start_char == '0':
             query.filter("%s >=" % field, "0")
             query.filter("%s <" % field, u"9" + u"\uffff")
@@ -1054,6 +1069,8 @@ def browse_page(request, entity_kind, start_char, ctx_vars=None):
             query.filter("revoked =", False)
         query.order(field)
         prev, items, next = query.fetch(page_size, bookmark)
+        ctx_vars["total"] = query.approximate_count()
+        ctx_vars["total_is_capped"] = ctx_vars["total"] == query.count_limit
     
     ctx_vars["form"] = form
     ctx_vars["bookmark"] = bookmark
@@ -1079,7 +1096,7 @@ def new_browse_page(request):
     field = 'title'
     page_size = 10
     bookmark = None
-    query = pager.PagerQuery(models.Album)
+    query = _pager_query(models.Album)
     if start_char == '0':
         query.filter("%s >=" % field, "0")
         query.filter("%s <" % field, u"9" + u"\uffff")
@@ -1099,15 +1116,7 @@ def new_browse_page(request):
     prev, items, next = query.fetch(page_size, bookmark)
 
     album = items[0]
-    try:
-        lastfm = pylast.get_lastfm_network(api_key='c2dedca7961e64bd318894ae80d161b7')
-        lastfm_album = lastfm.get_album('PJ Harvey', 'Dry')
-        ctx_vars["album_cover_m"] = lastfm_album.get_cover_image(pylast.COVER_MEDIUM)
-        ctx_vars["album_cover_xl"] = lastfm_album.get_cover_image(pylast.COVER_EXTRA_LARGE)
-    except:
-        ctx_vars["album_cover_m"] = "/media/common/img/no_cover_art.png"
-        ctx_vars["album_cover_xl"] = "/media/common/img/no_cover_art.png"
-        pass
+    _set_album_cover(ctx_vars, album)
 
     ctx_vars["album"] = album
     ctx_vars["album_tags"] = []
@@ -1155,6 +1164,10 @@ def track_search_for_autocomplete(request):
     
     response = http.HttpResponse(mimetype="text/plain")
     start_dt = datetime.now() - timedelta(seconds=LAST_PLAYED_SECONDS)
+    identity.prefetch(matching_entities, 'album', 'track_artist')
+    if artist_key:
+        identity.prefetch([t.album for t in matching_entities],
+                          'album_artist')
     for track in matching_entities:
         if artist_key:
             # skip this track if it doesn't match the 
@@ -1202,6 +1215,21 @@ def _get_matches_for_partial_entity_search(query, entity_kind):
     else:
         return []
 
+def _set_album_cover(ctx_vars, album):
+    """Sets album cover image URLs from cached cover art, if there is any."""
+    art = None
+    try:
+        art = cover_art.lookup(album.artist_name, album.title, album=album)
+    except:
+        log.exception('IGNORED while looking up cover art')
+    if art and art['found']:
+        ctx_vars["album_cover_m"] = art['med']
+        ctx_vars["album_cover_xl"] = art['xl']
+    else:
+        ctx_vars["album_cover_m"] = "/media/common/img/no_cover_art.png"
+        ctx_vars["album_cover_xl"] = "/media/common/img/no_cover_art.png"
+
+
 def _get_album_or_404(album_id_str):
     if not album_id_str.isdigit():
         return http.HttpResponse(status=404)
@@ -1214,6 +1242,7 @@ def _get_album_or_404(album_id_str):
         return http.HttpResponse(status=404)
     return album
 
+@from_studio
 def album_info_page(request, album_id_str, ctx_vars=None):
     album = _get_album_or_404(album_id_str)
     template = loader.get_template("djdb/album_info_page.html")
@@ -1221,15 +1250,7 @@ def album_info_page(request, album_id_str, ctx_vars=None):
     if ctx_vars is None:
         ctx_vars = {}
 
-    try:
-        lastfm = pylast.get_lastfm_network(api_key=dbconfig['lastfm.api_key'])
-        lastfm_album = lastfm.get_album(album.artist_name, album.title)
-        ctx_vars["album_cover_m"] = lastfm_album.get_cover_image(pylast.COVER_MEDIUM)
-        ctx_vars["album_cover_xl"] = lastfm_album.get_cover_image(pylast.COVER_EXTRA_LARGE)
-    except:
-        ctx_vars["album_cover_m"] = "/media/common/img/no_cover_art.png"
-        ctx_vars["album_cover_xl"] = "/media/common/img/no_cover_art.png"
-        pass
+    _set_album_cover(ctx_vars, album)
 
     ctx_vars["album"] = album
     ctx_vars["album_tags"] = []
@@ -1665,6 +1686,7 @@ def _sort_crate_items(sort_by, key):
             return crate_item.duration
     return None
 
+@from_studio
 def crate_page(request, crate_key=None, ctx_vars=None):
     if ctx_vars is None:
         ctx_vars = {}
@@ -97,9 +97,14 @@ On the server, all you have to do is implement a worker method::
         response = HttpResponse(content_type='text/csv; charset=utf-8')
         response.write(csv_file)
         return response
-        
+
+Job results are kept in one entity so a worker that builds a large file
+should store it with append_output() instead and stream it back with
+iter_output() in the product.
 """
 
+import uuid
+
 
 worker_registry = {}
 
@@ -180,3 +185,45 @@ def get_producer(job_name):
         raise LookupError(
             "No producer has been registered for job %r" % job_name)
     return worker_registry['producers'][job_name]
+
+
+# Chunks fetched per batch get by iter_output().
+OUTPUT_BATCH_SIZE = 20
+
+
+def _output_key_name(output_id, n):
+    return '%s:%06d' % (output_id, n)
+
+
+def append_output(results, data):
+    """Stores data as the next chunk of a job's output.
+
+    **results**
+    The worker's results dict.  The output ID and the number of chunks
+    are kept in it under 'output'.
+    """
+    from jobs.models import JobOutput
+    output = results.setdefault('output', {'id': uuid.uuid4().hex,
+                                           'chunks': 0})
+    JobOutput(key_name=_output_key_name(output['id'], output['chunks']),
+              data=data).put()
+    output['chunks'] += 1
+
+
+def iter_output(results):
+    """Yields the chunks stored by append_output() in order."""
+    from google.appengine.ext import db
+    from jobs.models import JobOutput
+    output = results.get('output')
+    if output is None:
+        return
+    for start in range(0, output['chunks'], OUTPUT_BATCH_SIZE):
+        end = min(start + OUTPUT_BATCH_SIZE, output['chunks'])
+        keys = [db.Key.from_path('JobOutput',
+                                 _output_key_name(output['id'], n))
+                for n in range(start, end)]
+        for chunk in db.get(keys):
+            if chunk is None:
+                raise LookupError('Job output %s is missing chunks; it may '
+                                  'have expired' % output['id'])
+            yield chunk.data
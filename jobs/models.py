@@ -23,4 +23,9 @@ class Job(db.Model):
     job_name = db.StringProperty(required=True)
     started = db.DateTimeProperty(auto_now_add=True)
     finished = db.DateTimeProperty()
-    result = db.TextProperty()
\ No newline at end of file
+    result = db.TextProperty()
+
+class JobOutput(db.Model):
+    """A chunk of a job's output; see jobs.append_output()."""
+    data = db.BlobProperty()
+    created = db.DateTimeProperty(auto_now_add=True)
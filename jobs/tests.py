@@ -28,7 +28,7 @@ from nose.tools import eq_
 
 from auth import roles
 import jobs
-from jobs.models import Job
+from jobs.models import Job, JobOutput
 from jobs import worker_registry, job_worker, job_product
 
 
@@ -77,6 +77,8 @@ class JobTestCase(object):
 def teardown_data():
     for ob in Job.all():
         ob.delete()
+    for ob in JobOutput.all():
+        ob.delete()
     jobs._reset_registry()
 
 class TestJobModel(TestCase):
@@ -92,6 +94,31 @@ class TestJobModel(TestCase):
     def tearDown(self):
         teardown_data()
 
+
+class TestJobOutput(TestCase):
+
+    def tearDown(self):
+        teardown_data()
+
+    def test_chunks(self):
+        results = {}
+        self.assertEqual(list(jobs.iter_output(results)), [])
+        for i in range(jobs.OUTPUT_BATCH_SIZE + 2):
+            jobs.append_output(results, 'chunk %s\n' % i)
+        self.assertEqual(results['output']['chunks'],
+                         jobs.OUTPUT_BATCH_SIZE + 2)
+        self.assertEqual(''.join(jobs.iter_output(results)),
+                         ''.join('chunk %s\n' % i for i in
+                                 range(jobs.OUTPUT_BATCH_SIZE + 2)))
+
+    def test_missing_chunk(self):
+        results = {}
+        jobs.append_output(results, 'one')
+        for chunk in JobOutput.all():
+            chunk.delete()
+        self.assertRaises(LookupError, list, jobs.iter_output(results))
+
+
 class JobSelfTestCase(DjangoTestCase):
     
     def tearDown(self):
@@ -219,14 +246,16 @@ class TestJobs(JobSelfTestCase):
         job.started = datetime.datetime.now() - timedelta(days=3)
         job.save()
         old_job_key = job.key()
-        
-        response = self.client.post(reverse('jobs.start'), {
-            'job_name': 'counter'
-        })
-        json_response = simplejson.loads(response.content)
-        self.assert_json_success(json_response)
-        
+        new_job = Job(job_name='counter')
+        new_job.save()
+
+        response = self.client.get(reverse('common.start_expiry',
+                                           args=['jobs']),
+                                   HTTP_X_APPENGINE_CRON='true')
+        self.assertEqual(response.status_code, 200)
+
         self.assertEqual(Job.get(old_job_key), None)
+        assert Job.get(new_job.key()) is not None
 
     
 class TestJobsWithParams(JobSelfTestCase):
@@ -17,7 +17,6 @@
 ###
 
 import logging
-import datetime
 from datetime import timedelta
 import traceback
 
@@ -25,8 +24,9 @@ from django.conf import settings
 from django.utils import simplejson
 from django.http import Http404
 
+from common import expiry
 from common.utilities import as_json
-from jobs.models import Job
+from jobs.models import Job, JobOutput
 from jobs import get_worker, get_producer
 
 log = logging.getLogger()
@@ -40,17 +40,22 @@ def init_jobs():
          __import__(path)  # registers the job workers
 
 
-def reap_dead_jobs():
-    q = Job.all().filter("started <",
-                         datetime.datetime.now() - timedelta(days=2))
-    for job in q:
-        job.delete()
+# Dead jobs and their output are deleted by cron; see cron.yaml.
+@expiry.expirer('jobs')
+def dead_jobs(now):
+    return Job.all(keys_only=True).filter(
+                "started <", now - timedelta(days=2))
+
+
+@expiry.expirer('job_output')
+def dead_job_output(now):
+    return JobOutput.all(keys_only=True).filter(
+                "created <", now - timedelta(days=2))
 
 
 def start_job(request):
     init_jobs()
     # TODO(kumar) check for already running jobs
-    reap_dead_jobs()
     job_name = request.POST['job_name']
     job = Job(job_name=job_name)
     job.put()
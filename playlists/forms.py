@@ -111,7 +111,7 @@ class PlaylistTrackForm(forms.Form):
             'notes': trk.notes,
             'key': str(trk.key()),
             'categories': list(trk.categories),
-            'selector_key': str(trk.selector.key()),
+            'selector_key': str(trk.selector_key),
             'established_display': trk.established.timetuple()[0:7]
         }, 30)
 
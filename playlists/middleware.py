@@ -17,71 +17,187 @@
 
 """Middleware for CHIRP's playlists system."""
 
-from django import http
-from common.models import DBConfig
 import logging
 
+from django.utils.decorators import decorator_from_middleware
+
+from common.models import DBConfig
+
 dbconfig = DBConfig()
 log = logging.getLogger()
 
+_BITS = {4: 32, 6: 128}
+
+
+def _parse_ipv4(text):
+    parts = text.split('.')
+    if len(parts) != 4:
+        raise ValueError('Bad IPv4 address %r' % text)
+    n = 0
+    for part in parts:
+        byte = int(part)
+        if not 0 <= byte <= 255:
+            raise ValueError('Bad IPv4 address %r' % text)
+        n = (n << 8) | byte
+    return n
+
+
+def _parse_ipv6(text):
+    # Drop any zone index, as in fe80::1%eth0.
+    text = text.split('%')[0]
+    if text.count('::') > 1:
+        raise ValueError('Bad IPv6 address %r' % text)
+
+    def groups(part):
+        if not part:
+            return []
+        words = part.split(':')
+        result = []
+        for i, word in enumerate(words):
+            if '.' in word and i == len(words) - 1:
+                n = _parse_ipv4(word)
+                result.extend([n >> 16, n & 0xffff])
+            elif 1 <= len(word) <= 4:
+                result.append(int(word, 16))
+            else:
+                raise ValueError('Bad IPv6 address %r' % text)
+        return result
+
+    head, sep, tail = text.partition('::')
+    head, tail = groups(head), groups(tail)
+    missing = 8 - len(head) - len(tail)
+    if (sep and missing < 1) or (not sep and missing != 0):
+        raise ValueError('Bad IPv6 address %r' % text)
+    n = 0
+    for word in head + [0] * missing + tail:
+        n = (n << 16) | word
+    return n
+
+
+def parse_ip(text):
+    """Returns (version, address as an int) for an IPv4 or IPv6 address.
+
+    IPv4 addresses mapped into IPv6, like ::ffff:10.0.0.1, are returned
+    as IPv4.  Raises ValueError for anything else.
+    """
+    if ':' not in text:
+        return 4, _parse_ipv4(text)
+    n = _parse_ipv6(text)
+    if n >> 32 == 0xffff:
+        return 4, n & 0xffffffff
+    return 6, n
+
+
+class NetworkSet(object):
+    """A compiled set of networks such as '10.0.0.0/24, 2001:db8::/32'.
+
+    Addresses without a prefix length match exactly.  Networks are
+    grouped by prefix length so a lookup costs one set lookup per
+    distinct prefix length.
+    """
+
+    def __init__(self, spec):
+        # (version, bits to drop) -> set of network numbers
+        self._networks = {}
+        for entry in spec.split(','):
+            entry = entry.strip()
+            if not entry:
+                continue
+            address, _, length = entry.partition('/')
+            try:
+                version, n = parse_ip(address.strip())
+                bits = _BITS[version]
+                length = int(length) if length else bits
+                if not 0 <= length <= bits:
+                    raise ValueError('Bad prefix length %s' % length)
+            except ValueError, exc:
+                log.error('Ignoring studio network %r: %s' % (entry, exc))
+                continue
+            shift = bits - length
+            self._networks.setdefault((version, shift), set()).add(n >> shift)
+        self._lookups = sorted(self._networks.items())
+
+    def __contains__(self, address):
+        try:
+            version, n = parse_ip(address)
+        except ValueError:
+            return False
+        for (net_version, shift), networks in self._lookups:
+            if net_version == version and (n >> shift) in networks:
+                return True
+        return False
+
+
+# The last studio network config and its compiled NetworkSet.
+_compiled = (None, NetworkSet(''))
+
+
+def studio_networks(spec):
+    """Returns the NetworkSet for spec, compiling it only when it changes.
+    """
+    global _compiled
+    compiled_spec, networks = _compiled
+    if spec != compiled_spec:
+        networks = NetworkSet(spec)
+        _compiled = (spec, networks)
+    return networks
+
+
 class FromStudioMiddleware(object):
     """Manage the request.is_from_studio based on IP address and POST override
     variables.
 
     People should only submit new items to the playlist if they are in the
-    studio. This is managed by a list of IP addresses in the Config entity. If
-    someone is not in the studio they are presented with a warning and
-    override checkbox. The playlist view should only process a request if
-    request.is_in_studio is True.
+    studio. This is managed by a list of IP addresses and CIDR networks,
+    IPv4 or IPv6, in the Config entity. If someone is not in the studio
+    they are presented with a warning and override checkbox. The playlist
+    view should only process a request if request.is_from_studio is True.
+
+    This only runs for the views that need it; see from_studio.
 
     NOTE: App Engine will construct this middleware object then hold it in
-    memory while serving multiple requests sequentially.
+    memory while serving multiple requests, so per-request state is kept
+    on the request.
     """
 
     DB_KEY = 'chirp.studio_ip_range'
     COOKIE_NAME = 'is_from_studio'
 
-    def __init__(self):
-        self._reset()
-
-    def _reset(self):
-        self.is_from_studio = False
-        self.set_cookie = False
-
     def process_request(self, request):
-        self._reset()
-        studio_ip_range = []
+        request.is_from_studio = False
+        request.set_studio_cookie = False
         current_user_ip = request.META.get('REMOTE_ADDR', '')
         post_val_override = request.POST.get('is_from_studio_override')
 
         if request.COOKIES.get(self.COOKIE_NAME) == 'override':
-            self.is_from_studio = True
-            log.info('Found %s cookie.' % self.COOKIE_NAME)
+            request.is_from_studio = True
+            log.debug('Found %s cookie.' % self.COOKIE_NAME)
         else:
             try:
-                # chirp_studio_ip_range is comma delimited string
-                studio_ip_range = dbconfig[self.DB_KEY].split(',')
+                # A comma delimited string of addresses and networks.
+                networks = studio_networks(dbconfig[self.DB_KEY])
             except KeyError:
                 log.error("Could not find key '%s' in dbconfig." % self.DB_KEY)
             else:
-                log.info('current_user_ip is %s' % current_user_ip)
-                log.info('studio_ip_range is %s' % studio_ip_range)
-                if current_user_ip in studio_ip_range:
-                    self.set_cookie = True
-                    self.is_from_studio = True
+                if current_user_ip in networks:
+                    request.set_studio_cookie = True
+                    request.is_from_studio = True
 
         # check override in POST
         if post_val_override == 'override':
-            self.set_cookie = True
+            request.set_studio_cookie = True
             log.warning("This person %s %s is overriding the studio ip range %s." % (
-                request.user, current_user_ip, studio_ip_range))
+                request.user, current_user_ip, dbconfig.get(self.DB_KEY)))
 
-        request.is_from_studio = self.is_from_studio
-        log.info("request.is_from_studio is %s." % request.is_from_studio)
+        log.debug("request.is_from_studio is %s for %s." % (
+            request.is_from_studio, current_user_ip))
 
     def process_response(self, request, response):
-        if self.set_cookie:
-            log.info('Setting %s cookie.' % self.COOKIE_NAME)
+        if getattr(request, 'set_studio_cookie', False):
+            log.debug('Setting %s cookie.' % self.COOKIE_NAME)
             response.set_cookie(self.COOKIE_NAME, value='override')
         return response
 
+
+# Decorates the views that show or act on request.is_from_studio.
+from_studio = decorator_from_middleware(FromStudioMiddleware)
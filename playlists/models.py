@@ -16,17 +16,22 @@
 ###
 
 """Datastore model for DJ Playlists."""
+import calendar
+from datetime import datetime, timedelta
 import hashlib
 import logging
+import time
 
 from google.appengine.ext.db import polymodel
 from google.appengine.api import memcache
 from google.appengine.ext import db
 from google.appengine.api.datastore_types import Key
+from django.utils import simplejson
 
 from auth.models import User
 import auth
 from djdb.models import Artist, Album, Track
+from common import identity
 from common import time_util
 from common.autoretry import AutoRetry
 
@@ -76,7 +81,7 @@ class DJPlaylist(Playlist):
     # A name to identify this playlist by
     name = db.StringProperty(required=True)
     # DJ user who created the playlist, if relevant
-    created_by_dj = db.ReferenceProperty(User, required=True)
+    created_by_dj = identity.ReferenceProperty(User, required=True)
     # Number of tracks contained in this playlist.
     # TODO(kumar) this is not currently used.
     track_count = db.IntegerProperty(default=0, required=True)
@@ -123,7 +128,7 @@ def chirp_playlist_key():
 class PlaylistEvent(polymodel.PolyModel):
     """An event that occurs in a Playlist."""
     # The playlist this event belongs to
-    playlist = db.ReferenceProperty(Playlist, required=True)
+    playlist = identity.ReferenceProperty(Playlist, required=True)
     # The date this playlist event was established
     # (automatically set to now upon creation)
     established = db.DateTimeProperty(auto_now_add=True)
@@ -148,23 +153,32 @@ class PlaylistBreak(PlaylistEvent):
     # this doesn't have any special fields
 
 class PlaylistTrack(PlaylistEvent):
-    """A track in a Playlist."""
+    """A track in a Playlist.
+
+    Display values from the referenced artist, track, album and selector
+    are copied onto the track when it is saved so that reading them does
+    not cost a datastore get each.  See update_cached_fields().
+    """
+    # Bump this when cached fields are added or changed so that
+    # backfill_cached_fields() updates older tracks.
+    CACHED_FIELDS_VERSION = 1
+
     # DJ user who selected this track.
-    selector = db.ReferenceProperty(User, required=True)
+    selector = identity.ReferenceProperty(User, required=True)
     # Artist name if this is a freeform entry
     freeform_artist_name = db.StringProperty(required=False)
     # Reference to artist from CHIRP digital library (if exists in library)
-    artist = db.ReferenceProperty(Artist, required=False)
+    artist = identity.ReferenceProperty(Artist, required=False)
     # Track title if this is a freeform entry
     freeform_track_title = db.StringProperty(required=False)
     # Reference to track (mp3 file) from CHIRP digital library (if exists in library)
-    track = db.ReferenceProperty(Track, required=False)
+    track = identity.ReferenceProperty(Track, required=False)
     # The order at which this track appears in the playlist
     track_number = db.IntegerProperty(required=True, default=1)
     # Album title if this is a freeform entry
     freeform_album_title = db.StringProperty(required=False)
     # Reference to album from CHIRP digital library (if exists in library)
-    album = db.ReferenceProperty(Album, required=False)
+    album = identity.ReferenceProperty(Album, required=False)
     # Label if this is a freeform entry
     freeform_label = db.StringProperty(required=False)
     # Notes about this track
@@ -179,31 +193,65 @@ class PlaylistTrack(PlaylistEvent):
     lastfm_url_med_image = db.StringProperty(required=False)
     # LastFM URL to large album image
     lastfm_url_large_image = db.StringProperty(required=False)
-
-    @property
-    def artist_name(self):
+    # Copies of referenced values; 0 means they were never set.
+    cached_fields_version = db.IntegerProperty(default=0)
+    cached_artist_name = db.StringProperty(required=False)
+    cached_track_title = db.StringProperty(required=False)
+    cached_album_title = db.StringProperty(required=False)
+    cached_dj_name = db.StringProperty(required=False)
+    cached_duration_ms = db.IntegerProperty(required=False)
+
+    def update_cached_fields(self):
+        """Copies display values from referenced entities onto this track."""
         # validate() should enforce that one of these is available:
         if self.artist:
-            return self.artist.name
+            self.cached_artist_name = self.artist.name
+        else:
+            self.cached_artist_name = self.freeform_artist_name
+        if self.track:
+            self.cached_track_title = self.track.title
+            self.cached_duration_ms = self.track.duration_ms
+        else:
+            self.cached_track_title = self.freeform_track_title
+            self.cached_duration_ms = None
+        if self.album:
+            self.cached_album_title = self.album.title
+        elif self.freeform_album_title:
+            self.cached_album_title = self.freeform_album_title
         else:
-            return self.freeform_artist_name
+            self.cached_album_title = None
+        self.cached_dj_name = self.selector.effective_dj_name
+        self.cached_fields_version = self.CACHED_FIELDS_VERSION
+
+    def _get_cached(self, name):
+        if not self.cached_fields_version:
+            # Saved before fields were cached; see backfill_cached_fields().
+            self.update_cached_fields()
+        return getattr(self, name)
+
+    @property
+    def artist_name(self):
+        return self._get_cached('cached_artist_name')
 
     @property
     def track_title(self):
-        # validate() should enforce that one of these is available:
-        if self.track:
-            return self.track.title
-        else:
-            return self.freeform_track_title
+        return self._get_cached('cached_track_title')
 
     @property
     def album_title(self):
-        if self.album:
-            return self.album.title
-        elif self.freeform_album_title:
-            return self.freeform_album_title
-        else:
-            return None
+        return self._get_cached('cached_album_title')
+
+    @property
+    def dj_name(self):
+        return self._get_cached('cached_dj_name')
+
+    @property
+    def duration_ms(self):
+        return self._get_cached('cached_duration_ms')
+
+    @property
+    def selector_key(self):
+        return PlaylistTrack.selector.get_value_for_datastore(self)
 
     @property
     def album_title_display(self):
@@ -235,6 +283,7 @@ class PlaylistTrack(PlaylistEvent):
 
         A track must have at least artist name and track title
         """
+        self.update_cached_fields()
         if not self.track_title and not self.track:
             raise ValueError("Must set either a track_title or reference a track")
         if not self.artist_name and not self.artist:
@@ -245,16 +294,166 @@ class PlaylistTrack(PlaylistEvent):
 
     def put(self, *args, **kwargs):
         self.validate()
+        is_new = not self.is_saved()
         super(PlaylistTrack, self).put(*args, **kwargs)
         try:
-            memcache.delete('api.current_track')
+            PlaylistChange.record(self, is_new and PlaylistChange.ADD
+                                               or PlaylistChange.CHANGE)
+        except:
+            log.exception('IGNORED while logging playlist change:')
+        try:
+            _current_playlist_api().write_through(self)
         except:
             log.exception('IGNORED while saving playlist:')
 
+    def delete(self, *args, **kwargs):
+        key = self.key()
+        try:
+            PlaylistChange.record(self, PlaylistChange.DELETE)
+        except:
+            log.exception('IGNORED while logging playlist change:')
+        super(PlaylistTrack, self).delete(*args, **kwargs)
+        try:
+            _current_playlist_api().evict(key)
+        except:
+            log.exception('IGNORED while deleting from playlist:')
+
     def save(self, *args, **kwargs):
         return self.put(*args, **kwargs)
 
 
+class PlaylistChange(db.Model):
+    """A log entry for a PlaylistTrack that was added, changed or deleted.
+
+    Entries are children of their playlist so reading the log back is
+    strongly consistent.  The version is a timestamp in microseconds that
+    API clients pass back to receive only newer changes.  Versions come
+    from a memcache counter so they keep increasing even when instance
+    clocks disagree.  Changes older than RETENTION are expired.
+    """
+    ADD = 'add'
+    CHANGE = 'change'
+    DELETE = 'delete'
+    RETENTION = timedelta(days=1)
+
+    track = db.ReferenceProperty(PlaylistTrack, required=True,
+                                 collection_name='changes')
+    action = db.StringProperty(required=True,
+                               choices=(ADD, CHANGE, DELETE))
+    version = db.IntegerProperty(required=True)
+    established = db.DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def _version_key(cls, playlist_key):
+        return 'playlists.changes.version.%s' % playlist_key
+
+    @classmethod
+    def _counter_key(cls, playlist_key):
+        return 'playlists.changes.counter.%s' % playlist_key
+
+    @classmethod
+    def version_at(cls, when):
+        """The version of a change made at a datetime."""
+        return int(time.mktime(when.timetuple())) * 1000000 + when.microsecond
+
+    @classmethod
+    def next_versions(cls, playlist_key, count):
+        """Reserves count consecutive versions, returning the first.
+
+        The counter is bumped up to this instance's clock when it lags
+        behind, but never moves backwards, so a change can't land below
+        a version a client has already seen.
+        """
+        now = int(time.time() * 1000000)
+        key = cls._counter_key(playlist_key)
+        last = memcache.incr(key, delta=count)
+        if last is None:
+            last = memcache.incr(key, delta=count,
+                    initial_value=cls.latest_version(playlist_key))
+        if last is not None and last < now:
+            last = memcache.incr(key, delta=now - last)
+        if last is None:
+            # Memcache is down or just evicted the counter; the last
+            # stored version is the best we have.
+            return max(now, cls.latest_version(playlist_key) + 1)
+        return last - count + 1
+
+    @classmethod
+    def record(cls, track, action):
+        return cls.record_multi([track], action)[0]
+
+    @classmethod
+    def record_multi(cls, tracks, action):
+        """Logs the same action for several tracks with one batch put."""
+        changes = []
+        versions = {}
+        for track in tracks:
+            parent = PlaylistEvent.playlist.get_value_for_datastore(track)
+            versions[parent] = versions.get(parent, 0) + 1
+        for parent, count in versions.items():
+            versions[parent] = cls.next_versions(parent, count)
+        for track in tracks:
+            parent = PlaylistEvent.playlist.get_value_for_datastore(track)
+            changes.append(cls(parent=parent,
+                               track=track.key(),
+                               action=action,
+                               version=versions[parent]))
+            versions[parent] += 1
+        AutoRetry(db).put(changes)
+        memcache.set_multi(dict((cls._version_key(c.parent_key()), c.version)
+                                for c in changes))
+        return changes
+
+    @classmethod
+    def latest_version(cls, playlist_key):
+        """The version of the last change to this playlist (0 if none).
+
+        This is usually answered by memcache alone.
+        """
+        version = memcache.get(cls._version_key(playlist_key))
+        if version is None:
+            changes = (cls.all().ancestor(playlist_key)
+                          .order('-version').fetch(1))
+            version = changes and changes[0].version or 0
+            memcache.set(cls._version_key(playlist_key), version)
+        return version
+
+    @classmethod
+    def since(cls, playlist_key, version, limit):
+        """Changes to this playlist after version, oldest first."""
+        return (cls.all().ancestor(playlist_key)
+                   .filter('version >', version)
+                   .order('version')
+                   .fetch(limit))
+
+    @property
+    def track_key(self):
+        return PlaylistChange.track.get_value_for_datastore(self)
+
+
+def put_tracks(tracks):
+    """Saves changes to existing tracks with one batch put.
+
+    Like PlaylistTrack.put() this logs the changes and writes them
+    through to the API cache.  Tracks are not validated again.
+    """
+    AutoRetry(db).put(tracks)
+    try:
+        PlaylistChange.record_multi(tracks, PlaylistChange.CHANGE)
+    except:
+        log.exception('IGNORED while logging playlist change:')
+    try:
+        _current_playlist_api().write_through(*tracks)
+    except:
+        log.exception('IGNORED while saving playlist:')
+
+
+def _current_playlist_api():
+    # The API module imports this module so it can't be imported globally.
+    from api.handler import CurrentPlaylist
+    return CurrentPlaylist
+
+
 class PlayCount(db.Model):
     """A log of how many times each artist/track was played."""
     play_count = db.IntegerProperty(default=0)
@@ -298,11 +497,138 @@ class PlayCountSnapshot(db.Model):
     label = db.StringProperty()
 
     @classmethod
-    def create_from_count(cls, count):
+    def from_count(cls, count, established=None):
         snap = cls()
+        if established:
+            snap.established = established
         snap.play_count = count.play_count
         snap.artist_name = count.artist_name
         snap.album_title = count.album_title
         snap.label = count.label
         snap.track_id = str(count.key())
-        return db.put_async(snap)
+        return snap
+
+
+class PlayChart(db.Model):
+    """Top 40 releases over a rolling window of play count snapshots.
+
+    The current chart for each window in WINDOWS has the window name as
+    its key name.  Snapshots are added to it as they are taken and dropped
+    once they fall out of the window so the snapshots themselves are only
+    read to create a chart for the first time.  Each update also archives
+    the releases under the window name and date; see get_archive().
+    """
+    WINDOWS = {
+        'day': timedelta(days=1),
+        'week': timedelta(days=7),
+        'month': timedelta(days=30),
+    }
+    CHART_SIZE = 40
+
+    window = db.StringProperty(required=True)
+    start = db.DateTimeProperty()
+    end = db.DateTimeProperty()
+    # JSON list of [timestamp, track_id, play_count, artist_name,
+    # album_title, label] for each snapshot in the window.
+    # Not set on archived charts.
+    snapshots_json = db.TextProperty()
+    # JSON list of releases as served by /api/stats.
+    releases_json = db.TextProperty()
+
+    @property
+    def releases(self):
+        return simplejson.loads(self.releases_json or '[]')
+
+    @classmethod
+    def _snapshot_row(cls, snap):
+        return [calendar.timegm(snap.established.utctimetuple()),
+                snap.track_id, snap.play_count, snap.artist_name,
+                snap.album_title, snap.label]
+
+    def add_snapshots(self, snapshots, now):
+        """Adds PlayCountSnapshot entities and drops expired ones."""
+        self.start = now - self.WINDOWS[self.window]
+        self.end = now
+        oldest = calendar.timegm(self.start.utctimetuple())
+        rows = {}
+        for row in simplejson.loads(self.snapshots_json or '[]'):
+            rows[(row[0], row[1])] = row
+        for snap in snapshots:
+            row = self._snapshot_row(snap)
+            rows[(row[0], row[1])] = row
+        rows = sorted([r for r in rows.values() if r[0] >= oldest])
+        self.snapshots_json = simplejson.dumps(rows)
+
+        # Average the play counts of each release.
+        counts = {}
+        for (ts, track_id, play_count,
+             artist_name, album_title, label) in rows:
+            release = counts.setdefault(track_id, {'play_count': []})
+            # Rows are in order so the latest names win.
+            release.update({'artist': artist_name,
+                            'release': album_title,
+                            'label': label,
+                            # Make this ID shorter so it's easier for
+                            # clients.
+                            'id': hashlib.sha1(track_id).hexdigest()})
+            release['play_count'].append(play_count)
+        for release in counts.values():
+            pc = release['play_count']
+            release['play_count'] = int(round(sum(pc) / len(pc), 1))
+
+        # Sort the releases in descending order of play count.
+        releases = sorted(counts.values(),
+                          key=lambda c: (c['play_count'], c['release']),
+                          reverse=True)
+        self.releases_json = simplejson.dumps(releases[0:self.CHART_SIZE])
+
+    def archive(self):
+        """Returns a copy of this chart to keep for its end date."""
+        return PlayChart(key_name=self.archive_key_name(self.window,
+                                                        self.end),
+                         window=self.window,
+                         start=self.start,
+                         end=self.end,
+                         releases_json=self.releases_json)
+
+    @classmethod
+    def archive_key_name(cls, window, date):
+        return '%s.%s' % (window, date.strftime('%Y-%m-%d'))
+
+    @classmethod
+    def create(cls, window, now):
+        """Creates a chart from the snapshots already in the window."""
+        chart = cls(key_name=window, window=window)
+        qs = (PlayCountSnapshot.all()
+              .filter('established >=', now - cls.WINDOWS[window])
+              .filter('established <=', now))
+        chart.add_snapshots(AutoRetry(qs).run(), now)
+        return chart
+
+    @classmethod
+    def update(cls, snapshots, now=None):
+        """Adds new PlayCountSnapshot entities to every chart."""
+        if now is None:
+            now = datetime.now()
+        to_put = []
+        for window in cls.WINDOWS:
+            chart = cls.get_by_key_name(window)
+            if chart is None:
+                chart = cls.create(window, now)
+            chart.add_snapshots(snapshots, now)
+            to_put.extend([chart, chart.archive()])
+        AutoRetry(db).put(to_put)
+
+    @classmethod
+    def get_chart(cls, window):
+        """Returns the current chart for window, creating it if need be."""
+        chart = cls.get_by_key_name(window)
+        if chart is None:
+            chart = cls.create(window, datetime.now())
+            AutoRetry(chart).put()
+        return chart
+
+    @classmethod
+    def get_archive(cls, window, date):
+        """Returns the chart for window as of date or None."""
+        return cls.get_by_key_name(cls.archive_key_name(window, date))
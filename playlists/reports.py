@@ -28,6 +28,7 @@ from google.appengine.api import datastore_errors
 from auth.decorators import require_role
 import auth
 from auth import roles
+from common import identity
 from common.utilities import (as_encoded_str, http_send_csv_file, 
                               restricted_job_worker, restricted_job_product)
 from djdb.models import HEAVY_ROTATION_TAG, LIGHT_ROTATION_TAG
@@ -187,6 +188,8 @@ def playlist_export_report_worker(results, request_params):
     else:
         finished = False
 
+    # Most entries are on the same few playlists.
+    identity.prefetch(all_entries, 'playlist')
     for entry in all_entries:
         established = _get_entity_attr(entry, 'established_display')
         report_key = as_encoded_str(str(established))
@@ -198,12 +201,11 @@ def playlist_export_report_worker(results, request_params):
             }
             continue
        
-        playlist = _get_entity_attr(entry, 'playlist') 
-        track = _get_entity_attr(entry, 'track')
+        playlist = _get_entity_attr(entry, 'playlist')
         results['items'][report_key] = {
             'channel': as_encoded_str(_get_entity_attr(playlist, 'channel')),
             'date': as_encoded_str(established.strftime("%m/%d/%y")),
-            'duration_ms': as_encoded_str(_get_entity_attr(track, 
+            'duration_ms': as_encoded_str(_get_entity_attr(entry,
                                                            'duration_ms', 0)),
             'established': as_encoded_str(established.strftime('%Y-%m-%d %H:%M:%S')),
             'artist_name': as_encoded_str(_get_entity_attr(entry,
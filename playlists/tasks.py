@@ -15,9 +15,13 @@
 ### limitations under the License.
 ###
 from datetime import datetime, timedelta
+import httplib
 import sys
 import logging
+import threading
+import time
 import urllib, urllib2
+import urlparse
 import wsgiref.handlers
 
 from django import http
@@ -26,16 +30,38 @@ from django.core.urlresolvers import reverse
 
 from google.appengine.ext import db
 from google.appengine.ext import webapp
-from google.appengine.api import taskqueue, urlfetch
+from google.appengine.api import memcache, taskqueue, urlfetch
 
-from common import dbconfig, in_dev
+from common import dbconfig, expiry, identity, in_dev
 from common.utilities import as_encoded_str, cronjob
 from common.autoretry import AutoRetry
 from djdb.models import Track
-from playlists.models import PlaylistEvent, PlayCount, PlayCountSnapshot
+from playlists.models import (PlaylistEvent, PlaylistTrack, PlaylistChange,
+                              PlayCount, PlayCountSnapshot, PlayChart)
 
 log = logging.getLogger()
 
+# Push endpoints on chirpradio.org, in the order they are notified.
+PUSH_URL_KEYS = ['chirpradio.push.recently-played',
+                 'chirpradio.push.now-playing']
+
+# Seconds to wait for each push endpoint.  A task has 10 minutes to
+# execute but both pushes run at the same time so one slow endpoint
+# can no longer eat into the other's time.
+PUSH_DEADLINES = {
+    'chirpradio.push.recently-played': 60 * 2,
+    'chirpradio.push.now-playing': 60,
+}
+
+# Playlist entries created within the same window of this many seconds
+# are announced to the live site with a single push.  The live site
+# pulls the playlist when notified so it always sees the latest state.
+PUSH_DEBOUNCE_SECS = 10
+
+# Playlist entries created within the same window of this many seconds
+# are sent to Live365 as one metadata update of the latest entry.
+LIVE365_DEBOUNCE_SECS = 30
+
 
 class PlaylistEventListener(object):
     """Listens to creations or deletions of playlist entries."""
@@ -53,10 +79,24 @@ class LiveSiteListener(PlaylistEventListener):
     """Tells chirpradio.org that a new entry was added to the playlist."""
 
     def create(self, track):
-        """This instance of PlaylistEvent was created."""
-        taskqueue.add(url=reverse('playlists.send_track_to_live_site'),
-                      queue_name='live-site-playlists',
-                      params={'id':str(track.key())})
+        """This instance of PlaylistEvent was created.
+
+        The push task is named after the current debounce window and
+        scheduled for the end of it, so a burst of entries (or a DJ
+        correcting a typo) results in one push of the latest state.
+        """
+        now = time.time()
+        window = int(now // PUSH_DEBOUNCE_SECS)
+        countdown = (window + 1) * PUSH_DEBOUNCE_SECS - now
+        try:
+            taskqueue.add(url=reverse('playlists.send_track_to_live_site'),
+                          queue_name='live-site-playlists',
+                          name='live-site-push-%d' % window,
+                          countdown=countdown,
+                          params={'id':str(track.key())})
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            log.info('Coalesced live site push for track %s' % track.key())
 
     def delete(self, track_key):
         """The key of this PlaylistEvent was deleted."""
@@ -98,9 +138,29 @@ class Live365Listener(PlaylistEventListener):
 
         **album**
         Album title
+
+        Updates are collapsed per broadcast: the task for the current
+        debounce window sends whichever entry was created last.
         """
-        taskqueue.add(url=reverse('playlists.send_track_to_live365'),
-                      params={'id':str(track.key())})
+        playlist_key = str(PlaylistEvent.playlist.get_value_for_datastore(
+                                                                    track))
+        try:
+            memcache.set(_live365_latest_key(playlist_key), str(track.key()))
+        except:
+            log.exception('IGNORED while caching latest Live365 track:')
+        now = time.time()
+        window = int(now // LIVE365_DEBOUNCE_SECS)
+        countdown = (window + 1) * LIVE365_DEBOUNCE_SECS - now
+        try:
+            taskqueue.add(url=reverse('playlists.send_track_to_live365'),
+                          name='live365-%s-%d' % (playlist_key, window),
+                          countdown=countdown,
+                          params={'id':str(track.key()),
+                                  'playlist': playlist_key})
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            log.info('Coalesced Live365 update for track %s' % track.key())
+            _incr_metrics(LIVE365_METRICS_PREFIX, {'suppressed': 1})
 
     def delete(self, track_key):
         """The key of this PlaylistEvent was deleted.
@@ -146,8 +206,9 @@ playlist_event_listeners = PlaylistEventDispatcher([
 def send_track_to_live_site(request):
     """View for task queue that tells chirpradio.org a new track was entered"""
     log.info('Pushing notifications for track %r' % request.POST['id'])
-    success = [_push_notify('chirpradio.push.recently-played'),
-               _push_notify('chirpradio.push.now-playing')]
+    # Start all fetches before waiting on any of them.
+    pushes = [_push_notify(url_key) for url_key in PUSH_URL_KEYS]
+    success = [_push_result(push) for push in pushes]
     if all(success):
         return HttpResponse("OK")
     else:
@@ -156,23 +217,85 @@ def send_track_to_live_site(request):
 
 
 def _push_notify(url_key):
+    """Starts an asynchronous push to the URL configured for url_key.
+
+    Returns a push object to pass to _push_result() or None if
+    there is no URL configured in the development environment.
+    """
     url = dbconfig.get(url_key)
     if not url:
         msg = 'No value in dbconfig for %r' % url_key
         if in_dev():
             log.warning(msg)
+            return None
         else:
             raise ValueError(msg)
 
-    # A task has 10 minutes to execute. This tells urlfetch to time out after 8
-    # minutes.
-    deadline = 60 * 8
-    resp = urlfetch.fetch(url, deadline=deadline)
-    log.info('Push response from %r: %s' % (url, resp.status_code))
-    if resp.status_code != 200:
-        log.error(resp.content)
+    started = time.time()
+    rpc = urlfetch.create_rpc(deadline=PUSH_DEADLINES[url_key])
+    urlfetch.make_fetch_call(rpc, url)
+    return {'url_key': url_key, 'url': url, 'rpc': rpc, 'started': started}
+
+
+def _push_result(push):
+    """Waits for a push started by _push_notify() and records its metrics.
+
+    Returns True if the push succeeded.
+    """
+    if push is None:
+        return True
+    try:
+        resp = push['rpc'].get_result()
+    except urlfetch.Error, exc:
+        log.error('Push to %r failed: %s: %s' % (push['url'],
+                                                exc.__class__.__name__, exc))
+        ok = False
+    else:
+        log.info('Push response from %r: %s' % (push['url'],
+                                                resp.status_code))
+        ok = resp.status_code == 200
+        if not ok:
+            log.error(resp.content)
+    latency_ms = int((time.time() - push['started']) * 1000)
+    _record_push_metrics(push['url_key'], latency_ms, ok)
+    return ok
+
+
+def _push_metrics_prefix(url_key):
+    return 'playlists.push.%s.' % url_key
+
+
+def _incr_metrics(key_prefix, offsets):
+    """Increments memcache counters; metrics never fail a task."""
+    try:
+        memcache.offset_multi(offsets, key_prefix=key_prefix,
+                              initial_value=0)
+    except:
+        log.exception('IGNORED while recording metrics:')
+
+
+def _record_push_metrics(url_key, latency_ms, ok):
+    _incr_metrics(_push_metrics_prefix(url_key),
+                  {'calls': 1, 'errors': int(not ok),
+                   'latency_ms': latency_ms})
+
+
+def get_push_metrics():
+    """Returns call, error and average latency counts per push endpoint.
 
-    return resp.status_code == 200
+    These are memcache counters so they reset whenever memcache is flushed.
+    """
+    metrics = {}
+    for url_key in PUSH_URL_KEYS:
+        stats = memcache.get_multi(['calls', 'errors', 'latency_ms'],
+                                   key_prefix=_push_metrics_prefix(url_key))
+        calls = stats.get('calls', 0)
+        metrics[url_key] = {
+            'calls': calls,
+            'errors': stats.get('errors', 0),
+            'avg_latency_ms': calls and stats.get('latency_ms', 0) / calls,
+        }
+    return metrics
 
 
 def play_count(request):
@@ -219,26 +342,71 @@ def play_count(request):
 @cronjob
 def expunge_play_count(request):
     """Cron view to expire old play counts."""
-    # Delete tracks that have not been incremented in the last week.
-    qs = PlayCount.all().filter('modified <',
-                                datetime.now() - timedelta(days=7))
-    num = 0
-    for ob in qs.fetch(1000):
-        ob.delete()
-        num += 1
-    log.info('Deleted %s old play count entries' % num)
+    expiry.run_batch('play_count')
+
+
+@expiry.expirer('play_count')
+def old_play_counts(now):
+    # Tracks that have not been incremented in the last week.
+    return PlayCount.all(keys_only=True).filter(
+                        'modified <', now - timedelta(days=7))
+
+
+@expiry.expirer('playlist_changes')
+def old_playlist_changes(now):
+    # Older than anything the playlist_changes API still serves.
+    cutoff = PlaylistChange.version_at(now - PlaylistChange.RETENTION)
+    return PlaylistChange.all(keys_only=True).filter('version <', cutoff)
+
+
+# Tracks updated by each backfill_cached_fields() task.
+BACKFILL_BATCH_SIZE = 100
+
+
+def backfill_cached_fields(request):
+    """Task view to cache display values on tracks saved before they were.
+
+    This works through all tracks in batches, chaining a task for each
+    batch.  Start it by visiting the URL as an admin.
+    """
+    query = PlaylistTrack.all()
+    cursor = request.REQUEST.get('cursor')
+    if cursor:
+        query.with_cursor(cursor)
+    tracks = query.fetch(BACKFILL_BATCH_SIZE)
+    stale = [t for t in tracks if t.cached_fields_version <
+                                  PlaylistTrack.CACHED_FIELDS_VERSION]
+    identity.prefetch(stale, 'artist', 'track', 'album', 'selector')
+    updated = []
+    for track in stale:
+        try:
+            track.update_cached_fields()
+        except db.ReferencePropertyResolveError:
+            log.warning('Not caching fields of %s; bad reference'
+                        % track.key())
+            continue
+        updated.append(track)
+    # Not track.put() because these are not playlist changes.
+    AutoRetry(db).put(updated)
+    log.info('Cached fields of %s of %s tracks'
+             % (len(updated), len(tracks)))
+    if len(tracks) == BACKFILL_BATCH_SIZE:
+        taskqueue.add(url=reverse('playlists.backfill_cached_fields'),
+                      params={'cursor': query.cursor()})
+    return HttpResponse('OK')
 
 
 @cronjob
 def play_count_snapshot(request):
     """Cron view to create a play count snapshot (top 40)."""
+    now = datetime.now()
     qs = PlayCount.all().order('-play_count')
-    results = []
-    for count in qs.fetch(40):
-        results.append(PlayCountSnapshot.create_from_count(count))
-    for res in results:
-        res.get_result()  # wait for result
+    snapshots = [PlayCountSnapshot.from_count(count, established=now)
+                 for count in qs.fetch(40)]
+    AutoRetry(db).put(snapshots)
     log.info('Created play count snapshot')
+    PlayChart.update(snapshots, now=now)
+    log.info('Updated play charts')
 
 
 def send_track_to_live365(request):
@@ -284,72 +452,145 @@ def send_track_to_live365(request):
     **album**
     Album title
     """
-    track = AutoRetry(PlaylistEvent).get(request.POST['id'])
+    track_key = request.POST['id']
+    playlist_key = request.POST.get('playlist')
+    if playlist_key:
+        latest_key = memcache.get(_live365_latest_key(playlist_key))
+        if latest_key and latest_key != track_key:
+            log.info('Sending latest track %s instead of %s'
+                     % (latest_key, track_key))
+            track_key = latest_key
+    track = AutoRetry(PlaylistEvent).get(track_key)
     if not track:
-        log.warning("Requested to create a non-existant track of ID %r" % request.POST['id'])
+        log.warning("Requested to create a non-existant track of ID %r" % track_key)
         # this is not an error (malicious POST, etc), so make sure the task succeeds:
         return task_response({'success':True})
 
     log.info("Live365 create track %s" % track.key())
-
-    qs = {
-        'member_name': dbconfig['live365.member_name'],
-        'password': dbconfig['live365.password'],
-        'version': 2,
-        'seconds': 30,
-        'title': as_encoded_str(track.track_title, encoding='latin-1', errors="ignore"),
-        'artist': as_encoded_str(track.artist_name, encoding='latin-1', errors="ignore"),
-        'album': as_encoded_str(track.album_title, encoding='latin-1', errors="ignore")
-    }
-    data = urllib.urlencode(qs)
-    headers = {"Content-type": "application/x-www-form-urlencoded"}
-    # in prod: http://www.live365.com/cgi-bin/add_song.cgi
-    service_url = dbconfig['live365.service_url']
-    result = _fetch_url(url=service_url, method='POST', data=data, headers=headers)
+    result = live365_sender.send(track)
+    if result['success']:
+        _incr_metrics(LIVE365_METRICS_PREFIX, {'sent': 1})
     return task_response(result)
 
 
-class AnyRequest(urllib2.Request):
+LIVE365_METRICS_PREFIX = 'playlists.live365.'
 
-    def get_method(self):
-        if hasattr(self, 'http_method'):
-            return getattr(self, 'http_method')
-        else:
-            return urllib2.Request.get_method(self)
 
+def _live365_latest_key(playlist_key):
+    return 'playlists.live365.latest.%s' % playlist_key
 
-def _fetch_url(url=None, data=None, method='GET', headers=None):
-    if headers is None:
-        headers = {}
 
-    try:
-        # request
-        req = AnyRequest(url, data, headers)
-        req.http_method = method
-
-        # response
-        res = urllib2.urlopen(req)
-        d = {'code': res.code, 'content': res.read(), 'success':True}
-        log.info("URL success output: %s" % d)
-        return d
-    except AssertionError:
-        # short of listing every possible urllib2 exception,
-        # this is the best I can think of to get the test suite to work
-        # (i.e. mock assertions) -Kumar
-        raise
-    except Exception, e:
-        # raise
-        etype, val, tb = sys.exc_info()
-        log.error(e)
-        if hasattr(e, 'read'):
-            content = e.read()
+def get_live365_metrics():
+    """Returns how many Live365 updates were sent and suppressed.
+
+    These are memcache counters so they reset whenever memcache is flushed.
+    """
+    stats = memcache.get_multi(['sent', 'suppressed'],
+                               key_prefix=LIVE365_METRICS_PREFIX)
+    return {'sent': stats.get('sent', 0),
+            'suppressed': stats.get('suppressed', 0)}
+
+
+class Live365Sender(object):
+    """Sends track metadata to Live365 over a reusable connection.
+
+    One sender is kept per instance (see live365_sender).  Credentials
+    are read from dbconfig once every credentials_ttl seconds and the
+    HTTP connection is kept open between tasks.  Any failure drops both
+    so the next task starts fresh.
+    """
+    credentials_ttl = 60 * 10
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Closes the connection and forgets cached credentials."""
+        conn = getattr(self, '_conn', None)
+        if conn is not None:
+            try:
+                conn.close()
+            except:
+                log.exception('IGNORED while closing Live365 connection:')
+        self._conn = None
+        self._conn_netloc = None
+        self._config = None
+        self._config_loaded = 0
+
+    def config(self):
+        if (self._config is None or
+            time.time() - self._config_loaded > self.credentials_ttl):
+            self._config = {
+                'member_name': dbconfig['live365.member_name'],
+                'password': dbconfig['live365.password'],
+                # in prod: http://www.live365.com/cgi-bin/add_song.cgi
+                'service_url': dbconfig['live365.service_url'],
+            }
+            self._config_loaded = time.time()
+        return self._config
+
+    def _connection(self, scheme, netloc):
+        if self._conn is None or self._conn_netloc != (scheme, netloc):
+            if scheme == 'https':
+                self._conn = httplib.HTTPSConnection(netloc)
+            else:
+                self._conn = httplib.HTTPConnection(netloc)
+            self._conn_netloc = (scheme, netloc)
+        return self._conn
+
+    def send(self, track):
+        """POSTs the track to Live365.
+
+        Returns a result dict suitable for task_response().
+        """
+        with self._lock:
+            return self._send(track)
+
+    def _send(self, track):
+        config = self.config()
+        qs = {
+            'member_name': config['member_name'],
+            'password': config['password'],
+            'version': 2,
+            'seconds': 30,
+            'title': as_encoded_str(track.track_title, encoding='latin-1', errors="ignore"),
+            'artist': as_encoded_str(track.artist_name, encoding='latin-1', errors="ignore"),
+            'album': as_encoded_str(track.album_title, encoding='latin-1', errors="ignore")
+        }
+        data = urllib.urlencode(qs)
+        headers = {"Content-type": "application/x-www-form-urlencoded"}
+        url = urlparse.urlsplit(config['service_url'])
+        path = url.path
+        if url.query:
+            path = '%s?%s' % (path, url.query)
+        try:
+            conn = self._connection(url.scheme, url.netloc)
+            conn.request('POST', path, data, headers)
+            res = conn.getresponse()
+            content = res.read()
+        except AssertionError:
+            # Let mock assertions fail the test suite.
+            raise
+        except Exception, e:
+            etype, val, tb = sys.exc_info()
+            log.error(e)
+            self.reset()
+            return {'success': False,
+                    'exception_type': etype.__name__,
+                    'exception': val,
+                    'content': None}
+        d = {'code': res.status, 'content': content,
+             'success': res.status < 400}
+        if d['success']:
+            log.info("URL success output: %s" % d)
         else:
-            content = None
-        log.info("URL error output: %s" % content)
-        return {'success': False,
-                'exception_type': etype.__name__,
-                'exception': val,
-                'content': content}
+            log.error("URL error output: %s" % d)
+            self.reset()
+        return d
+
+
+live365_sender = Live365Sender()
 
 
 """Thin wrapper for taskqueue actions mapped in playlists/urls.py
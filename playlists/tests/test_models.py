@@ -202,6 +202,30 @@ class TestPlaylistTrack(PlaylistEventTest):
         self.assertEqual(track.track_title, "You Are The Sunshine Of My Life")
         self.assertEqual(track.track, self.tracks['You Are The Sunshine Of My Life'])
     
+    def test_cached_fields(self):
+        selector = create_dj()
+        selector.dj_name = 'DJ Night Moves'
+        selector.put()
+        track = PlaylistTrack(
+            selector=selector,
+            playlist=ChirpBroadcast(),
+            artist=self.stevie,
+            album=self.talking_book,
+            track=self.tracks['You Are The Sunshine Of My Life']
+        )
+        track.put()
+        # Reading display values does not need the referenced entities.
+        for obj in (self.stevie, self.talking_book, selector,
+                    self.tracks['You Are The Sunshine Of My Life']):
+            obj.delete()
+        track = PlaylistTrack.get(track.key())
+        self.assertEqual(track.artist_name, "Stevie Wonder")
+        self.assertEqual(track.album_title, "Talking Book")
+        self.assertEqual(track.track_title, "You Are The Sunshine Of My Life")
+        self.assertEqual(track.dj_name, "DJ Night Moves")
+        self.assertEqual(track.duration_ms, 60*60*3)
+        self.assertEqual(track.selector_key, selector.key())
+
     def test_track_by_free_entry(self):
         selector = create_dj()
         playlist = ChirpBroadcast()
@@ -18,11 +18,13 @@
 
 from __future__ import with_statement
 
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 import cgi
 import datetime
 from datetime import timedelta
 import os
 from StringIO import StringIO
+import threading
 import unittest
 # future: urlparse
 
@@ -30,7 +32,8 @@ from django.test import TestCase, Client
 from django.core.urlresolvers import reverse
 import fudge
 from fudge.inspector import arg
-from google.appengine.api import memcache
+from google.appengine.api import memcache, taskqueue
+from google.appengine.ext import db
 from nose.tools import eq_
 
 from common.testutil import FormTestCaseHelper
@@ -39,20 +42,18 @@ import auth
 from auth import roles
 from auth.models import User
 import playlists.tasks
+from playlists.middleware import NetworkSet, studio_networks
 from playlists import views as playlists_views
 from playlists.models import (Playlist, PlaylistTrack, PlaylistBreak,
-                              ChirpBroadcast, PlayCount, PlayCountSnapshot)
+                              ChirpBroadcast, PlayCount, PlayCountSnapshot,
+                              PlayChart)
 from djdb.models import Artist, Album, Track
 
 import time
 
 __all__ = ['TestPlaylistViews', 'TestPlaylistViewsWithLibrary',
            'TestDeleteTrackFromPlaylist', 'TestLiveSitePlaylistTasks',
-           'TestLive365PlaylistTasks']
-
-# stub that does nothing to handle tests
-# that don't need to make assertions about URL fetches
-stub_fetch_url = fudge.Fake('_fetch_url', callable=True)
+           'TestLiveSiteListener', 'TestLive365PlaylistTasks']
 
 def setup_dbconfig():
     dbconfig['chirpapi.url.create'] = 'http://testapi/playlist/create'
@@ -68,6 +69,10 @@ def clear_data():
         pl.delete()
     for ob in PlayCount.all():
         ob.delete()
+    for ob in PlayCountSnapshot.all():
+        ob.delete()
+    for ob in PlayChart.all():
+        ob.delete()
 
 def create_stevie_wonder_album_data():
     stevie = Artist.create(name="Stevie Wonder")
@@ -169,11 +174,10 @@ class TestPlaylistViews(PlaylistViewsTest):
                     freeform_track_title="Port Rhombus")
         track.put()
 
-        with fudge.patched_context(playlists.tasks, "_fetch_url", stub_fetch_url):
-            resp = self.client.post(reverse('playlists_add_event'), {
-                'artist': 'Julio Iglesias',
-                'album': 'Mi Amore'
-            })
+        resp = self.client.post(reverse('playlists_add_event'), {
+            'artist': 'Julio Iglesias',
+            'album': 'Mi Amore'
+        })
         # self.assertNoFormErrors(resp)
         context = resp.context[0]
         self.assertEqual(context['form'].errors.as_text(),
@@ -206,12 +210,17 @@ class TestPlaylistViews(PlaylistViewsTest):
                 .with_args(
                     url=reverse('playlists.send_track_to_live_site'),
                     params={'id': arg.any_value()},
-                    queue_name='live-site-playlists'
+                    queue_name='live-site-playlists',
+                    name=arg.any_value(),
+                    countdown=arg.any_value()
                 )
                 .next_call()
                 .with_args(
                     url=reverse('playlists.send_track_to_live365'),
-                    params={'id': arg.any_value()}
+                    params={'id': arg.any_value(),
+                            'playlist': arg.any_value()},
+                    name=arg.any_value(),
+                    countdown=arg.any_value()
                 )
                 .next_call()
                 .with_args(
@@ -490,9 +499,8 @@ class TestDeleteTrackFromPlaylist(PlaylistViewsTest):
                     freeform_track_title="Rock Show",)
         other_track.put()
 
-        with fudge.patched_context(playlists.tasks, "_fetch_url", stub_fetch_url):
-            resp = self.client.get(reverse('playlists_delete_event',
-                                            args=[other_track.key()]))
+        resp = self.client.get(reverse('playlists_delete_event',
+                                        args=[other_track.key()]))
 
         self.assertRedirects(resp, reverse('playlists_landing_page'))
         # simulate the redirect:
@@ -549,37 +557,128 @@ class TaskTest(object):
         fudge.clear_expectations()
 
 
+class PushStandIn(object):
+    """Local HTTP server standing in for the chirpradio.org push endpoints.
+
+    Each path maps to the status code it responds with.  Requested paths
+    are recorded in the order they arrive.
+    """
+
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.requests = []
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                stand_in.requests.append(self.path)
+                self.send_response(stand_in.statuses.get(self.path, 404))
+                self.end_headers()
+                self.wfile.write('pushed %s' % self.path)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:%s%s' % (self.server.server_port, path)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
 class TestLiveSitePlaylistTasks(TaskTest, TestCase):
 
     def setUp(self):
         super(TestLiveSitePlaylistTasks, self).setUp()
-        self.recent_url = 'http://__push/recently-played'
-        self.now_url = 'http://__push/now-playing'
-        dbconfig['chirpradio.push.recently-played'] = self.recent_url
-        dbconfig['chirpradio.push.now-playing'] = self.now_url
-
-    @fudge.patch('playlists.tasks.urlfetch.fetch')
-    def test_create(self, fetch):
-        recent = fetch.expects_call().with_args(self.recent_url,
-                                                deadline=arg.any())
-        recent.returns_fake().has_attr(status_code=200)
-        now = recent.next_call().with_args(self.now_url,
-                                           deadline=arg.any())
-        now.returns_fake().has_attr(status_code=200)
-
-        resp = self.client.post(reverse('playlists.send_track_to_live_site'), {
-            'id': self.track.key()
-        })
+        assert memcache.flush_all()
+        self.stand_in = PushStandIn({'/recently-played': 200,
+                                     '/now-playing': 200})
+        dbconfig['chirpradio.push.recently-played'] = \
+                                self.stand_in.url('/recently-played')
+        dbconfig['chirpradio.push.now-playing'] = \
+                                self.stand_in.url('/now-playing')
 
-    @fudge.patch('playlists.tasks.urlfetch.fetch')
-    def test_create_failure(self, fetch):
-        (fetch.expects_call().returns_fake()
-                             .has_attr(status_code=500,
-                                       content='busted'))
-        resp = self.client.post(reverse('playlists.send_track_to_live_site'), {
-            'id': self.track.key()
-        })
+    def tearDown(self):
+        super(TestLiveSitePlaylistTasks, self).tearDown()
+        self.stand_in.stop()
+        assert memcache.flush_all()
+
+    def push(self):
+        return self.client.post(reverse('playlists.send_track_to_live_site'),
+                                {'id': self.track.key()})
+
+    def test_create(self):
+        resp = self.push()
+        eq_(resp.status_code, 200)
+        eq_(sorted(self.stand_in.requests),
+            ['/now-playing', '/recently-played'])
+
+    def test_create_failure(self):
+        self.stand_in.statuses['/now-playing'] = 500
+        resp = self.push()
         eq_(resp.status_code, 500)
+        # The other endpoint is still notified.
+        assert '/recently-played' in self.stand_in.requests
+
+    def test_unreachable_endpoint(self):
+        self.stand_in.stop()
+        resp = self.push()
+        eq_(resp.status_code, 500)
+
+    def test_metrics(self):
+        self.stand_in.statuses['/now-playing'] = 500
+        self.push()
+        self.push()
+        metrics = playlists.tasks.get_push_metrics()
+        eq_(metrics['chirpradio.push.recently-played']['calls'], 2)
+        eq_(metrics['chirpradio.push.recently-played']['errors'], 0)
+        eq_(metrics['chirpradio.push.now-playing']['calls'], 2)
+        eq_(metrics['chirpradio.push.now-playing']['errors'], 2)
+        assert metrics['chirpradio.push.now-playing']['avg_latency_ms'] >= 0
+
+
+class TestLiveSiteListener(TaskTest, TestCase):
+
+    def create_at(self, *stamps):
+        """Creates the track at each timestamp, returns the queued tasks."""
+        queued = {}
+
+        def add(**task):
+            if task['name'] in queued:
+                raise taskqueue.TaskAlreadyExistsError()
+            queued[task['name']] = task
+
+        fake_add = fudge.Fake('add', callable=True).calls(add)
+        listener = playlists.tasks.LiveSiteListener()
+        with fudge.patched_context(playlists.tasks.taskqueue, 'add',
+                                   fake_add):
+            for stamp in stamps:
+                fake_time = fudge.Fake('time', callable=True).returns(stamp)
+                with fudge.patched_context(playlists.tasks.time, 'time',
+                                           fake_time):
+                    listener.create(self.track)
+        return queued.values()
+
+    def test_burst_is_coalesced(self):
+        tasks = self.create_at(1350000000.0, 1350000003.0, 1350000009.5)
+        eq_(len(tasks), 1)
+        eq_(tasks[0]['url'], reverse('playlists.send_track_to_live_site'))
+        eq_(tasks[0]['queue_name'], 'live-site-playlists')
+        # Scheduled for the end of the window.
+        eq_(tasks[0]['countdown'], playlists.tasks.PUSH_DEBOUNCE_SECS)
+
+    def test_next_window_is_pushed(self):
+        tasks = self.create_at(
+                1350000000.0,
+                1350000000.0 + playlists.tasks.PUSH_DEBOUNCE_SECS)
+        eq_(len(tasks), 2)
 
 
 class TestPlayCountTask(TaskTest, TestCase):
@@ -701,6 +800,32 @@ class TestPlayCountTask(TaskTest, TestCase):
         eq_(snap.album_title, self.track.album_title)
         eq_(snap.label, self.track.label)
 
+    def test_snapshot_updates_charts(self):
+        self.count()
+        self.count()
+        res = self.snapshot()
+        eq_(res.status_code, 200)
+        for window in PlayChart.WINDOWS:
+            releases = PlayChart.get_by_key_name(window).releases
+            eq_(len(releases), 1)
+            eq_(releases[0]['artist'], self.track.artist_name)
+            eq_(releases[0]['release'], self.track.album_title)
+            eq_(releases[0]['play_count'], 2)
+            archived = PlayChart.get_archive(window, datetime.datetime.now())
+            eq_(archived.releases, releases)
+
+    def test_chart_drops_old_snapshots(self):
+        self.count()
+        count = PlayCount.all()[0]
+        now = datetime.datetime.now()
+        chart = PlayChart(key_name='week', window='week')
+        chart.add_snapshots([PlayCountSnapshot.from_count(
+                                count, established=now - timedelta(days=8))],
+                            now - timedelta(days=2))
+        eq_(len(chart.releases), 1)
+        chart.add_snapshots([], now)
+        eq_(chart.releases, [])
+
     def test_snapshot_count_track_ids(self):
         self.count()
         self.count()
@@ -763,123 +888,170 @@ class TestPlayCountTask(TaskTest, TestCase):
         eq_(snap.album_title, 'Talking Book')
 
 
-class TestLive365PlaylistTasks(TaskTest, TestCase):
-
-    def test_create_not_latin_chars(self):
-
-        def inspect_request(r):
-            # NOTE: due to URL fetching, you can only raise
-            # AssertionError here
-            self.assertEqual(r.get_full_url(), 'http://__dummylive365service__/cgi-bin/add_song.cgi')
-            qs = dict(cgi.parse_qsl(r.data))
-            self.assertEqual(qs['member_name'], "dummy_member")
-            self.assertEqual(qs['password'], "dummy_password")
-            self.assertEqual(qs['seconds'], '30')
-            # c should be replaced because latin-1 can't encode that and Live365 likes latin-1
-            self.assertEqual(qs['title'], 'Ivan Krsti song')
-            self.assertEqual(qs['album'], 'Ivan Krsti album')
-            self.assertEqual(qs['artist'], 'Ivan Krsti')
-            return True
-
-        fake_urlopen = (fudge.Fake('urlopen', expect_call=True)
-                                .with_args(arg.passes_test(inspect_request)))
-
-        fake_response = (fake_urlopen
-                                .returns_fake()
-                                .has_attr(code='200')
-                                .provides('read')
-                                .returns("<service response>"))
-
-        with fudge.patched_context(playlists.tasks.urllib2, "urlopen", fake_urlopen):
-            resp = self.client.post(reverse('playlists.send_track_to_live365'), {
-                'id': self.track.key()
-            })
-
-        fudge.verify()
-
-    def test_create_latin_chars(self):
-
-        self.playlist = ChirpBroadcast()
-        selector = self.get_selector()
-        self.track = PlaylistTrack(
-                    playlist=self.playlist,
-                    selector=selector,
-                    freeform_artist_name=u'Bj\xf6rk',
-                    freeform_album_title=u'Bj\xf6rk album',
-                    freeform_track_title=u'Bj\xf6rk song')
-        self.track.put()
+class TestBackfillCachedFields(TaskTest, TestCase):
 
-        def inspect_request(r):
-            # NOTE: due to URL fetching, you can only raise
-            # AssertionError here
-            self.assertEqual(r.get_full_url(), 'http://__dummylive365service__/cgi-bin/add_song.cgi')
-            qs = dict(cgi.parse_qsl(r.data))
-            self.assertEqual(qs['member_name'], "dummy_member")
-            self.assertEqual(qs['password'], "dummy_password")
-            self.assertEqual(qs['seconds'], '30')
-            # c should be replaced because latin-1 can't encode that and Live365 likes latin-1
-            self.assertEqual(qs['title'], 'Bj\xf6rk song')
-            self.assertEqual(qs['album'], 'Bj\xf6rk album')
-            self.assertEqual(qs['artist'], 'Bj\xf6rk')
-            return True
+    def setUp(self):
+        super(TestBackfillCachedFields, self).setUp()
+        # Simulate a track saved before fields were cached.
+        self.track.cached_fields_version = 0
+        self.track.cached_artist_name = None
+        self.track.cached_dj_name = None
+        db.put(self.track)
+
+    def backfill(self, **params):
+        return self.client.post(reverse('playlists.backfill_cached_fields'),
+                                params)
+
+    def test_backfill(self):
+        res = self.backfill()
+        eq_(res.status_code, 200)
+        track = PlaylistTrack.get(self.track.key())
+        eq_(track.cached_fields_version, PlaylistTrack.CACHED_FIELDS_VERSION)
+        eq_(track.cached_artist_name, u"Ivan Krsti\u0107")
+        eq_(track.cached_dj_name, track.selector.effective_dj_name)
 
-        fake_urlopen = (fudge.Fake('urlopen', expect_call=True)
-                                .with_args(arg.passes_test(inspect_request)))
+    @fudge.patch('playlists.tasks.taskqueue')
+    def test_chain(self, fake_tq):
+        fake_tq.expects('add').with_args(
+                    url=reverse('playlists.backfill_cached_fields'),
+                    params=arg.any())
+        with fudge.patched_context(playlists.tasks, 'BACKFILL_BATCH_SIZE', 1):
+            self.backfill()
 
-        fake_response = (fake_urlopen
-                                .returns_fake()
-                                .has_attr(code='200')
-                                .provides('read')
-                                .returns("<service response>"))
 
-        with fudge.patched_context(playlists.tasks.urllib2, "urlopen", fake_urlopen):
-            resp = self.client.post(reverse('playlists.send_track_to_live365'), {
-                'id': self.track.key()
-            })
+class TestLive365PlaylistTasks(TaskTest, TestCase):
 
-        fudge.verify()
+    def setUp(self):
+        super(TestLive365PlaylistTasks, self).setUp()
+        assert memcache.flush_all()
+        playlists.tasks.live365_sender.reset()
 
-    def test_create_ascii_chars(self):
+    def tearDown(self):
+        super(TestLive365PlaylistTasks, self).tearDown()
+        playlists.tasks.live365_sender.reset()
+        assert memcache.flush_all()
 
-        self.playlist = ChirpBroadcast()
-        selector = self.get_selector()
-        self.track = PlaylistTrack(
-                    playlist=self.playlist,
-                    selector=selector,
-                    freeform_artist_name=u'artist',
-                    freeform_album_title=u'album',
-                    freeform_track_title=u'song')
-        self.track.put()
+    def make_track(self, artist, album, song):
+        track = PlaylistTrack(
+                    playlist=ChirpBroadcast(),
+                    selector=self.get_selector(),
+                    freeform_artist_name=artist,
+                    freeform_album_title=album,
+                    freeform_track_title=song)
+        track.put()
+        return track
 
-        def inspect_request(r):
-            # NOTE: due to URL fetching, you can only raise
-            # AssertionError here
-            self.assertEqual(r.get_full_url(), 'http://__dummylive365service__/cgi-bin/add_song.cgi')
-            qs = dict(cgi.parse_qsl(r.data))
+    def expect_post(self, fake_conn, expected, status=200, times=1):
+        def inspect_body(body):
+            qs = dict(cgi.parse_qsl(body))
             self.assertEqual(qs['member_name'], "dummy_member")
             self.assertEqual(qs['password'], "dummy_password")
             self.assertEqual(qs['seconds'], '30')
-            # c should be replaced because latin-1 can't encode that and Live365 likes latin-1
-            self.assertEqual(qs['title'], 'song')
-            self.assertEqual(qs['album'], 'album')
-            self.assertEqual(qs['artist'], 'artist')
+            for k, v in expected.items():
+                self.assertEqual(qs[k], v)
             return True
 
-        fake_urlopen = (fudge.Fake('urlopen', expect_call=True)
-                                .with_args(arg.passes_test(inspect_request)))
-
-        fake_response = (fake_urlopen
-                                .returns_fake()
-                                .has_attr(code='200')
-                                .provides('read')
-                                .returns("<service response>"))
+        conn = (fake_conn.expects_call()
+                         .with_args('__dummylive365service__')
+                         .times_called(times)
+                         .returns_fake())
+        (conn.expects('request')
+             .with_args('POST', '/cgi-bin/add_song.cgi',
+                        arg.passes_test(inspect_body), arg.any())
+             .expects('getresponse')
+             .returns_fake()
+             .has_attr(status=status)
+             .provides('read')
+             .returns("<service response>"))
+        conn.provides('close')
+        return conn
+
+    def send(self, track):
+        return self.client.post(reverse('playlists.send_track_to_live365'), {
+            'id': track.key()
+        })
 
-        with fudge.patched_context(playlists.tasks.urllib2, "urlopen", fake_urlopen):
-            resp = self.client.post(reverse('playlists.send_track_to_live365'), {
-                'id': self.track.key()
-            })
+    @fudge.patch('playlists.tasks.httplib.HTTPConnection')
+    def test_create_not_latin_chars(self, fake_conn):
+        # c should be dropped because latin-1 can't encode that and
+        # Live365 likes latin-1
+        self.expect_post(fake_conn, {'title': 'Ivan Krsti song',
+                                     'album': 'Ivan Krsti album',
+                                     'artist': 'Ivan Krsti'})
+        resp = self.send(self.track)
+        eq_(resp.status_code, 200)
+
+    @fudge.patch('playlists.tasks.httplib.HTTPConnection')
+    def test_create_latin_chars(self, fake_conn):
+        track = self.make_track(u'Bj\xf6rk', u'Bj\xf6rk album',
+                                u'Bj\xf6rk song')
+        self.expect_post(fake_conn, {'title': 'Bj\xf6rk song',
+                                     'album': 'Bj\xf6rk album',
+                                     'artist': 'Bj\xf6rk'})
+        resp = self.send(track)
+        eq_(resp.status_code, 200)
+
+    @fudge.patch('playlists.tasks.httplib.HTTPConnection')
+    def test_create_ascii_chars(self, fake_conn):
+        track = self.make_track(u'artist', u'album', u'song')
+        self.expect_post(fake_conn, {'title': 'song',
+                                     'album': 'album',
+                                     'artist': 'artist'})
+        resp = self.send(track)
+        eq_(resp.status_code, 200)
+
+    @fudge.patch('playlists.tasks.httplib.HTTPConnection')
+    def test_connection_and_credentials_are_reused(self, fake_conn):
+        self.expect_post(fake_conn, {}, times=1)
+        self.send(self.track)
+        # Changing the config has no effect until credentials expire.
+        dbconfig['live365.password'] = 'new_password'
+        resp = self.send(self.track)
+        eq_(resp.status_code, 200)
+
+    @fudge.patch('playlists.tasks.httplib.HTTPConnection')
+    def test_error_resets_connection(self, fake_conn):
+        self.expect_post(fake_conn, {}, status=500, times=2)
+        resp = self.send(self.track)
+        eq_(resp.status_code, 500)
+        resp = self.send(self.track)
+        eq_(resp.status_code, 500)
 
-        fudge.verify()
+    @fudge.patch('playlists.tasks.httplib.HTTPConnection')
+    def test_sends_latest_track_of_broadcast(self, fake_conn):
+        track = self.make_track(u'artist', u'album', u'corrected song')
+        fake_add = fudge.Fake('add', callable=True)
+        with fudge.patched_context(playlists.tasks.taskqueue, 'add',
+                                   fake_add):
+            playlists.tasks.Live365Listener().create(self.track)
+            playlists.tasks.Live365Listener().create(track)
+        self.expect_post(fake_conn, {'title': 'corrected song'})
+        resp = self.client.post(reverse('playlists.send_track_to_live365'), {
+            'id': self.track.key(),
+            'playlist': self.playlist.key()
+        })
+        eq_(resp.status_code, 200)
+        eq_(playlists.tasks.get_live365_metrics()['sent'], 1)
+
+    def test_suppressed_updates_are_counted(self):
+        queued = set()
+
+        def add(**task):
+            if task['name'] in queued:
+                raise taskqueue.TaskAlreadyExistsError()
+            queued.add(task['name'])
+
+        fake_add = fudge.Fake('add', callable=True).calls(add)
+        fake_time = fudge.Fake('time', callable=True).returns(1350000000.0)
+        with fudge.patched_context(playlists.tasks.taskqueue, 'add',
+                                   fake_add):
+            with fudge.patched_context(playlists.tasks.time, 'time',
+                                       fake_time):
+                for i in range(3):
+                    playlists.tasks.Live365Listener().create(self.track)
+        eq_(len(queued), 1)
+        eq_(playlists.tasks.get_live365_metrics(),
+            {'sent': 0, 'suppressed': 2})
 
     def test_create_non_existant_track(self):
         key = self.track.key()
@@ -889,6 +1061,24 @@ class TestLive365PlaylistTasks(TaskTest, TestCase):
         })
         self.assertEqual(resp.status_code, 200)
 
+class TestNetworkSet(unittest.TestCase):
+
+    def test_match(self):
+        networks = NetworkSet('192.168.0.1, 10.0.0.0/8, 2001:db8::/32, ::1,'
+                              ' not-an-ip, 1.2.3.4/33')
+        for address in ('192.168.0.1', '10.200.1.1', '2001:db8:ffff::1',
+                        '::1', '::ffff:10.1.1.1'):
+            assert address in networks, address
+        for address in ('192.168.0.2', '11.0.0.1', '2001:db9::1',
+                        '1.2.3.4', 'garbage', ''):
+            assert address not in networks, address
+
+    def test_compiled_once(self):
+        networks = studio_networks('10.0.0.0/8')
+        assert studio_networks('10.0.0.0/8') is networks
+        assert studio_networks('10.0.0.0/16') is not networks
+
+
 class IsFromStudioTests(TestCase):
     """Test the FromStudioMiddleware playlists middleware."""
 
@@ -917,6 +1107,19 @@ class IsFromStudioTests(TestCase):
         resp = self.client.get('/playlists/', {}, REMOTE_ADDR='127.0.0.1')
         assert 'is_from_studio' not in self.client.cookies.keys()
 
+    def test_studio_networks(self):
+        dbconfig['chirp.studio_ip_range'] = '10.1.0.0/16, 2001:db8::/32'
+        resp = self.client.get('/playlists/', {}, REMOTE_ADDR='10.1.20.3')
+        assert 'name="is_from_studio_override"' not in resp.content
+        resp = self.client.get('/playlists/', {},
+                               REMOTE_ADDR='2001:db8::17')
+        assert 'name="is_from_studio_override"' not in resp.content
+
+    def test_not_checked_on_other_pages(self):
+        resp = self.client.get('/playlists/on-air', {},
+                               REMOTE_ADDR='192.168.0.2')
+        assert 'is_from_studio' not in self.client.cookies.keys()
+
     def tearDown(self):
         clear_data()
         fudge.clear_expectations()
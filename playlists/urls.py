@@ -43,4 +43,6 @@ urlpatterns += patterns('playlists.tasks',
         name='playlists.expunge_play_count'),
     url(r'^task/play_count_snapshot$', 'play_count_snapshot',
         name='playlists.play_count_snapshot'),
+    url(r'^task/backfill_cached_fields$', 'backfill_cached_fields',
+        name='playlists.backfill_cached_fields'),
 )
@@ -33,6 +33,7 @@ import auth
 from auth import roles
 from djdb.models import Album, HEAVY_ROTATION_TAG, LIGHT_ROTATION_TAG
 from playlists.forms import PlaylistTrackForm
+from playlists.middleware import from_studio
 from playlists.models import (PlaylistTrack, PlaylistEvent, PlaylistBreak,
                               chirp_playlist_key, ChirpBroadcast)
 from playlists.tasks import playlist_event_listeners
@@ -99,6 +100,7 @@ class CachedPlaylistEvent(object):
         self.label_display = data['label_display']
         self.notes = data['notes']
         self.selector = CachedSelector(data['selector_key'])
+        self.selector_key = self.selector.key()
         self.categories = data['categories']
         d = datetime(*data['established_display'])
         d = time_util.convert_utc_to_chicago(d)
@@ -190,6 +192,7 @@ def get_playlist_history(playlist):
     return list(iter_playlist_events_for_view(pl))
 
 @require_role(roles.DJ)
+@from_studio
 def landing_page(request, vars=None):
     if vars is None:
         vars = get_vars(request)
@@ -236,7 +239,7 @@ def delete_event(request, event_key):
     except BadKeyError:
         pass
     else:
-        if e and e.selector.key() == auth.get_current_user(request).key():
+        if e and e.selector_key == auth.get_current_user(request).key():
             e.delete()
             # This avoids seeing dupes after deleting the last
             # submitted track.
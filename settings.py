@@ -74,6 +74,9 @@ MEDIA_URL = '/media/'
 # this is necessary so they are executed by Admin user
 # (internal Task Queue user)
 PUBLIC_TOP_LEVEL_URLS = ['/playlists/task',
+                         '/common/task',
+                         '/traffic_log/task',
+                         '/traffic_log/generate',
                          '/auth/task',
                          '/auth/cron',
                          '/_ah/warmup',
@@ -88,9 +91,11 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = [
+    'common.profiler.ProfilerMiddleware',
+    'common.autoretry.DeadlineMiddleware',
     'django.middleware.common.CommonMiddleware',
+    'common.identity.IdentityMapMiddleware',
     'auth.middleware.AuthenticationMiddleware',
-    'playlists.middleware.FromStudioMiddleware'
 ]
 
 if not DEBUG:
@@ -149,3 +154,15 @@ JOB_WORKER_MODULES = [
     'playlists.reports',
     'traffic_log.views',
 ]
+
+# Fraction of requests whose API calls are profiled; see common.profiler.
+PROFILER_SAMPLE_RATE = 0.05
+
+# Modules that register expirers; see common.expiry.
+EXPIRY_MODULES = [
+    'djdb.lastfm',
+    'djdb.search',
+    'jobs.views',
+    'playlists.tasks',
+    'traffic_log.views',
+]
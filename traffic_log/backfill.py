@@ -0,0 +1,144 @@
+###
+### Copyright 2009 The Chicago Independent Radio Project
+### All Rights Reserved.
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###     http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+###
+
+"""Brings entries read before the report fields and the underwriter
+rollups were kept up to date.
+
+TrafficLogEntry.denormalize() fills in the spot's title and type and
+the copy's underwriter when an entry is read.  Older entries lack them,
+so the report's filters would skip them, and their reads are not in the
+rollups of traffic_log.underwriting.  run_batch() walks every entry
+with a cursor, fills them in, batching the gets of spots and copies,
+and counts the reads in their rollups.  Counting is idempotent so it
+can be run again at any time.  Like common.expiry it runs for
+TIME_LIMIT seconds and chains a task to carry on.  The report page
+offers to start it until a run has finished.
+"""
+
+import logging
+import time
+
+from django.core.urlresolvers import reverse
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+
+from common import dbconfig
+from common.autoretry import AutoRetry
+from traffic_log import models, underwriting
+
+log = logging.getLogger()
+
+# Entries looked at per query.
+BATCH_SIZE = 200
+# Seconds each task spends before chaining the next one.
+TIME_LIMIT = 60
+
+# Set in dbconfig to the time of the last completed run.
+FINISHED_KEY = 'traffic_log.backfilled'
+TASK_NAME = 'traffic-log-backfill'
+
+
+def is_finished():
+    """Returns True once a run has gone through every entry."""
+    return bool(dbconfig.get(FINISHED_KEY))
+
+
+def start():
+    """Queues a run unless one was queued in the last hour."""
+    try:
+        taskqueue.add(url=reverse('traffic_log.backfill'),
+                      name='%s-%d' % (TASK_NAME, time.time() // 3600))
+    except (taskqueue.TaskAlreadyExistsError,
+            taskqueue.TombstonedTaskError):
+        pass
+
+
+def denormalize_entries(entries):
+    """Fills in the report fields of read entries that lack them.
+
+    Returns the entries that changed, which still need to be put.
+    """
+    entries = [e for e in entries if e.readtime is not None and not e.is_read]
+    spot_keys = set()
+    copy_keys = set()
+    for entry in entries:
+        spot_keys.add(models.TrafficLogEntry.spot
+                            .get_value_for_datastore(entry))
+        copy_keys.add(models.TrafficLogEntry.spot_copy
+                            .get_value_for_datastore(entry))
+    spot_keys.discard(None)
+    copy_keys.discard(None)
+    keys = list(spot_keys) + list(copy_keys)
+    loaded = dict(zip(keys, AutoRetry(db).get(keys)))
+
+    changed = []
+    for entry in entries:
+        spot = loaded.get(models.TrafficLogEntry.spot
+                                .get_value_for_datastore(entry))
+        if spot is None:
+            # Deleted spots leave nothing to copy.
+            continue
+        spot_copy = loaded.get(models.TrafficLogEntry.spot_copy
+                                     .get_value_for_datastore(entry))
+        entry.denormalize(spot, spot_copy)
+        changed.append(entry)
+    return changed
+
+
+def run_batch(cursor=None, updated=0, rollups=0, started=None):
+    """Fills in entries and counts them for TIME_LIMIT seconds.
+
+    A task is queued to continue where this left off if there are more
+    entries.  Returns a dict of progress so far.
+    """
+    if started is None:
+        started = time.time()
+    query = models.TrafficLogEntry.all()
+    deadline = time.time() + TIME_LIMIT
+    while True:
+        if cursor:
+            query.with_cursor(cursor)
+        entries = query.fetch(BATCH_SIZE)
+        cursor = query.cursor()
+        changed = denormalize_entries(entries)
+        AutoRetry(db).put(changed)
+        updated += len(changed)
+        rollups += underwriting.add_reads(entries)
+        finished = len(entries) < BATCH_SIZE
+        if finished or time.time() >= deadline:
+            break
+
+    elapsed = max(time.time() - started, 0.001)
+    stats = {'updated': updated,
+             'rollups': rollups,
+             'finished': finished,
+             'seconds': round(elapsed, 3),
+             'per_second': round(updated / elapsed, 1)}
+    if finished:
+        dbconfig[FINISHED_KEY] = repr(time.time())
+        log.info('Backfilled %(updated)s traffic log entries and '
+                 '%(rollups)s rollups in %(seconds)ss '
+                 '(%(per_second)s/sec)' % stats)
+    else:
+        log.info('Backfilled %(updated)s traffic log entries and '
+                 '%(rollups)s rollups so far (%(per_second)s/sec)' % stats)
+        taskqueue.add(url=reverse('traffic_log.backfill'),
+                      params={'cursor': cursor,
+                              'updated': updated,
+                              'rollups': rollups,
+                              'started': repr(started)})
+    return stats
@@ -80,3 +80,12 @@ class ReportForm(djangoforms.ModelForm):
                                          choices=zip(   constants.SPOT_TYPE_CHOICES,
                                                         ['[all]'] + constants.SPOT_TYPE_CHOICES[1:]))
     underwriter = djangoforms.forms.CharField(label="Underwriter", required=False)
+
+
+class UnderwritingReportForm(forms.Form):
+    start_date = forms.DateField(label="Start Date", required=True)
+    end_date = forms.DateField(label="End Date", required=True)
+    underwriter = forms.CharField(label="Underwriter", required=False)
+    by = forms.ChoiceField(label="Count By", required=True,
+                           choices=[('date', 'Date'), ('hour', 'Hour'),
+                                    ('spot', 'Spot')])
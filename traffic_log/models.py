@@ -29,30 +29,53 @@ from common import time_util
 
 log = logging.getLogger()
 
+# Spot.copies_expire_at when none of the copies expire.
+NEVER_EXPIRES = datetime.datetime(9999, 1, 1)
+
 class SpotAtConstraint(object):
     """A spot within its constraint."""
     
-    def __init__(self, spot_constraint, spot):
+    def __init__(self, spot_constraint, spot, finished=None):
         self.spot = spot
+        if finished is not None:
+            # Already known from a SpotIndex.
+            self.finished = finished
+            return
         
-        q = (TrafficLogEntry.all()
-                .filter("log_date =", time_util.chicago_now().date())
-                .filter("spot =", spot)
-                .filter("hour =", spot_constraint.hour)
-                .filter("slot =", spot_constraint.slot)
-                .filter("dow =", spot_constraint.dow))
-        if AutoRetry(q).count(1):
-            self.finished = True
-        else:
-            self.finished = False
+        self.finished = bool(TrafficLogEntry.read_entries(
+            time_util.chicago_now().date(), spot, spot_constraint.dow,
+            spot_constraint.hour, spot_constraint.slot))
+
+def readable_slot_time(hour, slot):
+    min_slot = str(slot)
+    if min_slot == '0':
+        min_slot = '00'
+    meridian = 'am'
+    if hour > 12:
+        meridian = 'pm'
+        hour = hour - 12
+    # exceptions:
+    if hour == 12:
+        meridian = 'pm'
+    if hour == 0:
+        hour = 12
+    return "%s:%s%s" % (hour, min_slot, meridian)
+
 
 class SpotConstraint(db.Model):
     dow      = db.IntegerProperty(verbose_name="Day of Week", choices=constants.DOW)
     hour     = db.IntegerProperty(verbose_name="Hour", choices=constants.HOUR)
     slot     = db.IntegerProperty(verbose_name="Spot", choices=constants.SLOT)
     spots    = db.ListProperty(db.Key)
+
+    # Set by SpotIndex, which answers for many constraints at once.
+    spot_index = None
     
     def iter_spots(self):
+        if self.spot_index is not None:
+            for spot_view in self.spot_index.spots_at(self):
+                yield spot_view.spot
+            return
         for spot in AutoRetry(Spot).get(self.spots):
             if spot is None:
                 # there was a bug where deleted spots had lingering constraints.
@@ -65,8 +88,9 @@ class SpotConstraint(db.Model):
             yield spot
     
     def iter_spots_at_constraint(self):
-        for spot in self.iter_spots():
-            yield SpotAtConstraint(self, spot)
+        if self.spot_index is not None:
+            return iter(self.spot_index.spots_at(self))
+        return (SpotAtConstraint(self, spot) for spot in self.iter_spots())
     
     def as_query_string(self):
         return "hour=%d&dow=%d&slot=%d" % (self.hour, self.dow, self.slot)
@@ -80,20 +104,7 @@ class SpotConstraint(db.Model):
     
     @property
     def readable_slot_time(self):
-        min_slot = str(self.slot)
-        if min_slot == '0':
-            min_slot = '00'
-        meridian = 'am'
-        hour = self.hour
-        if hour > 12:
-            meridian = 'pm'
-            hour = hour - 12
-        # exceptions:
-        if hour == 12:
-            meridian = 'pm'
-        if hour == 0:
-            hour = 12
-        return "%s:%s%s" % (hour, min_slot, meridian)
+        return readable_slot_time(self.hour, self.slot)
 
     def __init__(self, *args, **kw):
         key_name = "%d:%d:%d" % (kw['dow'], kw['hour'], kw['slot']) 
@@ -109,6 +120,10 @@ class Spot(db.Model):
     created   = db.DateTimeProperty(auto_now_add=True)
     updated   = db.DateTimeProperty(auto_now=True)
     random_spot_copies = db.ListProperty(db.Key)
+    # The earliest expire_on of the copies in random_spot_copies, so that
+    # checking for expired copies is a comparison.  NEVER_EXPIRES if none
+    # of them expire; None until it is first worked out.
+    copies_expire_at = db.DateTimeProperty()
 
     def all_spot_copy(self):
         # two queries (since there is no OR statement).  
@@ -122,43 +137,63 @@ class Spot(db.Model):
 
     def add_spot_copy(self, spot_copy):
         self.random_spot_copies.append(spot_copy.key())
+        self._note_copy_expiry(spot_copy.expire_on)
         AutoRetry(self).save()
+
+    def _note_copy_expiry(self, expire_on):
+        if (expire_on and self.copies_expire_at is not None and
+            expire_on < self.copies_expire_at):
+            self.copies_expire_at = expire_on
+            return True
+        return False
+
+    def copy_expiry_changed(self, expire_on):
+        """Called when one of this spot's copies gets a new expire_on."""
+        if self._note_copy_expiry(expire_on):
+            AutoRetry(self).save()
     
     def _expunge_expired_spot_copies(self, random_spot_copies):
         """Check to see if any of the cached spot copies have expired.
         
         if so, expunge them and save the spot with a new list.
         """
-        one_expired = False
-        q = SpotCopy.all().filter("spot =", self)
-        q = q.filter("__key__ in", random_spot_copies)
-        
-        expired_spot_copy_keys = []
-        for copy in q:
-            if copy.expire_on and copy.expire_on <= datetime.datetime.now():
-                expired_spot_copy_keys.append(copy.key())
-        
-        for expired_key in expired_spot_copy_keys:
-            for k in random_spot_copies:
-                one_expired = True
-                if str(k) == str(expired_key):
-                    random_spot_copies.remove(k)
-        if one_expired:
-            # only save if we have to since expunging will be rare
-            self.random_spot_copies = random_spot_copies
-            AutoRetry(self).save()
+        now = datetime.datetime.now()
+        if self.copies_expire_at is not None and self.copies_expire_at > now:
+            return
+
+        copies = AutoRetry(db).get(random_spot_copies)
+        expire_at = NEVER_EXPIRES
+        for key, copy in zip(list(random_spot_copies), copies):
+            if copy is None or not copy.expire_on:
+                continue
+            if copy.expire_on <= now:
+                random_spot_copies.remove(key)
+            else:
+                expire_at = min(expire_at, copy.expire_on)
+        self.random_spot_copies = random_spot_copies
+        self.copies_expire_at = expire_at
+        AutoRetry(self).save()
 
     def shuffle_spot_copies(self, prev_spot_copy=None):
         """Shuffle list of spot copy keys associated with this spot."""
-        spot_copies = [spot_copy.key() for spot_copy in self.all_spot_copy()]
+        all_copies = self.all_spot_copy()
+        spot_copies = [spot_copy.key() for spot_copy in all_copies]
         random.shuffle(spot_copies)
+        expiries = [c.expire_on for c in all_copies if c.expire_on]
+        if expiries:
+            self.copies_expire_at = min(expiries)
+        else:
+            self.copies_expire_at = NEVER_EXPIRES
 
         # Get spot copies that have been read in the last period (two hours).
+        # Only the spot_copy keys are loaded; the copies are not fetched.
         date = datetime.datetime.now().date() - datetime.timedelta(hours=2)
-        query = TrafficLogEntry.all().filter('log_date >=', date)
-        recent_spot_copies = []
-        for entry in query:
-            recent_spot_copies.append(entry.spot_copy.key())
+        query = (TrafficLogEntry.all(projection=('spot_copy',))
+                    .filter('spot =', self)
+                    .filter('log_date >=', date))
+        recent_spot_copies = set(
+            TrafficLogEntry.spot_copy.get_value_for_datastore(entry)
+            for entry in AutoRetry(query))
 		
         # Iterate through list, moving spot copies that have been read in the past period to the
         # end of the list.
@@ -191,17 +226,11 @@ class Spot(db.Model):
             # or return the next random one for reading
 
             today = time_util.chicago_now().date()
-            q = (TrafficLogEntry.all()
-                    .filter("log_date =", today)
-                    .filter("spot =", self)
-                    .filter("dow =", dow)
-                    .filter("hour =", hour)
-                    .filter("slot =", slot))
+            logged = TrafficLogEntry.read_entries(today, self, dow, hour, slot)
                 
             # Spot copy exists for dow, hour, and slot. Return it.
-            if AutoRetry(q).count(1):
-                existing_logged_spot = AutoRetry(q).fetch(1)[0]
-                spot_copy = existing_logged_spot.spot_copy
+            if logged:
+                spot_copy = logged[0].spot_copy
                 is_logged = True
             
             # Return next random spot copy.
@@ -254,6 +283,19 @@ class SpotCopy(db.Model):
     
     __str__ = __unicode__
 
+    def put(self, **kwargs):
+        key = super(SpotCopy, self).put(**kwargs)
+        if self.expire_on and SpotCopy.spot.get_value_for_datastore(self):
+            try:
+                spot = self.spot
+            except db.ReferencePropertyResolveError:
+                spot = None
+            if spot is not None:
+                spot.copy_expiry_changed(self.expire_on)
+        return key
+
+    save = put
+
     def get_absolute_url(self):
         return '/traffic_log/spot-copy/%s/' % self.key()
 
@@ -263,8 +305,18 @@ class SpotCopy(db.Model):
     def get_edit_url(self):
         return reverse('traffic_log.editSpotCopy', args=(self.key(),))
 
-## there can only be one entry per date, hour, slot
+## there can only be one entry per date, hour, slot and spot
 class TrafficLogEntry(db.Model):
+    """A spot scheduled for a time slot on a date.
+
+    Entries are created ahead of time by traffic_log.schedule and are
+    read once readtime is set.  Entries logged before the schedule was
+    built have no key name.
+
+    When an entry is read it is marked is_read and the spot's title and
+    type and the copy's underwriter are copied onto it so the report can
+    filter on them without loading the spots and copies.
+    """
     log_date  = db.DateProperty()
     spot      = db.ReferenceProperty(Spot)
     spot_copy = db.ReferenceProperty(SpotCopy)
@@ -275,5 +327,136 @@ class TrafficLogEntry(db.Model):
     readtime  = db.DateTimeProperty()
     reader    = db.ReferenceProperty(User)
     created   = db.DateTimeProperty(auto_now_add=True)
+    # Copied from the spot and its copy by denormalize().
+    is_read     = db.BooleanProperty(default=False)
+    spot_title  = db.StringProperty(indexed=False)
+    spot_type   = db.StringProperty()
+    underwriter = db.StringProperty()
 
-    
+    def put(self, **kwargs):
+        if self.readtime is not None and not self.is_read:
+            self.denormalize(self.spot, self.spot_copy)
+        return super(TrafficLogEntry, self).put(**kwargs)
+
+    save = put
+
+    def denormalize(self, spot, spot_copy):
+        """Copies the report fields from the entry's spot and copy."""
+        self.is_read = self.readtime is not None
+        self.spot_title = spot.title
+        self.spot_type = spot.type
+        underwriter = spot_copy and spot_copy.underwriter
+        # Indexed strings are limited to 500 characters.
+        self.underwriter = underwriter and underwriter[:500] or None
+
+    @staticmethod
+    def key_name_for(log_date, hour, slot, spot_key):
+        return 'entry:%s:%d:%d:%s' % (log_date.isoformat(), hour, slot,
+                                      spot_key.id_or_name())
+
+    @classmethod
+    def read_entries(cls, log_date, spot, dow, hour, slot):
+        """Returns the entries of spot read in a slot; normally one at most.
+        """
+        q = (cls.all()
+                .filter("log_date =", log_date)
+                .filter("spot =", spot)
+                .filter("dow =", dow)
+                .filter("hour =", hour)
+                .filter("slot =", slot))
+        return [e for e in AutoRetry(q).fetch(10) if e.readtime is not None]
+
+
+class UnderwriterRollup(db.Model):
+    """How many times an underwriter's spot was read in an hour of a day.
+
+    Kept up to date by traffic_log.underwriting so compliance reports
+    read a few rollups instead of every entry.
+    """
+    underwriter = db.StringProperty()
+    spot        = db.ReferenceProperty(Spot)
+    spot_title  = db.StringProperty(indexed=False)
+    date        = db.DateProperty()
+    hour        = db.IntegerProperty()
+    count       = db.IntegerProperty(default=0, indexed=False)
+    # The entries counted, so an entry is never counted twice.
+    entries     = db.ListProperty(db.Key, indexed=False)
+
+    @staticmethod
+    def key_name_for(underwriter, spot_key, date, hour):
+        return 'rollup:%s:%d:%s:%s' % (date.isoformat(), hour,
+                                       spot_key.id_or_name(), underwriter)
+
+
+class SpotIndex(object):
+    """Today's spots and their traffic log status for many constraints.
+
+    SpotConstraint.iter_spots_at_constraint makes several queries for
+    each spot.  This loads all of a day's TrafficLogEntry rows with one
+    query, then the spots and the spot copies to read with one batch get
+    each, and attaches itself to the constraints so they answer from it.
+    """
+
+    def __init__(self, constraints, log_date=None):
+        if log_date is None:
+            log_date = time_util.chicago_now().date()
+        self.constraints = list(constraints)
+        self._spots_at = {}
+
+        # (spot key, dow, hour, slot) -> spot copy key of the entry
+        self.logged = {}
+        q = TrafficLogEntry.all().filter("log_date =", log_date)
+        for entry in AutoRetry(q):
+            if entry.readtime is None:
+                # Scheduled but not read yet.
+                continue
+            spot_key = TrafficLogEntry.spot.get_value_for_datastore(entry)
+            copy_key = TrafficLogEntry.spot_copy.get_value_for_datastore(entry)
+            self.logged[(spot_key, entry.dow, entry.hour, entry.slot)] = \
+                copy_key
+
+        spot_keys = list(set(k for c in self.constraints for k in c.spots))
+        self.spots = dict(zip(spot_keys, AutoRetry(db).get(spot_keys)))
+
+        copy_keys = set(self.logged.values())
+        for spot in self.spots.values():
+            if spot is not None and spot.random_spot_copies:
+                copy_keys.add(spot.random_spot_copies[0])
+        copy_keys = [k for k in copy_keys if k is not None]
+        self.copies = dict(zip(copy_keys, AutoRetry(db).get(copy_keys)))
+
+        for constraint in self.constraints:
+            constraint.spot_index = self
+
+    def _spot_copy(self, constraint, spot):
+        """Returns (spot copy, is_logged) like Spot.get_spot_copy."""
+        slot = (spot.key(), constraint.dow, constraint.hour, constraint.slot)
+        if slot in self.logged:
+            return self.copies.get(self.logged[slot]), True
+        if spot.random_spot_copies:
+            copy = self.copies.get(spot.random_spot_copies[0])
+            if copy is not None and (copy.expire_on is None or
+                    copy.expire_on > datetime.datetime.now()):
+                return copy, False
+        # The shuffled copies ran out or expired, which get_spot_copy fixes.
+        return spot.get_spot_copy(constraint.dow, constraint.hour,
+                                  constraint.slot)
+
+    def spots_at(self, constraint):
+        """Returns the SpotAtConstraint of each spot with copy to read."""
+        key = (constraint.dow, constraint.hour, constraint.slot)
+        if key not in self._spots_at:
+            spots = []
+            for spot_key in constraint.spots:
+                spot = self.spots.get(spot_key)
+                if spot is None:
+                    # Deleted spots may have lingering constraints.
+                    continue
+                copy, is_logged = self._spot_copy(constraint, spot)
+                if copy is None:
+                    # probably a spot with expired copy (or copy not yet created)
+                    continue
+                spots.append(SpotAtConstraint(constraint, spot,
+                                              finished=is_logged))
+            self._spots_at[key] = spots
+        return self._spots_at[key]
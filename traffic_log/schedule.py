@@ -0,0 +1,141 @@
+###
+### Copyright 2009 The Chicago Independent Radio Project
+### All Rights Reserved.
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###     http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+###
+
+"""Builds the traffic log schedule for a week.
+
+Each spot of each SpotConstraint gets a TrafficLogEntry for every date
+of the week that falls on the constraint's day.  Entries have key names
+from TrafficLogEntry.key_name_for() so building a week again only adds
+what is missing, and reading a spot fills in its scheduled entry.
+
+build_week() loads the constraints and the active spots once, the
+keys of the week's existing entries with one keys-only query, and then
+puts the missing entries in parallel batches.  After TIME_LIMIT
+seconds it chains a task to carry on from the next date.
+"""
+
+from collections import defaultdict
+import datetime
+import logging
+import time
+
+from django.core.urlresolvers import reverse
+from google.appengine.api import memcache, taskqueue
+from google.appengine.ext import db
+
+from common.autoretry import AutoRetry
+from traffic_log import models
+
+log = logging.getLogger()
+
+DAYS = 7
+# Entries put per RPC.  The puts for a date run in parallel.
+PUT_BATCH_SIZE = 100
+# Seconds each task spends building before chaining the next one.
+TIME_LIMIT = 60
+
+STATS_KEY = 'traffic_log.schedule.stats'
+
+
+def get_stats():
+    """Returns stats for the last completed build or None."""
+    return memcache.get(STATS_KEY)
+
+
+def existing_key_names(start, end):
+    """Returns the key names of entries from start up to end."""
+    q = (models.TrafficLogEntry.all(keys_only=True)
+            .filter('log_date >=', start)
+            .filter('log_date <', end))
+    return set(key.name() for key in AutoRetry(q) if key.name())
+
+
+def missing_entries(log_date, constraints, spot_keys, existing):
+    """Returns the entries to create for log_date."""
+    entries = []
+    for constraint in constraints:
+        for spot_key in constraint.spots:
+            if spot_key not in spot_keys:
+                # Deleted spots may have lingering constraints.
+                continue
+            key_name = models.TrafficLogEntry.key_name_for(
+                log_date, constraint.hour, constraint.slot, spot_key)
+            if key_name in existing:
+                continue
+            entries.append(models.TrafficLogEntry(
+                key_name=key_name,
+                log_date=log_date,
+                spot=spot_key,
+                dow=constraint.dow,
+                hour=constraint.hour,
+                slot=constraint.slot,
+                scheduled=constraint))
+    return entries
+
+
+def build_week(start, day=0, created=0, started=None):
+    """Creates the missing entries for the week from start.
+
+    Carries on from the date day days after start.  Returns a dict of
+    progress so far.
+    """
+    if started is None:
+        started = time.time()
+    deadline = time.time() + TIME_LIMIT
+    end = start + datetime.timedelta(days=DAYS)
+
+    constraints_by_dow = defaultdict(list)
+    for constraint in AutoRetry(models.SpotConstraint.all()):
+        constraints_by_dow[constraint.dow].append(constraint)
+    spot_keys = set(AutoRetry(models.Spot.all(keys_only=True)
+                              .filter('active =', True)))
+    existing = existing_key_names(start + datetime.timedelta(days=day), end)
+
+    while day < DAYS:
+        log_date = start + datetime.timedelta(days=day)
+        entries = missing_entries(
+            log_date, constraints_by_dow[log_date.isoweekday()],
+            spot_keys, existing)
+        rpcs = [db.put_async(entries[i:i + PUT_BATCH_SIZE])
+                for i in range(0, len(entries), PUT_BATCH_SIZE)]
+        for rpc in rpcs:
+            rpc.get_result()
+        created += len(entries)
+        day += 1
+        if time.time() >= deadline:
+            break
+    finished = day >= DAYS
+
+    elapsed = max(time.time() - started, 0.001)
+    stats = {'start': start.isoformat(),
+             'created': created,
+             'finished': finished,
+             'seconds': round(elapsed, 3),
+             'per_second': round(created / elapsed, 1)}
+    if finished:
+        log.info('Scheduled %(created)s traffic log entries for the week '
+                 'of %(start)s in %(seconds)ss (%(per_second)s/sec)' % stats)
+        memcache.set(STATS_KEY, stats)
+    else:
+        log.info('Scheduled %(created)s traffic log entries for the week '
+                 'of %(start)s so far (%(per_second)s/sec)' % stats)
+        taskqueue.add(url=reverse('traffic_log.build_schedule'),
+                      params={'start': start.isoformat(),
+                              'day': day,
+                              'created': created,
+                              'started': repr(started)})
+    return stats
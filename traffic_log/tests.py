@@ -14,6 +14,7 @@
 ### See the License for the specific language governing permissions and
 ### limitations under the License.
 ###
+from __future__ import with_statement
 import os
 import time
 import unittest
@@ -22,20 +23,24 @@ from datetime import timedelta
 import csv
 from StringIO import StringIO
 import fudge
+import fudge.inspector
 
 from django.core.urlresolvers import reverse
 from django.test import TestCase as DjangoTestCase
 from django.utils import simplejson
 from django import http
 from django.test.client import Client
+from google.appengine.api import memcache
+from google.appengine.ext import db
 from nose.exc import SkipTest
 from nose.tools import eq_
 
 from common.testutil import FormTestCaseHelper
-from common import time_util
+from common import dbconfig, time_util
 from auth import roles
 from auth.models import User
-from traffic_log import views, models, constants
+from traffic_log import (views, models, constants, schedule, backfill,
+                         underwriting)
 from jobs.tests import JobTestCase
 from jobs.models import Job
 
@@ -89,9 +94,39 @@ class TestTrafficLogViews(DjangoTestCase):
         # second hour:
         self.assertEqual(spot_map[(now + datetime.timedelta(hours=1)).hour].title,
                 'Legal ID')
-        # thir hour (not shown anymore):
-        # self.assertEqual(spot_map[(now + datetime.timedelta(hours=2)).hour].title,
-        #         'Legal ID')
+        # third and fourth hours:
+        self.assertEqual(spot_map[(now + datetime.timedelta(hours=2)).hour].title,
+                'Legal ID')
+        self.assertEqual(spot_map[(now + datetime.timedelta(hours=3)).hour].title,
+                'Legal ID')
+
+    def test_landing_page_shows_finished_spots(self):
+        user = User(email='test')
+        user.save()
+        spot = models.Spot(title='Legal ID', type='Station ID')
+        spot_key = spot.put()
+        constraint_keys = views.saveConstraint(dict(hour_list=range(0,24), dow_list=range(1,8), slot=0))
+        views.connectConstraintsAndSpot(constraint_keys, spot_key)
+        spot_copy = models.SpotCopy(body='body', spot=spot, author=user)
+        spot_copy.put()
+        spot = models.Spot.get(spot_key)
+        spot.add_spot_copy(spot_copy)
+
+        now = time_util.chicago_now()
+        models.TrafficLogEntry(log_date=now.date(), spot=spot,
+                               spot_copy=spot_copy,
+                               dow=now.isoweekday(), hour=now.hour,
+                               slot=0, readtime=now).put()
+
+        resp = self.client.get(reverse('traffic_log.index'))
+        finished = {}
+        for c in resp.context[0]['slotted_spots']:
+            for spot_view in c.iter_spots_at_constraint():
+                finished[c.hour] = spot_view.finished
+        self.assertEqual(len(finished), views.HOURS_TO_SHOW)
+        self.assertEqual(finished[now.hour], True)
+        self.assertEqual(
+            finished[(now + datetime.timedelta(hours=1)).hour], False)
 
 class TestTrafficLogAdminViews(FormTestCaseHelper, DjangoTestCase):
 
@@ -243,7 +278,8 @@ class TestTrafficLogAdminViews(FormTestCaseHelper, DjangoTestCase):
         for slotted_spot in context['slotted_spots']:
             spots.append([s.title for s in slotted_spot.iter_spots()])
 
-        self.assertEqual(spots, [[], []]) # ensure 2 hours of spots have expired
+        # ensure all hours of spots have expired
+        self.assertEqual(spots, [[]] * views.HOURS_TO_SHOW)
 
     def test_delete_spot(self):
         spot = models.Spot(
@@ -579,6 +615,62 @@ class TestObjects(DjangoTestCase):
         self.assertEqual(spot_copy.get_delete_url(),
                             reverse('traffic_log.deleteSpotCopy', args=(spot_copy.key(),)))
 
+
+class TestSpotRotation(DjangoTestCase):
+
+    def setUp(self):
+        self.author = User(email='test')
+        self.author.save()
+        self.spot = models.Spot(title='Legal ID', type='Station ID')
+        self.spot.put()
+
+    def tearDown(self):
+        clear_data()
+
+    def add_copy(self, body, expire_on=None):
+        copy = models.SpotCopy(body=body, spot=self.spot, author=self.author,
+                               expire_on=expire_on)
+        copy.put()
+        return copy
+
+    def test_expiry_is_tracked_on_spot(self):
+        later = datetime.datetime.now() + timedelta(days=2)
+        first = self.add_copy('first')
+        second = self.add_copy('second', expire_on=later)
+        self.spot.shuffle_spot_copies()
+        self.spot.save()
+        self.assertEqual(self.spot.copies_expire_at, later)
+
+        # Nothing has expired so the copies are not checked.
+        db_get = fudge.Fake('get').is_callable().raises(
+            AssertionError('copies should not be fetched'))
+        with fudge.patched_context(models.db, 'get', db_get):
+            self.spot._expunge_expired_spot_copies(
+                self.spot.random_spot_copies)
+        self.assertEqual(len(self.spot.random_spot_copies), 2)
+
+        # Saving an expired copy moves the expiry onto the spot.
+        second.expire_on = datetime.datetime.now() - timedelta(minutes=1)
+        second.save()
+        spot = models.Spot.get(self.spot.key())
+        self.assertEqual(spot.copies_expire_at, second.expire_on)
+        spot._expunge_expired_spot_copies(spot.random_spot_copies)
+        self.assertEqual(spot.random_spot_copies, [first.key()])
+        self.assertEqual(spot.copies_expire_at, models.NEVER_EXPIRES)
+
+    def test_recently_read_copies_go_last(self):
+        first = self.add_copy('first')
+        second = self.add_copy('second')
+        # The window is worked out from the server's date.
+        now = datetime.datetime.now()
+        models.TrafficLogEntry(log_date=now.date(), spot=self.spot,
+                               spot_copy=first, dow=now.isoweekday(),
+                               hour=now.hour, slot=0, readtime=now).put()
+        for i in range(5):
+            self.spot.shuffle_spot_copies()
+            self.assertEqual(self.spot.random_spot_copies,
+                             [second.key(), first.key()])
+
 class TestTrafficLogDJViews(FormTestCaseHelper, DjangoTestCase):
 
     def setUp(self):
@@ -699,13 +791,92 @@ class TrafficLogTestCase(unittest.TestCase):
         views.connectConstraintsAndSpot([constraint_key], spot_key)
         self.assertEqual(models.Spot.get(spot_key).constraints.count(), 1)
 
-    def test_traffic_log_generate(self):
-        pass
-
     def test_spot_constraint_delete(self):
         pass
 
 
+class TestTrafficLogSchedule(DjangoTestCase):
+
+    def setUp(self):
+        assert memcache.flush_all()
+        author = User(email='test')
+        author.save()
+        # A Monday.
+        self.start = datetime.date(2011, 1, 3)
+        self.spots = [models.Spot(title='spot %s' % i, type='Live Read Promo',
+                                  author=author)
+                      for i in range(2)]
+        db.put(self.spots)
+        inactive = models.Spot(title='inactive', type='Live Read Promo',
+                               author=author, active=False)
+        inactive.put()
+        for dow, hour in ((1, 6), (1, 7), (3, 6)):
+            constraint = models.SpotConstraint(dow=dow, hour=hour, slot=0)
+            constraint.spots = [s.key() for s in self.spots] + [inactive.key()]
+            constraint.put()
+
+    def tearDown(self):
+        assert memcache.flush_all()
+        for kind in (models.TrafficLogEntry, models.SpotConstraint,
+                     models.Spot, User):
+            db.delete(kind.all(keys_only=True).fetch(500))
+
+    def entries(self):
+        return sorted(models.TrafficLogEntry.all(),
+                      key=lambda e: (e.log_date, e.hour))
+
+    def test_build_week(self):
+        stats = schedule.build_week(self.start)
+        self.assertEqual(stats['created'], 6)
+        self.assertEqual(stats['finished'], True)
+        self.assertEqual(schedule.get_stats()['created'], 6)
+        entries = self.entries()
+        self.assertEqual([(e.log_date.isoweekday(), e.hour) for e in entries],
+                         [(1, 6), (1, 6), (1, 7), (1, 7), (3, 6), (3, 6)])
+        for entry in entries:
+            self.assertEqual(entry.readtime, None)
+            self.assertEqual(entry.scheduled.hour, entry.hour)
+            self.assertEqual(entry.key().name(),
+                models.TrafficLogEntry.key_name_for(
+                    entry.log_date, entry.hour, entry.slot,
+                    entry.spot.key()))
+
+        # Building again only fills in what is missing.
+        entries[0].delete()
+        self.assertEqual(schedule.build_week(self.start)['created'], 1)
+        self.assertEqual(len(self.entries()), 6)
+
+    def test_scheduled_entries_are_not_read(self):
+        schedule.build_week(self.start)
+        self.assertEqual(models.TrafficLogEntry.read_entries(
+                            self.start, self.spots[0], 1, 6, 0), [])
+
+    def test_continues_in_task(self):
+        fake_add = fudge.Fake('add', callable=True).expects_call()
+        with fudge.patched_context(schedule, 'TIME_LIMIT', 0):
+            with fudge.patched_context(schedule.taskqueue, 'add', fake_add):
+                stats = schedule.build_week(self.start)
+        self.assertEqual(stats['finished'], False)
+        self.assertEqual(stats['created'], 4)
+        fudge.verify()
+
+        resp = self.client.post(reverse('traffic_log.build_schedule'),
+                                {'start': '2011-01-03', 'day': 1,
+                                 'created': 4, 'started': '0'})
+        self.assertEqual(resp.status_code, 200)
+        stats = simplejson.loads(resp.content)
+        self.assertEqual(stats['finished'], True)
+        self.assertEqual(stats['created'], 6)
+        self.assertEqual(len(self.entries()), 6)
+
+    def test_cron(self):
+        resp = self.client.get(reverse('traffic_log.generate'),
+                               {'start': '2011-01-03'},
+                               HTTP_X_APPENGINE_CRON='true')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(self.entries()), 6)
+
+
 class TestTrafficLogReport(FormTestCaseHelper, JobTestCase, DjangoTestCase):
 
     def add_spot_to_constraint(self, spot):
@@ -899,6 +1070,122 @@ class TestTrafficLogReport(FormTestCaseHelper, JobTestCase, DjangoTestCase):
         underwriters = set([row[3] for row in report])
         self.assertEquals(underwriters, set(['reckless']))
 
+    def test_report_in_chunks(self):
+        spot_copy = models.SpotCopy(body='Second copy', spot=self.spot,
+                                    author=self.author)
+        spot_copy.put()
+        models.TrafficLogEntry(
+            log_date = self.today,
+            spot = self.spot,
+            spot_copy = spot_copy,
+            dow = self.dow,
+            hour = self.now.hour,
+            slot = 0,
+            scheduled = self.constraint,
+            readtime = time_util.chicago_now(),
+            reader = self.author
+        ).put()
+        # Scheduled but not read.
+        models.TrafficLogEntry(log_date=self.today, spot=self.spot,
+                               dow=self.dow, hour=self.now.hour + 1,
+                               slot=0, scheduled=self.constraint).put()
+
+        params = {'start_date': self.today.strftime("%Y-%m-%d"),
+                  'end_date': self.today.strftime("%Y-%m-%d"),
+                  'type': constants.SPOT_TYPE_CHOICES[0],
+                  'underwriter': '',
+                  'download': 'Download'}
+        with fudge.patched_context(views, 'REPORT_BATCH_SIZE', 1):
+            response = self.get_job_product('build-trafficlog-report',
+                                            params)
+        report = csv.reader(StringIO(response.content))
+        header = report.next()
+        self.assertEquals(sorted(r[6] for r in report),
+                          ['Second copy',
+                           'You are listening to chirpradio.org'])
+
+    def test_entry_keeps_report_fields(self):
+        entry = models.TrafficLogEntry.all().get()
+        self.assertEquals(entry.spot_title, 'Legal ID')
+        self.assertEquals(entry.spot_type, 'Station ID')
+        self.assertEquals(entry.underwriter, None)
+
+    def test_backfill(self):
+        entry = models.TrafficLogEntry.all().get()
+        self.spot_copy.underwriter = 'reckless'
+        self.spot_copy.put()
+        entry.spot_title = entry.spot_type = entry.underwriter = None
+        entry.is_read = False
+        # Skips TrafficLogEntry.put(), like entries read before the
+        # report fields were kept.
+        db.put([entry])
+        self.assertEquals(list(views.report_query(self.report_params())),
+                          [])
+
+        stats = backfill.run_batch()
+        self.assertEquals(stats['updated'], 1)
+        self.assertEquals(stats['finished'], True)
+        assert backfill.is_finished()
+        dbconfig[backfill.FINISHED_KEY] = ''
+        entry = models.TrafficLogEntry.get(entry.key())
+        self.assertEquals(entry.is_read, True)
+        self.assertEquals(entry.spot_type, 'Station ID')
+        self.assertEquals(entry.underwriter, 'reckless')
+        self.assertEquals(
+            [e.key() for e in views.report_query(self.report_params())],
+            [entry.key()])
+        self.assertEquals(backfill.run_batch()['updated'], 0)
+
+    def test_backfill_task(self):
+        entry = models.TrafficLogEntry.all().get()
+        entry.spot_title = entry.spot_type = entry.underwriter = None
+        entry.is_read = False
+        db.put([entry])
+        dbconfig[backfill.FINISHED_KEY] = ''
+        # The task queue calls without a login cookie.
+        self.client.logout()
+        resp = self.client.post(reverse('traffic_log.backfill'))
+        self.assertEquals(resp.status_code, 200)
+        stats = simplejson.loads(resp.content)
+        self.assertEquals(stats['updated'], 1)
+        self.assertEquals(stats['finished'], True)
+        assert backfill.is_finished()
+        entry = models.TrafficLogEntry.get(entry.key())
+        self.assertEquals(entry.is_read, True)
+        dbconfig[backfill.FINISHED_KEY] = ''
+
+    def report_params(self):
+        return {'start_date': self.today.strftime("%Y-%m-%d"),
+                'end_date': self.today.strftime("%Y-%m-%d"),
+                'type': constants.SPOT_TYPE_CHOICES[0],
+                'underwriter': ''}
+
+    def test_report_skips_unread_entries(self):
+        models.TrafficLogEntry(log_date=self.today, spot=self.spot,
+                               dow=self.dow, hour=self.now.hour,
+                               slot=0, scheduled=self.constraint).put()
+        self.assertEquals(
+            [e.readtime is not None
+             for e in views.report_query(self.report_params())],
+            [True])
+
+    @fudge.patch('traffic_log.backfill.taskqueue.add')
+    def test_report_page_offers_backfill(self, fake_add):
+        fake_add.expects_call().with_args(
+                                url=reverse('traffic_log.backfill'),
+                                name=fudge.inspector.arg.any_value())
+        dbconfig[backfill.FINISHED_KEY] = ''
+        resp = self.client.get(reverse('traffic_log.report'))
+        assert 'Run Backfill' in resp.content
+        resp = self.client.post(reverse('traffic_log.report'),
+                                {'backfill': 'Run Backfill'})
+        self.assertEquals(resp.status_code, 302)
+
+        dbconfig[backfill.FINISHED_KEY] = '1'
+        resp = self.client.get(reverse('traffic_log.report'))
+        assert 'Run Backfill' not in resp.content
+        dbconfig[backfill.FINISHED_KEY] = ''
+
     def test_many_spots(self):
         raise SkipTest('Something in DB sorting probably broke this test')
         copy = []
@@ -939,6 +1226,118 @@ class TestTrafficLogReport(FormTestCaseHelper, JobTestCase, DjangoTestCase):
                           ['You are listening to chirpradio.org'] + copy)
 
 
+class TestUnderwriting(DjangoTestCase):
+
+    def setUp(self):
+        author = User(email='test')
+        author.save()
+        self.author = author
+        self.spot = models.Spot(title='Reckless', type='Underwriting Spot',
+                                author=author)
+        self.spot.put()
+        self.spot_copy = models.SpotCopy(body='Reckless Records',
+                                         spot=self.spot, author=author,
+                                         underwriter='reckless')
+        self.spot_copy.put()
+        self.date = datetime.date(2011, 1, 3)
+
+    def tearDown(self):
+        for kind in (models.UnderwriterRollup, models.TrafficLogEntry,
+                     models.SpotCopy, models.Spot, User):
+            db.delete(kind.all(keys_only=True).fetch(500))
+
+    def read(self, date, hour, slot=0):
+        entry = models.TrafficLogEntry(
+            log_date=date, spot=self.spot, spot_copy=self.spot_copy,
+            dow=date.isoweekday(), hour=hour, slot=slot,
+            readtime=datetime.datetime.combine(date, datetime.time(hour)),
+            reader=self.author)
+        entry.put()
+        return entry
+
+    def test_counts(self):
+        entries = [self.read(self.date, 6), self.read(self.date, 6, 30),
+                   self.read(self.date, 7),
+                   self.read(self.date + timedelta(days=1), 6)]
+        self.assertEqual(underwriting.add_reads(entries), 3)
+        end = self.date + timedelta(days=1)
+        self.assertEqual(underwriting.counts(self.date, end, by='hour'),
+                         {'reckless': [(6, 3), (7, 1)]})
+        self.assertEqual(underwriting.counts(self.date, end, 'reckless'),
+                         {'reckless': [(self.date, 3), (end, 1)]})
+        self.assertEqual(underwriting.counts(self.date, self.date,
+                                             by='spot'),
+                         {'reckless': [('Reckless', 3)]})
+        self.assertEqual(underwriting.counts(self.date, end, 'other'), {})
+
+        # Counting the same reads again changes nothing.
+        self.assertEqual(underwriting.add_reads(entries), 0)
+        self.assertEqual(underwriting.counts(self.date, end, by='hour'),
+                         {'reckless': [(6, 3), (7, 1)]})
+
+    def test_log_read(self):
+        entry = models.TrafficLogEntry(
+            key_name=models.TrafficLogEntry.key_name_for(
+                self.date, 6, 0, self.spot.key()),
+            log_date=self.date, spot=self.spot, spot_copy=self.spot_copy,
+            dow=self.date.isoweekday(), hour=6, slot=0,
+            readtime=datetime.datetime.combine(self.date, datetime.time(6)),
+            reader=self.author)
+        entry.denormalize(self.spot, self.spot_copy)
+        underwriting.log_read(entry)
+        assert models.TrafficLogEntry.get(entry.key()) is not None
+        self.assertEqual(underwriting.counts(self.date, self.date),
+                         {'reckless': [(self.date, 1)]})
+        # Already counted.
+        self.assertEqual(underwriting.add_reads([entry]), 0)
+
+    def test_skips_reads_without_underwriter(self):
+        self.spot_copy.underwriter = None
+        self.spot_copy.put()
+        self.assertEqual(underwriting.add_reads([self.read(self.date, 6)]),
+                         0)
+        self.assertEqual(underwriting.counts(self.date, self.date), {})
+
+    def test_backfill_counts_old_reads(self):
+        self.read(self.date, 6)
+        self.read(self.date, 7)
+        stats = backfill.run_batch()
+        self.assertEqual(stats['rollups'], 2)
+        self.assertEqual(underwriting.counts(self.date, self.date),
+                         {'reckless': [(self.date, 2)]})
+        self.assertEqual(backfill.run_batch()['rollups'], 0)
+
+    def test_report_page(self):
+        underwriting.add_reads([self.read(self.date, 6)])
+        assert self.client.login(email="test@test.com",
+                                 roles=[roles.TRAFFIC_LOG_ADMIN])
+        resp = self.client.get(reverse('traffic_log.underwriting_report'),
+                               {'start_date': '2011-01-01',
+                                'end_date': '2011-01-31',
+                                'underwriter': '',
+                                'by': 'hour'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.context['underwriters'],
+                         [{'name': 'reckless', 'total': 1,
+                           'groups': [('6:00am', 1)]}])
+
+    def test_report_page_warns_until_backfilled(self):
+        assert self.client.login(email="test@test.com",
+                                 roles=[roles.TRAFFIC_LOG_ADMIN])
+        dbconfig[backfill.FINISHED_KEY] = ''
+        resp = self.client.get(reverse('traffic_log.underwriting_report'))
+        assert 'backfill has run' in resp.content
+        dbconfig[backfill.FINISHED_KEY] = '1'
+        resp = self.client.get(reverse('traffic_log.underwriting_report'))
+        assert 'backfill has run' not in resp.content
+        dbconfig[backfill.FINISHED_KEY] = ''
+
+    def test_report_page_requires_admin(self):
+        assert self.client.login(email="dj@test.com", roles=[roles.DJ])
+        resp = self.client.get(reverse('traffic_log.underwriting_report'))
+        self.assertEqual(resp.status_code, 403)
+
+
 class TestAddHour(unittest.TestCase):
 
     def test_12am_on_sunday_becomes_1am(self):
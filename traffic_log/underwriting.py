@@ -0,0 +1,143 @@
+###
+### Copyright 2009 The Chicago Independent Radio Project
+### All Rights Reserved.
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###     http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+###
+
+"""Underwriter compliance counts.
+
+Every read of a spot with an underwriter is counted in an
+UnderwriterRollup for the underwriter, spot, date and hour.
+finishReadingSpotCopy puts each read with log_read(), which counts it
+in the same transaction, and traffic_log.backfill counts the older
+entries.  A rollup lists the entries it counted so counting an entry
+again changes nothing.
+
+counts() answers questions like "how many times did an underwriter air
+last month, by hour" from one query of the rollups.
+"""
+
+from collections import defaultdict
+
+from google.appengine.ext import db
+
+from common.autoretry import AutoRetry
+from traffic_log import models
+
+GROUPINGS = ('date', 'hour', 'spot')
+
+
+def _rollup_key(entry):
+    spot_key = models.TrafficLogEntry.spot.get_value_for_datastore(entry)
+    return db.Key.from_path(
+        'UnderwriterRollup',
+        models.UnderwriterRollup.key_name_for(entry.underwriter, spot_key,
+                                              entry.log_date, entry.hour))
+
+
+def _counted(rollup_key, entries):
+    """Returns the rollup with entries counted in it; it needs a put."""
+    rollup = models.UnderwriterRollup.get(rollup_key)
+    if rollup is None:
+        first = entries[0]
+        rollup = models.UnderwriterRollup(
+            key_name=rollup_key.name(),
+            underwriter=first.underwriter,
+            spot=models.TrafficLogEntry.spot.get_value_for_datastore(first),
+            spot_title=first.spot_title,
+            date=first.log_date,
+            hour=first.hour)
+    counted = set(rollup.entries)
+    for entry in entries:
+        if entry.key() not in counted:
+            rollup.entries.append(entry.key())
+            counted.add(entry.key())
+    rollup.count = len(rollup.entries)
+    return rollup
+
+
+def _add(rollup_key, entries):
+    _counted(rollup_key, entries).put()
+
+
+def log_read(entry):
+    """Puts a read entry and counts it in its rollup in one transaction.
+
+    The entry must have a key name and its report fields; see
+    TrafficLogEntry.key_name_for() and denormalize().
+    """
+    def txn():
+        to_put = [entry]
+        if entry.underwriter:
+            to_put.append(_counted(_rollup_key(entry), [entry]))
+        db.put(to_put)
+    # The entry and the rollup are in different entity groups.
+    options = db.create_transaction_options(xg=True)
+    db.run_in_transaction_options(options, txn)
+
+
+def add_reads(entries):
+    """Counts read entries that have an underwriter in their rollups.
+
+    Entries must have been put and have their report fields; see
+    TrafficLogEntry.denormalize().  Returns the number of rollups that
+    changed.
+    """
+    by_rollup = defaultdict(list)
+    for entry in entries:
+        if entry.readtime is not None and entry.underwriter:
+            by_rollup[_rollup_key(entry)].append(entry)
+    keys = list(by_rollup)
+    # Most rollups are already up to date when entries are counted again.
+    existing = AutoRetry(db).get(keys)
+    changed = 0
+    for key, rollup in zip(keys, existing):
+        if rollup is not None:
+            counted = set(rollup.entries)
+            if all(e.key() in counted for e in by_rollup[key]):
+                continue
+        db.run_in_transaction(_add, key, by_rollup[key])
+        changed += 1
+    return changed
+
+
+def get_rollups(start_date, end_date, underwriter=None):
+    """Returns the rollups from start_date up to and including end_date.
+    """
+    q = models.UnderwriterRollup.all()
+    if underwriter:
+        q = q.filter('underwriter =', underwriter)
+    q = (q.filter('date >=', start_date)
+          .filter('date <=', end_date))
+    return list(AutoRetry(q))
+
+
+def counts(start_date, end_date, underwriter=None, by='date'):
+    """Returns reads from start_date to end_date grouped by date, hour
+    or spot.
+
+    The result is a dict of underwriter to a sorted list of (group,
+    count) pairs, where group is a date, an hour or a spot title.
+    """
+    if by not in GROUPINGS:
+        raise ValueError('Cannot group by %r' % by)
+    totals = defaultdict(lambda: defaultdict(int))
+    for rollup in get_rollups(start_date, end_date, underwriter):
+        if by == 'spot':
+            group = rollup.spot_title
+        else:
+            group = getattr(rollup, by)
+        totals[rollup.underwriter][group] += rollup.count
+    return dict((name, sorted(groups.items()))
+                for name, groups in totals.items())
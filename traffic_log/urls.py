@@ -34,9 +34,14 @@ urlpatterns = patterns('',
     (r'^spot_constraint/delete/(?P<spot_constraint_key>[^\.^/]+)/'
      r'spot/(?P<spot_key>[^\.^/]+)?$',
      'traffic_log.views.deleteSpotConstraint'),
-    # kumar: commenting this out for now since the view function doesn't exist
-    # (r'^generate/(\d{4})/(\d{2})/(\d{2})',
-    #  'traffic_log.views.generateTrafficLog'),
-    url(r'^report/?$', 'traffic_log.views.report', name='traffic_log.report')
+    url(r'^generate$', 'traffic_log.views.generate',
+        name='traffic_log.generate'),
+    url(r'^task/build_schedule$', 'traffic_log.views.build_schedule',
+        name='traffic_log.build_schedule'),
+    url(r'^task/backfill$', 'traffic_log.views.backfill',
+        name='traffic_log.backfill'),
+    url(r'^report/?$', 'traffic_log.views.report', name='traffic_log.report'),
+    url(r'^underwriting/?$', 'traffic_log.views.underwriting_report',
+        name='traffic_log.underwriting_report')
 )
 
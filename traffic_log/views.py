@@ -16,7 +16,6 @@
 ###
 
 import sys
-import random
 import datetime
 import calendar
 import logging
@@ -36,17 +35,32 @@ from django.utils import simplejson
 import django.forms
 
 from common.utilities import (as_json, http_send_csv_file, as_encoded_str,
-                              restricted_job_worker, restricted_job_product)
-from common import time_util
+                              restricted_job_worker, restricted_job_product,
+                              cronjob)
+from common import expiry, time_util
 from common.autoretry import AutoRetry
+from jobs import append_output, iter_output
 import auth
 from auth.models import User
 from auth.roles  import DJ, TRAFFIC_LOG_ADMIN
 from auth.decorators import require_role
-from traffic_log import models, forms, constants
+from traffic_log import models, forms, constants, schedule, underwriting
+from traffic_log import backfill as backfill_entries
 
 log = logging.getLogger()
 
+# Hours of spots shown on the index page, starting with the current one.
+HOURS_TO_SHOW = 4
+
+# Columns of the traffic log report.
+REPORT_FIELDS = ['readtime', 'dow', 'slot_time', 'underwriter',
+                 'title', 'type', 'excerpt']
+# Entries written to the report by each job request.
+REPORT_BATCH_SIZE = 200
+
+# How long traffic log entries are kept for reports.
+ENTRY_RETENTION = datetime.timedelta(days=365 * 3)
+
 
 def context(*args, **kw):
     if len(args):
@@ -86,28 +100,20 @@ def index(request):
     current_dow = today.isoweekday()
     hours_by_day[current_dow].append(current_hour)
     
-    hour_plus1, dow_for_hour = add_hour(current_hour, current_dow)
-    hours_by_day[dow_for_hour].append(hour_plus1)
-    
-    ## it seems that showing more than 2 hours was 
-    ## consistently causing datastore timeouts during a 
-    ## period when datastore status was reported as normal
-    
-    # hour_plus2, dow_for_hour = add_hour(hour_plus1, dow_for_hour)
-    # hours_by_day[dow_for_hour].append(hour_plus2)
-    # 
-    # hour_plus3, dow_for_hour = add_hour(hour_plus2, dow_for_hour)
-    # hours_by_day[dow_for_hour].append(hour_plus3)
-    # 
-    # hours_to_show = [current_hour, hour_plus1, hour_plus2, hour_plus3]
-    
-    hours_to_show = [current_hour, hour_plus1]
+    hours_to_show = [current_hour]
+    dow_for_hour = current_dow
+    for i in range(HOURS_TO_SHOW - 1):
+        hour, dow_for_hour = add_hour(hours_to_show[-1], dow_for_hour)
+        hours_by_day[dow_for_hour].append(hour)
+        hours_to_show.append(hour)
     
     slotted_spots = []
     for dow in hours_by_day:
         q = models.SpotConstraint.all().filter("dow =", dow).filter("hour IN", hours_by_day[dow])
         for s in AutoRetry(q):
             slotted_spots.append(s)
+    # Loads what the page shows for all the constraints in a few batches.
+    models.SpotIndex(slotted_spots, today)
     
     def hour_position(s):
         return hours_to_show.index(s.hour)
@@ -162,24 +168,22 @@ def finishReadingSpotCopy(request, spot_copy_key=None):
 
     # Check if spot has already been read (i.e., logged).
     today = time_util.chicago_now().date()
-    q = (models.TrafficLogEntry.all()
-                    .filter("log_date =", today)
-                    .filter("spot =", spot_copy.spot)
-                    .filter("dow =", dow)
-                    .filter("hour =", hour)
-                    .filter("slot =", slot))
-    if AutoRetry(q).count(1):
-        existing_logged_spot = AutoRetry(q).fetch(1)[0]
+    spot_key = models.SpotCopy.spot.get_value_for_datastore(spot_copy)
+    read = models.TrafficLogEntry.read_entries(today, spot_key,
+                                               dow, hour, slot)
+    if read:
         raise RuntimeError("This spot %r at %r has already been read %s" % (
-                    spot_copy.spot, constraint, existing_logged_spot.reader))
+                    spot_copy.spot, constraint, read[0].reader))
 
     # Remove spot copy from the spot's list.
     spot_copy.spot.finish_spot_copy()
-	
-    # Log spot read.
+
+    # Log spot read, filling in the scheduled entry if there is one.
     logged_spot = models.TrafficLogEntry(
+        key_name = models.TrafficLogEntry.key_name_for(today, hour, slot,
+                                                       spot_key),
         log_date = today,
-        spot = spot_copy.spot,
+        spot = spot_key,
         spot_copy = spot_copy,
         dow = dow,
         hour = hour,
@@ -188,7 +192,8 @@ def finishReadingSpotCopy(request, spot_copy_key=None):
         readtime = time_util.chicago_now(), 
         reader = auth.get_current_user(request)
     )
-    AutoRetry(logged_spot).put()
+    logged_spot.denormalize(spot_copy.spot, spot_copy)
+    underwriting.log_read(logged_spot)
     
     return {
         'spot_copy_key': str(spot_copy.key()), 
@@ -391,62 +396,43 @@ def deleteSpotConstraint(request, spot_constraint_key=None, spot_key=None):
     return HttpResponseRedirect('/traffic_log/spot/edit/%s'%spot_key)
 
 
-## maybe we don't generate a weeks worth of logs and instead jit the logs per hour or per day?
-def generateTrafficLogEntriesForWeek(request, year, month, day):
-    for d in constants.DOW:
-        next_day = datetime.datetime(int(year), int(month), int(day)) + datetime.timedelta(d)
-        generateTrafficLogEntries(request, next_day.date())
-        
-    
-def generateTrafficLogEntriesForDay(request, date=None):
-    date = date if date else datetime.datetime.today().date()
-    for hour in constants.HOUR:
-        entries_for_hour = generateTrafficLogEntriesForHour(request, date, hour)
-
-
-def generateTrafficLogEntriesForHour(request, datetime=None, hour=None):
-    now = datetime if datetime else chicago_now()
-    hour = hour if hour else now.hour
-    log_for_hour = []
-    for slot in constants.SLOT:
-        log_for_hour.append(getOrCreateTrafficLogEntry(now.date, hour, slot))
-            
-
-def getOrCreateTrafficLogEntry(date, hour, slot):
-    entry = models.TrafficLogEntry.gql(
-        "where log_date = :1 and hour = :2 and slot = :3",
-        date, hour, slot
-        )
-    
-    if AutoRetry(entry).count():
-        return AutoRetry(entry).get()
+@cronjob
+def generate(request):
+    """Cron view that builds next week's traffic log; see
+    traffic_log.schedule."""
+    if request.GET.get('start'):
+        start = _parse_date(request.GET['start'])
     else:
-        constraint = models.SpotConstraint.gql(
-            "where dow = :1 and hour = :2 and slot = :3",
-            date.isoweekday(), hour, slot
-            )
-        if AutoRetry(constraint).count():
-            constraint = AutoRetry(constraint).get()
-            spot = randomSpot(constraint.spots)
-            if spot:
-                new_entry = models.TrafficLogEntry(
-                    log_date  = date,
-                    spot      = spot,
-                    hour      = hour,
-                    slot      = slot,
-                    scheduled = constraint
-                    )
-                AutoRetry(new_entry).put()
-                return new_entry
-            else:
-                return
- 
-
-def randomSpot(spotkeylist):
-    #return models.Spot.get(random.choice(spotkeylist))
-    return random.choice(spotkeylist)
-
-                
+        start = time_util.chicago_now().date() + datetime.timedelta(days=1)
+    schedule.build_week(start)
+
+
+@as_json
+def build_schedule(request):
+    """Task view that continues building a week's traffic log."""
+    return schedule.build_week(_parse_date(request.POST['start']),
+                               day=int(request.POST['day']),
+                               created=int(request.POST['created']),
+                               started=float(request.POST['started']))
+
+
+@as_json
+def backfill(request):
+    """Task view that copies report fields onto old entries and counts
+    them in the underwriter rollups; see traffic_log.backfill."""
+    params = request.REQUEST
+    started = params.get('started')
+    return backfill_entries.run_batch(
+                cursor=params.get('cursor'),
+                updated=int(params.get('updated', 0)),
+                rollups=int(params.get('rollups', 0)),
+                started=started and float(started) or None)
+
+
+def _parse_date(date_string):
+    return datetime.datetime.strptime(date_string, '%Y-%m-%d').date()
+
+
 def displayAndReadSpot(request, traffic_log_key):
     pass
 
@@ -468,98 +454,131 @@ def traffic_log(request, date):
         context_instance=RequestContext(request))
 
 
-@restricted_job_worker('build-trafficlog-report', TRAFFIC_LOG_ADMIN)
-def trafficlog_report_worker(results, request_params):
-    fields = ['readtime', 'dow', 'slot_time', 'underwriter',
-              'title', 'type', 'excerpt']
-    if results is None:
-        # when starting the job, init file lines with the header row...
-        results = {
-            "file_lines": [ 
-                ",".join(fields) + "\n" 
-            ],
-            'last_offset': 0
-        }
-    
-    offset = results['last_offset']
-    last_offset = offset+50
-    results['last_offset'] = last_offset
-    
-    def mkdt(dt_string):
-        parts = [int(p) for p in dt_string.split("-")]
-        return datetime.datetime(*parts)
-        
+def report_query(request_params):
+    """Returns the entries for the report, filtered by date, spot type
+    and underwriter."""
+
+    def mkdate(date_string):
+        parts = [int(p) for p in date_string.split("-")]
+        return datetime.date(*parts)
+
     query = (models.TrafficLogEntry.all()
-                .filter('log_date >=', mkdt(request_params['start_date']))
+                .filter('is_read =', True)
+                .filter('log_date >=', mkdate(request_params['start_date']))
                 .filter('log_date <',
-                        mkdt(request_params['end_date']) +
-                        datetime.timedelta(days=1))
-    )
+                        mkdate(request_params['end_date']) +
+                        datetime.timedelta(days=1)))
     if request_params['type']:
         index = constants.SPOT_TYPE_CHOICES.index(request_params['type'])
         if index > 0:
             # -1 = not found, 0 = ALL
-            spots = models.Spot.all().filter(
-                        'type =', constants.SPOT_TYPE_CHOICES[index])
-            query = query.filter('spot IN', list(spots))
-    # TODO(Kumar) figure out why this doesn't work!
-    # if request_params['underwriter']:
-    #     copies = models.SpotCopy.all().filter('underwriter =',
-    #                                           request_params['underwriter'])
-    #     query = query.filter('spot_copy IN', list(copies))
-                        
-    all_entries = query[ offset: last_offset ]
-    if len(all_entries) == 0:
-        finished = True
-    else:
-        finished = False
-    
-    for entry in all_entries:
-        # TODO(Kumar) - see above
-        if request_params['underwriter']:
-            if entry.spot_copy.underwriter != request_params['underwriter']:
-                continue
-        buf = StringIO()
-        writer = csv.DictWriter(buf, fields)
-        row = report_entry_to_csv_dict(entry)
-        for k, v in row.items():
-            row[k] = as_encoded_str(v, encoding='utf8')
-        writer.writerow(row)
-        results['file_lines'].append(buf.getvalue())
-    
+            query = query.filter('spot_type =',
+                                 constants.SPOT_TYPE_CHOICES[index])
+    if request_params['underwriter']:
+        query = query.filter('underwriter =', request_params['underwriter'])
+    return query.order('log_date')
+
+
+@restricted_job_worker('build-trafficlog-report', TRAFFIC_LOG_ADMIN)
+def trafficlog_report_worker(results, request_params):
+    buf = StringIO()
+    writer = csv.writer(buf)
+    if results is None:
+        # when starting the job, start the file with the header row...
+        results = {'cursor': None}
+        writer.writerow(REPORT_FIELDS)
+
+    query = report_query(request_params)
+    if results['cursor']:
+        query.with_cursor(results['cursor'])
+    entries = query.fetch(REPORT_BATCH_SIZE)
+    results['cursor'] = query.cursor()
+    finished = len(entries) < REPORT_BATCH_SIZE
+
+    copy_keys = set(models.TrafficLogEntry.spot_copy
+                          .get_value_for_datastore(e) for e in entries)
+    copy_keys.discard(None)
+    copies = dict((c.key(), c) for c in
+                  AutoRetry(db).get(list(copy_keys)) if c is not None)
+    for entry in entries:
+        copy_key = models.TrafficLogEntry.spot_copy.get_value_for_datastore(
+                                                                    entry)
+        row = report_entry_to_csv_dict(entry, copies.get(copy_key))
+        writer.writerow([as_encoded_str(row[f], encoding='utf8')
+                         for f in REPORT_FIELDS])
+    append_output(results, buf.getvalue())
     return finished, results
 
 
 @restricted_job_product('build-trafficlog-report', TRAFFIC_LOG_ADMIN)
 def playlist_report_product(results):
     fname = "chirp-traffic_log"
-    response = HttpResponse(content_type='text/csv; charset=utf-8')
+    response = HttpResponse(iter_output(results),
+                            content_type='text/csv; charset=utf-8')
     response['Content-Disposition'] = "attachment; filename=%s.csv" % (fname)
-    for line in results['file_lines']:
-        response.write(line)
     return response
 
 
 @require_role(TRAFFIC_LOG_ADMIN)
 def report(request):
     # See job/worker code above for generating actual report
+    if request.method == 'POST' and request.POST.get('backfill'):
+        backfill_entries.start()
+        return HttpResponseRedirect(request.path)
     end_date = datetime.datetime.now().date()
     start_date = end_date - datetime.timedelta(days=30)
     report_form = forms.ReportForm({'start_date': start_date,
                                     'end_date': end_date})
     return render_to_response('traffic_log/report.html', 
-                              context({'form': report_form}),
+                              context({'form': report_form,
+                                       'backfilled':
+                                           backfill_entries.is_finished()}),
+                              context_instance=RequestContext(request))
+
+@require_role(TRAFFIC_LOG_ADMIN)
+def underwriting_report(request):
+    """Counts of underwriters' spots read in a period; see
+    traffic_log.underwriting."""
+    if request.GET:
+        form = forms.UnderwritingReportForm(request.GET)
+    else:
+        end_date = time_util.chicago_now().date()
+        start_date = end_date - datetime.timedelta(days=30)
+        form = forms.UnderwritingReportForm({'start_date': start_date,
+                                             'end_date': end_date,
+                                             'by': 'date'})
+    underwriters = None
+    if form.is_valid():
+        by = form.cleaned_data['by']
+        counts = underwriting.counts(form.cleaned_data['start_date'],
+                                     form.cleaned_data['end_date'],
+                                     form.cleaned_data['underwriter'],
+                                     by=by)
+        underwriters = []
+        for name in sorted(counts):
+            groups = counts[name]
+            if by == 'hour':
+                groups = [(models.readable_slot_time(hour, 0), n)
+                          for hour, n in groups]
+            underwriters.append({'name': name,
+                                 'total': sum(n for group, n in groups),
+                                 'groups': groups})
+    backfilled = backfill_entries.is_finished()
+    return render_to_response('traffic_log/underwriting.html',
+                              context({'form': form,
+                                       'underwriters': underwriters,
+                                       'backfilled': backfilled}),
                               context_instance=RequestContext(request))
 
-def report_entry_to_csv_dict(entry):
-    return {    
+def report_entry_to_csv_dict(entry, spot_copy):
+    return {
         'readtime': time_util.convert_utc_to_chicago(entry.readtime),
-        'dow': constants.DOW_DICT[entry.dow],                                       
-        'underwriter': entry.spot_copy.underwriter,
-        'slot_time': entry.scheduled.readable_slot_time,
-        'title': entry.spot.title,
-        'type': entry.spot.type,
-        'excerpt': entry.spot_copy.body[:140]
+        'dow': constants.DOW_DICT[entry.dow],
+        'underwriter': entry.underwriter,
+        'slot_time': models.readable_slot_time(entry.hour, entry.slot),
+        'title': entry.spot_title,
+        'type': entry.spot_type,
+        'excerpt': spot_copy and spot_copy.body[:140] or ''
     }
 
 def box(thing):
@@ -579,3 +598,9 @@ def _get_slot_from_request(request):
     if slot not in constants.SLOT:
         raise ValueError("dow value %r is out of range" % slot)
     return dow, hour, slot
+
+
+@expiry.expirer('traffic_log_entries')
+def old_traffic_log_entries(now):
+    return models.TrafficLogEntry.all(keys_only=True).filter(
+                "log_date <", now.date() - ENTRY_RETENTION)